@@ -0,0 +1,145 @@
+import frappe
+from frappe.utils import cint
+
+from stripe_pay.methods.replica import read_from_replica, use_primary
+
+TRANSFER_DETAIL_FIELDS = [
+    "name", "reference_id", "status", "datetime", "account", "transfer_type",
+    "amount", "currency", "payout_status", "payout_id", "reference_doc", "refrence_name",
+]
+
+
+@frappe.whitelist()
+def get_transfer_details(reference_doc, reference_name, force_primary=0):
+    """Stripe Transfer Details of one invoice, newest first.
+
+    Pass `force_primary` right after creating a payment so the rows just written
+    are not hidden by replication lag.
+    """
+    frappe.has_permission(reference_doc, doc=reference_name, throw=True)
+
+    if cint(force_primary):
+        with use_primary():
+            return _get_transfer_details(reference_doc, reference_name)
+
+    return _get_transfer_details(reference_doc, reference_name)
+
+
+@read_from_replica
+def _get_transfer_details(reference_doc, reference_name):
+    return frappe.get_all(
+        "Stripe Transfer Details",
+        filters={"reference_doc": reference_doc, "refrence_name": reference_name},
+        fields=TRANSFER_DETAIL_FIELDS,
+        order_by="datetime desc",
+    )
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_transfer_status_summary(from_date=None, to_date=None):
+    """Counts and amounts of Stripe Transfer Details per type and status, for status dashboards."""
+    frappe.has_permission("Stripe Transfer Details", throw=True)
+
+    filters = {}
+    if from_date and to_date:
+        filters["datetime"] = ["between", [from_date, to_date]]
+    elif from_date:
+        filters["datetime"] = [">=", from_date]
+    elif to_date:
+        filters["datetime"] = ["<=", to_date]
+
+    return frappe.get_all(
+        "Stripe Transfer Details",
+        filters=filters,
+        fields=["transfer_type", "status", "count(name) as count", "sum(amount) as amount"],
+        group_by="transfer_type, status",
+    )
+
+
+PAYMENT_FIELDS = [
+    "session_id", "payment_intent_id", "status", "payment_method_type", "amount", "currency",
+    "reference_doctype", "reference_name", "stripe_created", "paid_at", "expected_settlement_date", "fee", "net",
+]
+
+
+@frappe.whitelist()
+def get_payments(reference_doctype, reference_name, force_primary=0):
+    """Stripe Payments ledger rows of one invoice, newest first; amounts are in cents."""
+    frappe.has_permission(reference_doctype, doc=reference_name, throw=True)
+
+    if cint(force_primary):
+        with use_primary():
+            return _get_payments(reference_doctype, reference_name)
+
+    return _get_payments(reference_doctype, reference_name)
+
+
+@read_from_replica
+def _get_payments(reference_doctype, reference_name):
+    return frappe.get_all(
+        "Stripe Payments",
+        filters={"reference_doctype": reference_doctype, "reference_name": reference_name},
+        fields=PAYMENT_FIELDS,
+        order_by="stripe_created desc",
+    )
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_payment_status_summary(from_date=None, to_date=None):
+    """Counts and amounts (in cents) of Stripe Payments per status and currency."""
+    frappe.has_permission("Stripe Payments", throw=True)
+
+    filters = {}
+    if from_date and to_date:
+        filters["stripe_created"] = ["between", [from_date, to_date]]
+    elif from_date:
+        filters["stripe_created"] = [">=", from_date]
+    elif to_date:
+        filters["stripe_created"] = ["<=", to_date]
+
+    return frappe.get_all(
+        "Stripe Payments",
+        filters=filters,
+        fields=["status", "currency", "count(name) as count", "sum(amount) as amount"],
+        group_by="status, currency",
+    )
+
+
+@frappe.whitelist()
+@read_from_replica
+def find_collective_invoices_by_session(session_ids):
+    """Map Stripe checkout session ids to Collective Invoices, for reconciliation against Stripe exports."""
+    frappe.has_permission("Collective Invoices", throw=True)
+
+    session_ids = frappe.parse_json(session_ids) if isinstance(session_ids, str) else session_ids
+    if not session_ids:
+        return {}
+
+    return {
+        row.custom_stripe_session_id: row
+        for row in frappe.get_all(
+            "Collective Invoices",
+            filters={"custom_stripe_session_id": ["in", session_ids]},
+            fields=["name", "status", "custom_stripe_session_id", "custom_stripe_payment_intent_id"],
+        )
+    }
+
+
+@frappe.whitelist()
+@read_from_replica
+def export_transfer_details(from_date, to_date, transfer_type=None):
+    """Raw Stripe Transfer Details rows for a period, for reconciliation exports."""
+    frappe.has_permission("Stripe Transfer Details", "export", throw=True)
+
+    filters = {"datetime": ["between", [from_date, to_date]]}
+    if transfer_type:
+        filters["transfer_type"] = transfer_type
+
+    return frappe.get_all(
+        "Stripe Transfer Details",
+        filters=filters,
+        fields=TRANSFER_DETAIL_FIELDS,
+        order_by="datetime asc",
+    )
@@ -1,9 +1,39 @@
 import frappe
-import stripe
 import json
 from frappe import _
+from frappe.utils import flt
+
+from stripe_pay.methods.admission import shed_webhook
+from stripe_pay.methods.client import get_webhook_secret
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.site_filter import is_foreign_event
+from stripe_pay.methods.tracing import get_stripe_trace_id, set_trace_id, traced
+from stripe_pay.stripe_pay.doctype.stripe_payment_summary.stripe_payment_summary import (
+    record_payment_summary,
+)
+from stripe_pay.methods.webhook_dispatch import dispatch_event, get_object_reference
+from stripe_pay.methods.webhook_queue import submit_events
+from stripe_pay.stripe_pay.doctype.stripe_checkout_session.stripe_checkout_session import (
+    COMPLETED,
+    set_session_status,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import (
+    FAILED,
+    PAID,
+    PROCESSING,
+    get_payment_reference,
+    record_session_payment,
+    set_payment_status,
+)
+from stripe_pay.stripe_pay.doctype.stripe_processed_event.stripe_processed_event import (
+    get_processed_event_ids,
+)
+from stripe_pay.stripe_pay.doctype.stripe_webhook_dead_letter.stripe_webhook_dead_letter import (
+    record_dead_letter,
+)
 
 @frappe.whitelist(allow_guest=True)
+@traced("webhook.receive")
 def stripe_payment_webhook():
     """
     Stripe webhook endpoint to handle payment events
@@ -14,12 +44,12 @@ def stripe_payment_webhook():
         payload = frappe.request.get_data()
         sig_header = frappe.get_request_header("Stripe-Signature")
         
-        # Get webhook secret from site config
-        webhook_secret = frappe.conf.get("stripe_webhook_secret")
+        # Stripe Payment Settings, or site config on older setups
+        webhook_secret = get_webhook_secret()
         
         if not webhook_secret:
             frappe.log_error(
-                "Stripe webhook secret not found in site config",
+                "Stripe webhook secret not configured",
                 "Stripe Webhook Error"
             )
             frappe.local.response.http_status_code = 400
@@ -38,6 +68,16 @@ def stripe_payment_webhook():
             frappe.log_error(f"Invalid signature: {str(e)}", "Stripe Webhook Error")
             frappe.local.response.http_status_code = 400
             return {"error": "Invalid signature"}
+        set_trace_id(get_stripe_trace_id(event))
+        
+        # Another site's event on a shared Stripe account - acknowledge it and do nothing,
+        # before shedding, so a busy site does not make Stripe retry events it never needs
+        if is_foreign_event(event):
+            return {"status": "success", "ignored": True}
+        
+        shed = shed_webhook()
+        if shed:
+            return shed
         
         # Log the event
         frappe.log_error(
@@ -47,26 +87,11 @@ def stripe_payment_webhook():
             "Stripe Webhook Received"
         )
         
-        # Handle different event types
-        event_type = event["type"]
-        
-        if event_type == "checkout.session.completed":
-            handle_checkout_completed(event["data"]["object"])
-        elif event_type == "checkout.session.async_payment_succeeded":
-            # ACH payments fire this event when payment actually succeeds
-            handle_async_payment_succeeded(event["data"]["object"])
-        elif event_type == "payment_intent.succeeded":
-            handle_payment_succeeded(event["data"]["object"])
-        elif event_type == "payment_intent.payment_failed":
-            handle_payment_failed(event["data"]["object"])
-        elif event_type == "checkout.session.async_payment_failed":
-            # ACH payment failed
-            handle_async_payment_failed(event["data"]["object"])
-        else:
-            frappe.log_error(
-                f"Unhandled event type: {event_type}",
-                "Stripe Webhook Info"
-            )
+        if get_processed_event_ids([event["id"]]):
+            return {"status": "success", "duplicate": True}
+        
+        submit_events([event], "Webhook")
+        frappe.db.commit()
         
         return {"status": "success"}
         
@@ -79,6 +104,73 @@ def stripe_payment_webhook():
         return {"error": str(e)}
 
 
+def process_event(event):
+    """Dispatch an event, parking it in the dead-letter queue if its handler fails"""
+    # roll back only this event's writes, not those of the batch it came in
+    savepoint = f"stripe_event_{frappe.generate_hash(length=8)}"
+    frappe.db.savepoint(savepoint)
+    try:
+        dispatch_event(event)
+    except Exception as e:
+        frappe.db.rollback(save_point=savepoint)
+        record_dead_letter(event, e)
+
+
+def mark_session_completed(session):
+    """Handle checkout session completed for any invoice - stop tracking it as open"""
+    set_session_status([session.get("id")], COMPLETED)
+
+
+def record_checkout_completed(session):
+    """Ledger: a completed checkout is paid, or processing until its bank debit settles"""
+    record_session_payment(
+        session,
+        PAID if session.get("payment_status") == "paid" else PROCESSING,
+        *get_object_reference(session),
+    )
+
+
+def record_async_payment_succeeded(session):
+    """Ledger: the bank debit of a completed checkout settled"""
+    record_session_payment(session, PAID, *get_object_reference(session))
+
+
+def record_async_payment_failed(session):
+    """Ledger: the bank debit of a completed checkout failed"""
+    record_session_payment(session, FAILED, *get_object_reference(session))
+
+
+def record_payment_intent_succeeded(payment_intent):
+    """Ledger: the checkout this payment intent belongs to is paid"""
+    set_payment_status(PAID, payment_intent_id=payment_intent.get("id"))
+
+
+def record_payment_intent_failed(payment_intent):
+    """Ledger: the checkout this payment intent belongs to failed"""
+    set_payment_status(FAILED, payment_intent_id=payment_intent.get("id"))
+
+
+def handle_sales_invoice_checkout_completed(session):
+    """Handle checkout session completed for a Sales Invoice - store its payment intent
+
+    The intent only exists once the customer pays, so it is unknown when the session
+    is created; refunds and the payment intent handlers need it.
+    """
+    payment_intent_id = session.get("payment_intent")
+    sales_invoice = (session.get("metadata") or {}).get("sales_invoice")
+    if not payment_intent_id or not sales_invoice:
+        return
+
+    invoice = frappe.qb.DocType("Sales Invoice")
+    (
+        frappe.qb.update(invoice)
+        .set(invoice.stripe_payment_intent_id, payment_intent_id)
+        .where(invoice.name == sales_invoice)
+        .where(invoice.stripe_session_id == session.get("id"))
+        .run()
+    )
+
+
 def handle_checkout_completed(session):
     """Handle checkout session completed - for immediate payments (cards)"""
     try:
@@ -94,22 +186,20 @@ def handle_checkout_completed(session):
         )
         
         # Only update to Paid if payment_status is "paid" (immediate payments like cards)
-        # For ACH, payment_status will be "unpaid" here, so we wait for async_payment_succeeded
+        # For ACH, payment_status will be "unpaid" here, so we wait for async_payment_succeeded;
+        # record_checkout_completed keeps it in the ledger as Processing until then
         if payment_status != "paid":
-            frappe.log_error(
-                f"⏳ Payment status is '{payment_status}' - waiting for async payment completion",
-                "Stripe Checkout Completed"
-            )
             return
         
         # Find and update invoice for immediate payments
-        update_invoice_status(session_id, session.get("payment_intent"), "Paid")
+        update_invoice_status(session_id, session.get("payment_intent"), "Paid", session)
         
     except Exception as e:
         frappe.log_error(
             f"❌ Error in handle_checkout_completed: {str(e)}\n{frappe.get_traceback()}",
             "Stripe Webhook Error"
         )
+        raise
 
 
 def handle_async_payment_succeeded(session):
@@ -126,13 +216,14 @@ def handle_async_payment_succeeded(session):
         )
         
         # Update invoice to Paid
-        update_invoice_status(session_id, session.get("payment_intent"), "Paid")
+        update_invoice_status(session_id, session.get("payment_intent"), "Paid", session)
         
     except Exception as e:
         frappe.log_error(
             f"❌ Error in handle_async_payment_succeeded: {str(e)}\n{frappe.get_traceback()}",
             "Stripe Webhook Error"
         )
+        raise
 
 
 def handle_async_payment_failed(session):
@@ -147,33 +238,30 @@ def handle_async_payment_failed(session):
         )
         
         # Update invoice to Failed
-        update_invoice_status(session_id, session.get("payment_intent"), "Failed")
+        update_invoice_status(session_id, session.get("payment_intent"), "Failed", session)
         
     except Exception as e:
         frappe.log_error(
             f"❌ Error in handle_async_payment_failed: {str(e)}\n{frappe.get_traceback()}",
             "Stripe Webhook Error"
         )
+        raise
 
 
-def update_invoice_status(session_id, payment_intent_id, new_status):
+def update_invoice_status(session_id, payment_intent_id, new_status, session=None):
     """Helper function to update invoice status"""
     try:
         # Find the invoice
-        invoices = frappe.get_all(
-            "Collective Invoices",
-            filters={"custom_stripe_session_id": session_id},
-            fields=["name", "status", "custom_stripe_session_id", "custom_stripe_payment_intent_id"]
-        )
+        invoice_name = find_collective_invoice(session_id=session_id)
         
         frappe.log_error(
             f"🔍 Search Results:\n"
             f"Looking for session_id: {session_id}\n"
-            f"Found {len(invoices)} invoice(s): {invoices}",
+            f"Found invoice: {invoice_name}",
             "Stripe Invoice Search"
         )
         
-        if not invoices:
+        if not invoice_name:
             frappe.log_error(
                 f"⚠️ No invoice found for session: {session_id}",
                 "Stripe Webhook Warning"
@@ -181,7 +269,7 @@ def update_invoice_status(session_id, payment_intent_id, new_status):
             return
         
         # Update invoice
-        invoice = frappe.get_doc("Collective Invoices", invoices[0].name)
+        invoice = frappe.get_doc("Collective Invoices", invoice_name)
         
         frappe.log_error(
             f"📄 Found invoice: {invoice.name}\n"
@@ -196,6 +284,15 @@ def update_invoice_status(session_id, payment_intent_id, new_status):
             invoice.custom_stripe_payment_intent_id = payment_intent_id
         
         invoice.save(ignore_permissions=True)
+        if session:
+            record_payment_summary(
+                flt(session.get("amount_total")) / 100,
+                new_status,
+                reference_doc="Collective Invoices",
+                transfer_type="Webhook",
+                company=get_collective_invoice_company(invoice),
+                currency=session.get("currency"),
+            )
         frappe.db.commit()
         
         frappe.log_error(
@@ -211,6 +308,28 @@ def update_invoice_status(session_id, payment_intent_id, new_status):
             f"❌ Error updating invoice: {str(e)}\n{frappe.get_traceback()}",
             "Stripe Invoice Update Error"
         )
+        raise
+
+
+def find_collective_invoice(session_id=None, payment_intent_id=None):
+    """Collective Invoice of a checkout session or payment intent
+
+    Read from the Stripe Payments ledger; payments made before the ledger existed
+    are found by the ids stored on the invoice.
+    """
+    reference_doctype, reference_name = get_payment_reference(session_id, payment_intent_id)
+    if reference_doctype:
+        return reference_name if reference_doctype == "Collective Invoices" else None
+
+    if session_id:
+        return frappe.db.get_value("Collective Invoices", {"custom_stripe_session_id": session_id})
+    return frappe.db.get_value("Collective Invoices", {"custom_stripe_payment_intent_id": payment_intent_id})
+
+
+def get_collective_invoice_company(invoice):
+    """Company of a Collective Invoice, taken from its first reference invoice"""
+    if invoice.reference_invoices:
+        return frappe.db.get_value("Sales Invoice", invoice.reference_invoices[0].sales_invoice, "company")
 
 
 def handle_payment_succeeded(payment_intent):
@@ -229,6 +348,7 @@ def handle_payment_succeeded(payment_intent):
             f"Error in handle_payment_succeeded: {str(e)}",
             "Stripe Webhook Error"
         )
+        raise
 
 
 def handle_payment_failed(payment_intent):
@@ -243,16 +363,20 @@ def handle_payment_failed(payment_intent):
         )
         
         # Find and update invoice
-        invoices = frappe.get_all(
-            "Collective Invoices",
-            filters={"custom_stripe_payment_intent_id": payment_intent_id},
-            fields=["name"]
-        )
+        invoice_name = find_collective_invoice(payment_intent_id=payment_intent_id)
         
-        if invoices:
-            invoice = frappe.get_doc("Collective Invoices", invoices[0].name)
+        if invoice_name:
+            invoice = frappe.get_doc("Collective Invoices", invoice_name)
             invoice.status = "Failed"
             invoice.save(ignore_permissions=True)
+            record_payment_summary(
+                flt(payment_intent.get("amount")) / 100,
+                "Failed",
+                reference_doc="Collective Invoices",
+                transfer_type="Webhook",
+                company=get_collective_invoice_company(invoice),
+                currency=payment_intent.get("currency"),
+            )
             frappe.db.commit()
             
             frappe.log_error(
@@ -264,4 +388,5 @@ def handle_payment_failed(payment_intent):
         frappe.log_error(
             f"Error in handle_payment_failed: {str(e)}",
             "Stripe Webhook Error"
-        )
\ No newline at end of file
+        )
+        raise
\ No newline at end of file
@@ -0,0 +1,31 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("stripe-backfill")
+@click.option("--from-date", required=True, help="Import Stripe objects created on or after this date")
+@click.option("--to-date", help="Import Stripe objects created before this date, defaults to now")
+@click.option("--window-days", default=30, type=int, help="Length of the time windows fetched in parallel")
+@click.option("--workers", type=int, help="Parallel windows, defaults to the Connected Account Workers setting")
+@pass_context
+def stripe_backfill(context, from_date, to_date=None, window_days=30, workers=None):
+	"""Backfill Stripe Transfer Details from existing Stripe transfers, payouts and checkout sessions"""
+	from stripe_pay.methods.backfill import run_backfill
+
+	site = get_site(context)
+	frappe.init(site=site)
+	try:
+		frappe.connect()
+		written = run_backfill(from_date, to_date, window_days=window_days, workers=workers)
+		click.echo(
+			f"Processed {len(written)} window(s), wrote {sum(count or 0 for count in written.values())} record(s)"
+		)
+		failed = [name for name, count in written.items() if count is None]
+		if failed:
+			click.secho(f"{len(failed)} window(s) failed, run the command again to retry them", fg="yellow")
+	finally:
+		frappe.destroy()
+
+
+commands = [stripe_backfill]
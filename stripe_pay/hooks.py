@@ -48,6 +48,10 @@ override_whitelisted_methods = {
 doctype_js = {"Sales Invoice" : "public/js/sales_invoice.js",
                "Collective Invoices" : "public/js/collective_invoice.js"}
 # doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
+doctype_list_js = {
+	"Sales Invoice": "public/js/stripe_refund_list.js",
+	"Collective Invoices": "public/js/stripe_refund_list.js",
+}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
@@ -140,6 +144,51 @@ doctype_js = {"Sales Invoice" : "public/js/sales_invoice.js",
 # ---------------
 # Hook on document methods and events
 
+doc_events = {
+	"Company": {
+		"on_update": "stripe_pay.methods.accounts.clear_payment_account_cache",
+		"on_trash": "stripe_pay.methods.accounts.clear_payment_account_cache",
+	},
+	"Mode of Payment": {
+		"on_update": "stripe_pay.methods.accounts.clear_payment_account_cache",
+		"on_trash": "stripe_pay.methods.accounts.clear_payment_account_cache",
+	},
+	"Stripe Payment Settings": {
+		"on_update": "stripe_pay.stripe_pay.doctype.stripe_connected_account.stripe_connected_account.clear_connected_account_cache",
+	},
+}
+
+# Stripe webhook handlers per event type and invoice doctype, see
+# stripe_pay.methods.webhook_dispatch. "*" handlers run for every event of the type.
+stripe_webhook_handlers = {
+	"checkout.session.completed": {
+		"*": [
+			"stripe_pay.api.stripe_webhook.mark_session_completed",
+			"stripe_pay.api.stripe_webhook.record_checkout_completed",
+		],
+		"Sales Invoice": "stripe_pay.api.stripe_webhook.handle_sales_invoice_checkout_completed",
+		"Collective Invoices": "stripe_pay.api.stripe_webhook.handle_checkout_completed",
+	},
+	"checkout.session.async_payment_succeeded": {
+		"*": "stripe_pay.api.stripe_webhook.record_async_payment_succeeded",
+		"Collective Invoices": "stripe_pay.api.stripe_webhook.handle_async_payment_succeeded",
+	},
+	"checkout.session.async_payment_failed": {
+		"*": "stripe_pay.api.stripe_webhook.record_async_payment_failed",
+		"Collective Invoices": "stripe_pay.api.stripe_webhook.handle_async_payment_failed",
+	},
+	"payment_intent.succeeded": {
+		"*": [
+			"stripe_pay.api.stripe_webhook.handle_payment_succeeded",
+			"stripe_pay.api.stripe_webhook.record_payment_intent_succeeded",
+		],
+	},
+	"payment_intent.payment_failed": {
+		"*": "stripe_pay.api.stripe_webhook.record_payment_intent_failed",
+		"Collective Invoices": "stripe_pay.api.stripe_webhook.handle_payment_failed",
+	},
+}
+
 # doc_events = {
 # 	"*": {
 # 		"on_update": "method",
@@ -151,6 +200,32 @@ doctype_js = {"Sales Invoice" : "public/js/sales_invoice.js",
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"*/5 * * * *": [
+			"stripe_pay.stripe_pay.doctype.stripe_webhook_dead_letter.stripe_webhook_dead_letter.retry_dead_letters",
+			"stripe_pay.methods.payment_entries.submit_queued_payment_entries",
+			"stripe_pay.stripe_pay.doctype.stripe_transfer_retry.stripe_transfer_retry.retry_failed_transfers",
+		],
+		"*/10 * * * *": [
+			"stripe_pay.methods.event_poller.poll_events",
+		],
+		"*/15 * * * *": [
+			"stripe_pay.methods.sessions.sweep_checkout_sessions",
+			"stripe_pay.methods.site_filter.rebuild_session_filter",
+		],
+		"*/2 * * * *": [
+			"stripe_pay.methods.tracing.flush_spans",
+		],
+	},
+	"hourly": [
+		"stripe_pay.methods.payouts.create_batched_payouts",
+		"stripe_pay.methods.connected_accounts.refresh_payout_statuses",
+		"stripe_pay.methods.pending_payments.check_pending_payments",
+		"stripe_pay.methods.fees.capture_stripe_fees",
+	],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"stripe_pay.tasks.all"
@@ -199,12 +274,12 @@ doctype_js = {"Sales Invoice" : "public/js/sales_invoice.js",
 
 # Request Events
 # ----------------
-# before_request = ["stripe_pay.utils.before_request"]
+before_request = ["stripe_pay.methods.client.prewarm"]
 # after_request = ["stripe_pay.utils.after_request"]
 
 # Job Events
 # ----------
-# before_job = ["stripe_pay.utils.before_job"]
+before_job = ["stripe_pay.methods.client.prewarm"]
 # after_job = ["stripe_pay.utils.after_job"]
 
 # User Data Protection
@@ -241,7 +316,8 @@ doctype_js = {"Sales Invoice" : "public/js/sales_invoice.js",
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+default_log_clearing_doctypes = {
+	"Stripe Processed Event": 30,  # Stripe only keeps events for 30 days
+	"Stripe Payment Span": 30,
+}
 
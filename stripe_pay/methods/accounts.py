@@ -0,0 +1,56 @@
+import frappe
+
+PAYMENT_ACCOUNTS_CACHE_KEY = "stripe_pay:payment_accounts"
+
+
+def get_payment_accounts(company):
+    """Resolve the accounts a Stripe Payment Entry posts to for a company.
+
+    Returns a dict with `receivable_account`, `stripe_account` (the Stripe Mode of
+    Payment account), `fallback_account` (the Cash Mode of Payment account),
+    `paid_to` (Stripe, else Cash) and `mode_of_payment`. Missing accounts are None.
+    """
+    return frappe._dict(get_payment_account_map().get(company) or {})
+
+
+def get_payment_account_map():
+    return frappe.cache.get_value(PAYMENT_ACCOUNTS_CACHE_KEY, build_payment_account_map)
+
+
+def build_payment_account_map():
+    """Precompute the account resolution of every company in two queries."""
+    company = frappe.qb.DocType("Company")
+    mop_account = frappe.qb.DocType("Mode of Payment Account")
+
+    receivables = (
+        frappe.qb.from_(company).select(company.name, company.default_receivable_account).run()
+    )
+    mode_of_payment_accounts = {
+        (mode_of_payment, account_company): default_account
+        for mode_of_payment, account_company, default_account in (
+            frappe.qb.from_(mop_account)
+            .select(mop_account.parent, mop_account.company, mop_account.default_account)
+            .where(mop_account.parenttype == "Mode of Payment")
+            .where(mop_account.parent.isin(["Stripe", "Cash"]))
+            .run()
+        )
+    }
+
+    account_map = {}
+    for name, receivable_account in receivables:
+        stripe_account = mode_of_payment_accounts.get(("Stripe", name))
+        fallback_account = mode_of_payment_accounts.get(("Cash", name))
+        account_map[name] = {
+            "receivable_account": receivable_account,
+            "stripe_account": stripe_account,
+            "fallback_account": fallback_account,
+            "paid_to": stripe_account or fallback_account,
+            "mode_of_payment": "Stripe",
+        }
+
+    return account_map
+
+
+def clear_payment_account_cache(doc=None, method=None):
+    """doc_events hook for Company and Mode of Payment"""
+    frappe.cache.delete_value(PAYMENT_ACCOUNTS_CACHE_KEY)
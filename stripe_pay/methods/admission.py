@@ -0,0 +1,116 @@
+import time
+
+import frappe
+from frappe.utils import add_days, cint, getdate, nowdate
+from frappe.utils.background_jobs import get_queue
+from redis.exceptions import RedisError
+
+from stripe_pay.methods.webhook_queue import get_queue_shards, get_shard_queues
+
+QUEUE_DEPTH = "queue_depth"
+DB_LATENCY = "db_latency"
+
+# how long a worker reuses its last load reading, so a burst of webhooks does
+# not turn into a burst of queue and latency probes
+CHECK_INTERVAL = 2
+METRICS_RETENTION_DAYS = 8
+
+_last_check = {}
+
+
+def shed_webhook():
+    """Admission control for webhook endpoints.
+
+    Returns None when the request may proceed. Called once the signature is
+    verified, so unsigned requests cannot trigger the checks. While this site's
+    webhook queues or the database are past their thresholds it sets status 503
+    and returns the response body instead, so Stripe retries the delivery later
+    with backoff and the remaining capacity stays with interactive users.
+    """
+    reason = get_overload_reason()
+    if not reason:
+        return None
+
+    record_shed(reason)
+    frappe.local.response.http_status_code = 503
+    return {"error": "Service overloaded, please retry", "reason": reason}
+
+
+def get_overload_reason():
+    site = frappe.local.site
+    checked_at, reason = _last_check.get(site, (0, None))
+    if time.monotonic() - checked_at < CHECK_INTERVAL:
+        return reason
+
+    reason = check_load()
+    _last_check[site] = (time.monotonic(), reason)
+    return reason
+
+
+def check_load():
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+
+    max_depth = cint(settings.max_webhook_queue_depth)
+    if max_depth and get_queue_depth() > max_depth:
+        return QUEUE_DEPTH
+
+    max_latency = cint(settings.max_db_latency_ms)
+    if max_latency and get_db_latency_ms() > max_latency:
+        return DB_LATENCY
+
+
+def get_queue_depth():
+    """Events of this site waiting on the webhook queue shards.
+
+    RQ queues are shared by every site on the bench, so jobs are counted by the
+    site prefix of their id rather than by queue length. Without shards events are
+    applied in the request itself and nothing queues up.
+    """
+    shards = get_queue_shards()
+    if not shards:
+        return 0
+
+    prefix = f"{frappe.local.site}::"
+    try:
+        return sum(
+            sum(1 for job_id in get_queue(queue).get_job_ids() if job_id.startswith(prefix))
+            for queue in get_shard_queues(shards)
+        )
+    except RedisError:
+        # an unreachable queue is not a reason to refuse payments
+        return 0
+
+
+def get_db_latency_ms():
+    started = time.perf_counter()
+    frappe.db.sql("select 1")
+    return (time.perf_counter() - started) * 1000
+
+
+def record_shed(reason):
+    key = get_metrics_key(nowdate(), reason)
+    try:
+        frappe.cache.incr(key)
+        frappe.cache.expire(key, METRICS_RETENTION_DAYS * 24 * 60 * 60)
+    except RedisError:
+        pass
+
+
+def get_metrics_key(date, reason):
+    return frappe.cache.make_key(f"stripe_pay:webhook_shed:{date}:{reason}")
+
+
+@frappe.whitelist()
+def get_shed_counts(days=7):
+    """Webhook deliveries refused per day and reason, newest day first."""
+    frappe.only_for("System Manager")
+
+    today = getdate()
+    dates = [add_days(today, -offset) for offset in range(min(cint(days), METRICS_RETENTION_DAYS))]
+    keys = [get_metrics_key(date, reason) for date in dates for reason in (QUEUE_DEPTH, DB_LATENCY)]
+    values = iter(frappe.cache.mget(keys))
+
+    return [
+        {"date": date, QUEUE_DEPTH: cint(next(values)), DB_LATENCY: cint(next(values))}
+        for date in dates
+    ]
@@ -0,0 +1,118 @@
+from datetime import date
+from itertools import accumulate
+
+import frappe
+from frappe.utils import flt, getdate
+
+OLDEST_FIRST = "Oldest First"
+DUE_DATE = "Due Date"
+PRO_RATA = "Pro Rata"
+
+STRATEGY_DATE_FIELD = {OLDEST_FIRST: "posting_date", DUE_DATE: "due_date"}
+
+
+def get_allocation_strategy():
+    return frappe.get_cached_doc("Stripe Payment Settings").allocation_strategy or OLDEST_FIRST
+
+
+def get_collective_invoice_companies(names):
+    """{Collective Invoice: company} in one query.
+
+    Like `get_collective_invoice_company`, a Collective Invoice's company is that of
+    its first reference invoice.
+    """
+    if not names:
+        return {}
+
+    reference_doctype = frappe.get_meta("Collective Invoices").get_field("reference_invoices").options
+    companies = {}
+    for parent, company in frappe.get_all(
+        reference_doctype,
+        filters={"parenttype": "Collective Invoices", "parent": ["in", list(names)]},
+        fields=["parent", "sales_invoice.company"],
+        order_by="idx asc",
+        as_list=True,
+    ):
+        companies.setdefault(parent, company)
+    return companies
+
+
+def get_reference_invoices(ci_doc):
+    """Load the outstanding vector of a Collective Invoice's references in a single query.
+
+    Each row's `outstanding` is capped by the amount the Collective Invoice claims for
+    that Sales Invoice, as the row-by-row allocation always did.
+    """
+    names = [row.sales_invoice for row in ci_doc.reference_invoices if row.sales_invoice]
+    if not names:
+        return []
+
+    invoices = {
+        invoice.name: invoice
+        for invoice in frappe.get_all(
+            "Sales Invoice",
+            filters={"name": ["in", names]},
+            fields=["name", "company", "grand_total", "outstanding_amount", "posting_date", "due_date"],
+        )
+    }
+
+    rows = []
+    for ref_invoice in ci_doc.reference_invoices:
+        invoice = invoices.get(ref_invoice.sales_invoice)
+        if not invoice:
+            continue
+
+        invoice = frappe._dict(invoice)
+        invoice.outstanding = min(flt(invoice.outstanding_amount), flt(ref_invoice.outstanding))
+        rows.append(invoice)
+
+    return rows
+
+
+def allocate(settled_amount, invoices, strategy=OLDEST_FIRST):
+    """Spread a settled amount over invoices, returning one allocation per invoice.
+
+    Works in integer cents so allocations always add up to the settled amount (or the
+    total outstanding, whichever is lower) without rounding drift. Oldest First and
+    Due Date fill invoices in date order; Pro Rata splits by outstanding share and
+    hands leftover cents to the largest remainders.
+    """
+    outstanding = [max(round(flt(invoice.outstanding) * 100), 0) for invoice in invoices]
+    total = sum(outstanding)
+    settled = min(max(round(flt(settled_amount) * 100), 0), total)
+    if not settled:
+        return [0.0] * len(invoices)
+
+    if strategy == PRO_RATA:
+        shares = [cents * settled for cents in outstanding]
+        allocations = [share // total for share in shares]
+        leftover = settled - sum(allocations)
+        by_remainder = sorted(range(len(shares)), key=lambda i: shares[i] % total, reverse=True)
+        for i in by_remainder[:leftover]:
+            allocations[i] += 1
+    else:
+        date_field = STRATEGY_DATE_FIELD.get(strategy, "posting_date")
+        order = sorted(
+            range(len(invoices)),
+            key=lambda i: (getdate(invoices[i].get(date_field)) if invoices[i].get(date_field) else date.max, invoices[i].name),
+        )
+        allocations = [0] * len(invoices)
+        for i, filled in zip(order, accumulate(outstanding[i] for i in order)):
+            allocations[i] = min(outstanding[i], max(settled - (filled - outstanding[i]), 0))
+
+    return [cents / 100 for cents in allocations]
+
+
+def build_payment_references(invoices, allocations):
+    """Payment Entry reference rows for every invoice that received an allocation."""
+    return [
+        {
+            "reference_doctype": "Sales Invoice",
+            "reference_name": invoice.name,
+            "total_amount": invoice.grand_total,
+            "outstanding_amount": invoice.outstanding_amount,
+            "allocated_amount": allocated,
+        }
+        for invoice, allocated in zip(invoices, allocations)
+        if allocated > 0
+    ]
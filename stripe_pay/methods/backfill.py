@@ -0,0 +1,326 @@
+"""Import Stripe history that predates stripe_pay into Stripe Transfer Details.
+
+The requested period is cut into fixed `created` windows per resource (and per
+connected account for payouts), each tracked as a Stripe Backfill Window. Windows
+are paged through in parallel on the fan-out pool, every page is written with one
+bulk insert, added to the payment summary and committed together with the
+window's cursor, so an interrupted backfill picks up where each window stopped
+and skips finished ones. Rerun it with the same start date and window size to
+resume:
+
+    bench --site <site> stripe-backfill --from-date 2021-01-01
+"""
+
+import re
+from datetime import datetime
+
+import frappe
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+from stripe_pay.methods.allocation import get_collective_invoice_companies
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.pool import run_parallel
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.refunds import INVOICE_FIELDS
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.stripe_pay.doctype.stripe_connected_account.stripe_connected_account import (
+    get_all_connected_accounts,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payment_summary.stripe_payment_summary import (
+    record_payment_summary,
+)
+
+WINDOW = "Stripe Backfill Window"
+TRANSFER = "Transfer"
+PAYOUT = "Payout"
+CHECKOUT_SESSION = "Checkout Session"
+
+PENDING = "Pending"
+COMPLETED = "Completed"
+FAILED = "Failed"
+
+PAGE_SIZE = 100
+DEFAULT_WINDOW_DAYS = 30
+
+# transfers and payouts made by `transfer_and_payout` name their invoice in the description
+DESCRIPTION_PATTERN = re.compile(r"^(?:Transfer|Payout) for (Sales Invoice|Collective Invoice) (.+)$")
+DESCRIPTION_DOCTYPES = {"Sales Invoice": "Sales Invoice", "Collective Invoice": "Collective Invoices"}
+
+# Stripe payout status -> Stripe Transfer Details status
+PAYOUT_STATUS = {"paid": "paid", "failed": "failed", "canceled": "cancel", "pending": "pending", "in_transit": "pending"}
+
+
+@frappe.whitelist()
+def start_backfill(from_date, to_date=None, window_days=DEFAULT_WINDOW_DAYS):
+    """Run the backfill in the background; see `run_backfill`."""
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "stripe_pay.methods.backfill.run_backfill",
+        queue="long",
+        timeout=6 * 60 * 60,
+        job_id="stripe_backfill",
+        deduplicate=True,
+        from_date=from_date,
+        to_date=to_date,
+        window_days=window_days,
+    )
+
+
+def run_backfill(from_date, to_date=None, window_days=DEFAULT_WINDOW_DAYS, workers=None):
+    """Backfill transfers, payouts and completed checkout sessions created in the period.
+
+    Returns the number of records written by each window processed in this run.
+    """
+    stripe.api_key = get_secret_key()
+    windows = plan_windows(
+        get_datetime(from_date),
+        get_datetime(to_date) if to_date else now_datetime(),
+        cint(window_days) or DEFAULT_WINDOW_DAYS,
+    )
+    return run_parallel(backfill_window, windows, max_workers=workers)
+
+
+def plan_windows(start, end, window_days):
+    """Create the windows of the period that do not exist yet and return those not completed."""
+    targets = [(TRANSFER, ""), (CHECKOUT_SESSION, "")]
+    targets += [(PAYOUT, account) for account in get_all_connected_accounts()]
+
+    bounds = []
+    window_start = start
+    while window_start < end:
+        window_end = min(add_to_date(window_start, days=window_days), end)
+        bounds.append((window_start, window_end))
+        window_start = window_end
+
+    existing = {
+        (row.resource, row.account or "", get_datetime(row.window_start)): row
+        for row in frappe.get_all(
+            WINDOW,
+            filters={"window_start": ["between", [start, end]]},
+            fields=["name", "resource", "account", "window_start", "status"],
+        )
+    }
+
+    now = now_datetime()
+    names, rows = [], []
+    for resource, account in targets:
+        for window_start, window_end in bounds:
+            window = existing.get((resource, account, window_start))
+            if window:
+                if window.status != COMPLETED:
+                    names.append(window.name)
+                continue
+
+            name = frappe.generate_hash(length=10)
+            rows.append(
+                (name, now, now, "Administrator", "Administrator", resource, account, window_start, window_end, PENDING, 0)
+            )
+            names.append(name)
+
+    frappe.db.bulk_insert(
+        WINDOW,
+        [
+            "name", "creation", "modified", "owner", "modified_by",
+            "resource", "account", "window_start", "window_end", "status", "records",
+        ],
+        rows,
+    )
+    frappe.db.commit()
+    return names
+
+
+def backfill_window(name):
+    """Page through one window from its cursor, checkpointing after every page."""
+    window = frappe.get_doc(WINDOW, name)
+    list_method = {
+        TRANSFER: stripe.Transfer.list,
+        PAYOUT: stripe.Payout.list,
+        CHECKOUT_SESSION: stripe.checkout.Session.list,
+    }[window.resource]
+
+    params = {
+        "created": {
+            "gte": int(get_datetime(window.window_start).timestamp()),
+            "lte": int(get_datetime(window.window_end).timestamp()) - 1,
+        },
+        "limit": PAGE_SIZE,
+    }
+    if window.account:
+        params["stripe_account"] = window.account
+
+    records = cint(window.records)
+    cursor = window.cursor
+    try:
+        while True:
+            page = stripe_call(list_method, starting_after=cursor, priority=BACKGROUND, **params)
+            if page.data:
+                records += write_page(window, page.data)
+                cursor = page.data[-1].id
+            done = not page.has_more or not page.data
+            window.db_set(
+                {"cursor": cursor, "records": records, "status": COMPLETED if done else PENDING, "error": None},
+                update_modified=False,
+            )
+            frappe.db.commit()
+            if done:
+                return records
+    except Exception:
+        frappe.db.rollback()
+        window.db_set({"status": FAILED, "error": frappe.get_traceback()}, update_modified=False)
+        frappe.db.commit()
+        raise
+
+
+def write_page(window, objects):
+    """Insert the Stripe Transfer Details a page yields, skipping objects already recorded."""
+    if window.resource == CHECKOUT_SESSION:
+        objects = [session for session in objects if session.status == "complete"]
+        link_invoice_sessions(objects)
+
+    known = set(
+        frappe.get_all(
+            "Stripe Transfer Details",
+            filters={"reference_id": ["in", [obj.id for obj in objects]]},
+            pluck="reference_id",
+        )
+    ) if objects else set()
+
+    to_row = {TRANSFER: transfer_row, PAYOUT: payout_row, CHECKOUT_SESSION: session_row}[window.resource]
+    now = now_datetime()
+    rows = [
+        (frappe.generate_hash(length=10), now, now, "Administrator", "Administrator", *to_row(obj, window.account))
+        for obj in objects
+        if obj.id not in known
+    ]
+    frappe.db.bulk_insert(
+        "Stripe Transfer Details",
+        [
+            "name", "creation", "modified", "owner", "modified_by",
+            "reference_id", "status", "datetime", "reference_doc", "refrence_name",
+            "account", "transfer_type", "amount", "currency",
+        ],
+        rows,
+    )
+    record_summary(rows)
+    return len(rows)
+
+
+def record_summary(rows):
+    """Add written Stripe Transfer Details rows to the payment summary, in the page's transaction."""
+    companies = get_reference_companies({(row[8], row[9]) for row in rows if row[8] and row[9]})
+    for row in rows:
+        status, posted_at, reference_doc, reference_name, _account, transfer_type, amount, currency = row[6:]
+        record_payment_summary(
+            amount,
+            status,
+            reference_doc=reference_doc,
+            transfer_type=transfer_type,
+            company=companies.get((reference_doc, reference_name)),
+            currency=currency,
+            posting_date=posted_at,
+        )
+
+
+def get_reference_companies(references):
+    """{(reference doctype, name): company} of Sales Invoices and Collective Invoices."""
+    names = {
+        doctype: [name for reference_doc, name in references if reference_doc == doctype]
+        for doctype in DESCRIPTION_DOCTYPES.values()
+    }
+    companies = {}
+    if names["Sales Invoice"]:
+        for name, company in frappe.get_all(
+            "Sales Invoice", filters={"name": ["in", names["Sales Invoice"]]}, fields=["name", "company"], as_list=True
+        ):
+            companies["Sales Invoice", name] = company
+    for name, company in get_collective_invoice_companies(names["Collective Invoices"]).items():
+        companies["Collective Invoices", name] = company
+    return companies
+
+
+def transfer_row(transfer, account):
+    reference_doc, reference_name = parse_description(transfer.get("description"))
+    return (
+        transfer.id,
+        "cancel" if transfer.get("reversed") else "paid",
+        datetime.fromtimestamp(transfer.created),
+        reference_doc,
+        reference_name,
+        transfer.get("destination"),
+        TRANSFER,
+        transfer.amount / 100,
+        transfer.currency,
+    )
+
+
+def payout_row(payout, account):
+    reference_doc, reference_name = parse_description(payout.get("description"))
+    return (
+        payout.id,
+        PAYOUT_STATUS.get(payout.status, "pending"),
+        datetime.fromtimestamp(payout.created),
+        reference_doc,
+        reference_name,
+        account,
+        PAYOUT,
+        payout.amount / 100,
+        payout.currency,
+    )
+
+
+def session_row(session, account):
+    metadata = session.get("metadata") or {}
+    if metadata.get("collective_invoice"):
+        reference_doc, reference_name = "Collective Invoices", metadata["collective_invoice"]
+    elif metadata.get("sales_invoice"):
+        reference_doc, reference_name = "Sales Invoice", metadata["sales_invoice"]
+    else:
+        reference_doc = reference_name = None
+    return (
+        session.id,
+        "paid",
+        datetime.fromtimestamp(session.created),
+        reference_doc,
+        reference_name,
+        None,
+        "Checkout",
+        (session.get("amount_total") or 0) / 100,
+        session.currency,
+    )
+
+
+def parse_description(description):
+    match = DESCRIPTION_PATTERN.match(description or "")
+    if not match:
+        return None, None
+    return DESCRIPTION_DOCTYPES[match.group(1)], match.group(2)
+
+
+def link_invoice_sessions(sessions):
+    """Point invoices without a stored session at their completed checkout session."""
+    for doctype, metadata_key in (("Sales Invoice", "sales_invoice"), ("Collective Invoices", "collective_invoice")):
+        fields = INVOICE_FIELDS[doctype]
+        meta = frappe.get_meta(doctype)
+        if not meta.has_field(fields["session"]):
+            continue
+
+        sessions_by_invoice = {
+            session.metadata[metadata_key]: session
+            for session in sessions
+            if (session.get("metadata") or {}).get(metadata_key)
+        }
+        if not sessions_by_invoice:
+            continue
+
+        unlinked = frappe.get_all(
+            doctype,
+            filters={"name": ["in", list(sessions_by_invoice)], fields["session"]: ["is", "not set"]},
+            pluck="name",
+        )
+        table = frappe.qb.DocType(doctype)
+        for name in unlinked:
+            session = sessions_by_invoice[name]
+            query = frappe.qb.update(table).set(table.field(fields["session"]), session.id).where(table.name == name)
+            if session.get("payment_intent") and meta.has_field(fields["payment_intent"]):
+                query = query.set(table.field(fields["payment_intent"]), session.payment_intent)
+            query.run()
@@ -0,0 +1,65 @@
+import frappe
+
+from stripe_pay.methods.rate_limit import INTERACTIVE, acquire
+from stripe_pay.methods.sdk import get_stripe_module, stripe
+from stripe_pay.methods.tracing import span
+
+# (site, fieldname) -> (settings modified, password); get_cached_doc is invalidated
+# bench-wide when the settings are saved, so a changed `modified` means the password
+# must be re-read
+_passwords = {}
+_prewarmed_sites = set()
+
+
+def get_secret_key():
+    """Stripe secret key of the current site without decrypting it on every call."""
+    return get_settings_password("secret_key")
+
+
+def get_webhook_secret():
+    """Webhook signing secret, falling back to `stripe_webhook_secret` in site config."""
+    return get_settings_password("stripe_webhook_secret") or frappe.conf.get("stripe_webhook_secret")
+
+
+def get_settings_password(fieldname):
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    key = (frappe.local.site, fieldname)
+    cached = _passwords.get(key)
+    if not cached or cached[0] != settings.modified:
+        cached = _passwords[key] = (
+            settings.modified,
+            settings.get_password(fieldname, raise_exception=False),
+        )
+    return cached[1]
+
+
+def stripe_call(method, *args, priority=INTERACTIVE, **kwargs):
+    """Call a Stripe SDK method once the account's shared rate limiter allows it.
+
+    `stripe_account` in kwargs selects the connected account's bucket, everything
+    else is charged to the platform bucket.
+    """
+    acquire(kwargs.get("stripe_account"), priority=priority)
+    with span(f"stripe.{method.__qualname__}"):
+        return method(*args, **kwargs)
+
+
+def prewarm():
+    """before_request / before_job hook: load the SDK and warm Stripe caches once per site and worker."""
+    site = getattr(frappe.local, "site", None)
+    if not site or site in _prewarmed_sites:
+        return
+
+    _prewarmed_sites.add(site)
+    try:
+        if not frappe.get_cached_doc("Stripe Payment Settings").prewarm_client:
+            return
+
+        from stripe_pay.methods.accounts import get_payment_account_map
+
+        get_stripe_module()
+        stripe.api_key = get_secret_key()
+        get_payment_account_map()
+    except Exception:
+        # warming is best effort, the request itself must not fail because of it
+        frappe.log_error(frappe.get_traceback(), "Stripe Prewarm Failed")
@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+import frappe
+from frappe.utils import add_days, flt, now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.pool import run_parallel
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.stripe_pay.doctype.stripe_connected_account.stripe_connected_account import (
+    get_all_connected_accounts,
+)
+
+PAYOUT_LOOKBACK_DAYS = 14
+
+# Stripe payout status -> Stripe Transfer Details status
+PAYOUT_STATUS_MAP = {
+    "paid": "paid",
+    "pending": "pending",
+    "in_transit": "pending",
+    "canceled": "cancel",
+    "failed": "failed",
+}
+
+
+def refresh_payout_statuses():
+    """Scheduled: sync the status of recent payouts of every connected account.
+
+    Payouts are listed per account in parallel, then written back with one
+    update per status.
+    """
+    accounts = get_all_connected_accounts()
+    if not accounts:
+        return
+
+    stripe.api_key = get_secret_key()
+    since = int(add_days(now_datetime(), -PAYOUT_LOOKBACK_DAYS).timestamp())
+
+    def list_payouts(account):
+        return stripe_call(
+            stripe.Payout.list,
+            created={"gte": since},
+            limit=100,
+            stripe_account=account,
+            priority=BACKGROUND,
+        ).data
+
+    payout_ids_by_status = defaultdict(list)
+    for payouts in run_parallel(list_payouts, accounts).values():
+        for payout in payouts or []:
+            status = PAYOUT_STATUS_MAP.get(payout.status)
+            if status:
+                payout_ids_by_status[status].append(payout.id)
+
+    details = frappe.qb.DocType("Stripe Transfer Details")
+    for status, payout_ids in payout_ids_by_status.items():
+        (
+            frappe.qb.update(details)
+            .set(details.status, status)
+            .where(details.transfer_type == "Payout")
+            .where(details.reference_id.isin(payout_ids))
+            .where(details.status != status)
+            .run()
+        )
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_balances():
+    """Available and pending balance of every connected account, in major currency units."""
+    frappe.only_for("System Manager")
+    stripe.api_key = get_secret_key()
+
+    def retrieve_balance(account):
+        balance = stripe_call(stripe.Balance.retrieve, stripe_account=account)
+        return {
+            "available": sum_balance(balance.available),
+            "pending": sum_balance(balance.pending),
+        }
+
+    return run_parallel(retrieve_balance, get_all_connected_accounts())
+
+
+@frappe.whitelist()
+def list_transfers(limit=20):
+    """Most recent transfers to every connected account."""
+    frappe.only_for("System Manager")
+    stripe.api_key = get_secret_key()
+    limit = min(int(limit), 100)
+
+    def list_account_transfers(account):
+        transfers = stripe_call(stripe.Transfer.list, destination=account, limit=limit)
+        return [
+            {
+                "id": transfer.id,
+                "amount": flt(transfer.amount) / 100,
+                "currency": transfer.currency,
+                "created": transfer.created,
+                "description": transfer.description,
+            }
+            for transfer in transfers.data
+        ]
+
+    return run_parallel(list_account_transfers, get_all_connected_accounts())
+
+
+def sum_balance(funds):
+    """{currency: amount} of a Stripe balance's available/pending list."""
+    totals = defaultdict(float)
+    for fund in funds or []:
+        totals[fund.currency] += flt(fund.amount) / 100
+    return dict(totals)
@@ -0,0 +1,95 @@
+import frappe
+from frappe.utils import now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.stripe_pay.doctype.stripe_customer.stripe_customer import STRIPE_CUSTOMERS_CACHE_KEY
+
+PAGE_SIZE = 100
+
+
+@frappe.whitelist()
+def backfill_stripe_customers():
+    """Map existing Stripe customers to ERPNext Customers in the background."""
+    frappe.only_for("System Manager")
+    frappe.enqueue("stripe_pay.methods.customers.run_customer_backfill", queue="long", timeout=60 * 60)
+
+
+def run_customer_backfill():
+    """Page through all Stripe customers once and store a mapping for every one that
+    can be matched to an unmapped Customer: by the customer recorded in its metadata,
+    else by email address. Customers left unmatched are created lazily at checkout.
+    """
+    stripe.api_key = get_secret_key()
+    mapped = 0
+    starting_after = None
+
+    while True:
+        page = stripe_call(
+            stripe.Customer.list, limit=PAGE_SIZE, starting_after=starting_after, priority=BACKGROUND
+        )
+        if not page.data:
+            break
+
+        mapped += map_stripe_customers(page.data)
+        frappe.db.commit()
+
+        if not page.has_more:
+            break
+        starting_after = page.data[-1].id
+
+    # lookups made before the backfill may have cached "no mapping"
+    frappe.cache.delete_value(STRIPE_CUSTOMERS_CACHE_KEY)
+    frappe.log_error(f"Mapped {mapped} Stripe customer(s)", "Stripe Customer Backfill")
+    return mapped
+
+
+def map_stripe_customers(stripe_customers):
+    """Store the mappings one page of Stripe customers yields, in a fixed number of queries."""
+    by_customer = {}
+    by_email = {}
+    for stripe_customer in stripe_customers:
+        erpnext_customer = (stripe_customer.get("metadata") or {}).get("erpnext_customer")
+        if erpnext_customer:
+            by_customer[erpnext_customer] = stripe_customer.id
+        elif stripe_customer.get("email"):
+            by_email.setdefault(stripe_customer.email.lower(), stripe_customer.id)
+
+    customer = frappe.qb.DocType("Customer")
+    if by_email:
+        for name, email_id in (
+            frappe.qb.from_(customer)
+            .select(customer.name, customer.email_id)
+            .where(customer.email_id.isin(list(by_email)))
+            .run()
+        ):
+            by_customer.setdefault(name, by_email[email_id.lower()])
+
+    if not by_customer:
+        return 0
+
+    existing = set(
+        frappe.get_all(
+            "Stripe Customer",
+            filters={"customer": ["in", list(by_customer)]},
+            pluck="customer",
+        )
+    )
+    known_customers = set(
+        frappe.get_all("Customer", filters={"name": ["in", list(by_customer)]}, pluck="name")
+    )
+
+    now = now_datetime()
+    rows = [
+        (name, now, now, "Administrator", "Administrator", name, stripe_customer_id)
+        for name, stripe_customer_id in by_customer.items()
+        if name not in existing and name in known_customers
+    ]
+    frappe.db.bulk_insert(
+        "Stripe Customer",
+        ["name", "creation", "modified", "owner", "modified_by", "customer", "stripe_customer_id"],
+        rows,
+        ignore_duplicates=True,
+    )
+    return len(rows)
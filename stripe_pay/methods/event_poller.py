@@ -0,0 +1,131 @@
+from datetime import datetime
+
+import frappe
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.site_filter import is_foreign_event
+from stripe_pay.methods.webhook_dispatch import get_handled_event_types
+from stripe_pay.methods.webhook_queue import submit_events
+from stripe_pay.stripe_pay.doctype.stripe_processed_event.stripe_processed_event import (
+    get_processed_event_ids,
+)
+
+PAGE_SIZE = 100
+# bounds a single run; the next run continues from the saved cursor
+MAX_PAGES_PER_RUN = 50
+
+
+def poll_events():
+    """Scheduled fallback for the webhook: walk Stripe's event stream forward from a
+    persisted cursor and feed events the webhook never delivered into the same handlers.
+    """
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    if not settings.enable_event_polling:
+        return
+
+    stripe.api_key = get_secret_key()
+    if not stripe.api_key:
+        return
+
+    # read around the document cache, the cursor is written with set_single_value
+    cursor = frappe.db.get_single_value("Stripe Payment Settings", "event_poll_cursor")
+    if not cursor:
+        return catch_up_from(add_to_date(now_datetime(), hours=-(cint(settings.event_poll_lookback_hours) or 24)))
+
+    catch_up_cursor = frappe.db.get_single_value("Stripe Payment Settings", "event_poll_catch_up_cursor")
+    if catch_up_cursor:
+        catch_up_since = frappe.db.get_single_value("Stripe Payment Settings", "event_poll_catch_up_since")
+        catch_up_from(get_datetime(catch_up_since), starting_after=catch_up_cursor)
+
+    for _page in range(MAX_PAGES_PER_RUN):
+        # with ending_before Stripe returns the page just newer than the cursor,
+        # still newest first
+        page = stripe_call(
+            stripe.Event.list,
+            types=get_handled_event_types(),
+            ending_before=cursor,
+            limit=PAGE_SIZE,
+            priority=BACKGROUND,
+        )
+        if not page.data:
+            break
+
+        process_page(list(reversed(page.data)))
+        cursor = page.data[0].id
+        if not page.has_more:
+            break
+
+
+def catch_up_from(since, starting_after=None):
+    """Process the events created since `since`, up to MAX_PAGES_PER_RUN pages per run.
+
+    Stripe lists events newest first only, so a run takes the newest pages it can,
+    processes them oldest first and, on the first run, starts the forward cursor at
+    the newest event. If the lookback window holds more than that, the oldest event
+    taken is kept as the catch-up cursor and the next runs continue below it until
+    the window is exhausted; the older events then arrive after newer ones, which
+    `is_stale` already guards against.
+    """
+    events = []
+    exhausted = False
+    for _page in range(MAX_PAGES_PER_RUN):
+        page = stripe_call(
+            stripe.Event.list,
+            types=get_handled_event_types(),
+            created={"gte": int(since.timestamp())},
+            starting_after=starting_after,
+            limit=PAGE_SIZE,
+            priority=BACKGROUND,
+        )
+        events.extend(page.data)
+        if not page.has_more or not page.data:
+            exhausted = True
+            break
+        starting_after = page.data[-1].id
+
+    events.reverse()
+    for start in range(0, len(events), PAGE_SIZE):
+        process_page(events[start : start + PAGE_SIZE], advance_cursor=False)
+
+    values = {
+        "event_poll_catch_up_cursor": None if exhausted else events[0].id,
+        "event_poll_catch_up_since": None if exhausted else since,
+    }
+    if events and not frappe.db.get_single_value("Stripe Payment Settings", "event_poll_cursor"):
+        values["event_poll_cursor"] = events[-1].id
+        values["event_poll_cursor_created"] = datetime.fromtimestamp(events[-1].created)
+    frappe.db.set_single_value("Stripe Payment Settings", values)
+    frappe.db.commit()
+
+    if not exhausted:
+        frappe.log_error(
+            f"Catch-up stopped after {MAX_PAGES_PER_RUN} pages at event {events[0].id}; "
+            f"the next run continues with the older events since {since}",
+            "Stripe Event Poller",
+        )
+
+
+def process_page(events, advance_cursor=True):
+    """Handle one oldest-first batch of events, skip those already processed and advance the cursor."""
+    processed = get_processed_event_ids([event.id for event in events])
+    missed = [event for event in events if event.id not in processed and not is_foreign_event(event)]
+
+    submit_events(missed, "Poller")
+    if advance_cursor:
+        frappe.db.set_single_value(
+            "Stripe Payment Settings",
+            {
+                "event_poll_cursor": events[-1].id,
+                "event_poll_cursor_created": datetime.fromtimestamp(events[-1].created),
+            },
+        )
+    frappe.db.commit()
+
+    if missed:
+        frappe.log_error(
+            f"Processed {len(missed)} missed event(s): {', '.join(event.id for event in missed)}",
+            "Stripe Event Poller"
+        )
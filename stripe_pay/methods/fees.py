@@ -0,0 +1,237 @@
+"""Post the Stripe fees of paid payments to the ledger in hourly batches.
+
+The callbacks post a Payment Entry for the full amount as soon as the customer
+pays, before Stripe has settled the charge and without asking it about fees.
+This job picks up the Stripe Payments ledger rows paid in the last
+FEE_LOOKBACK_DAYS whose fee is not yet recorded, gets their balance transactions
+with one listing of charges expanded to them, and books each company's fees as
+one Journal Entry per batch: fee account debited, Stripe account credited. The
+ledger rows keep the fee, the net amount and the Journal Entry. Rows whose fee
+cannot be captured, for want of a company or a balance transaction, are marked
+with the reason so later runs do not list charges back to them again.
+"""
+
+from collections import defaultdict
+
+import frappe
+from frappe.utils import add_days, flt, now_datetime, nowdate
+
+from stripe_pay.methods.accounts import get_payment_accounts
+from stripe_pay.methods.allocation import get_collective_invoice_companies
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import PAID, REFUNDED
+
+LEDGER = "Stripe Payments"
+PAGE_SIZE = 100
+FEE_BATCH_SIZE = 100
+# payments whose charge has no balance transaction by then are left alone
+FEE_LOOKBACK_DAYS = 30
+# a charge still without a balance transaction this long after it was made never gets one
+FEE_GRACE_DAYS = 2
+
+
+def capture_stripe_fees():
+    """Scheduled: record and post the fees of recently paid payments."""
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    if not settings.enable_fee_capture:
+        return
+
+    stripe.api_key = get_secret_key()
+    payments = get_uncaptured_payments()
+    if not payments:
+        return
+
+    fee_accounts = {row.company: row for row in settings.fee_accounts}
+    companies = get_payment_companies(payments)
+    mark_uncapturable([row for row in payments if not companies.get(row.name)], "No company for the paid document")
+
+    unconfigured = {companies[row.name] for row in payments if companies.get(row.name)} - set(fee_accounts)
+    for company in unconfigured:
+        frappe.log_error(f"No Stripe fee account set for company {company}", "Stripe Fee Capture")
+
+    # only payments that can be posted decide how far back the charges are listed
+    payments = [row for row in payments if companies.get(row.name) in fee_accounts]
+    if not payments:
+        frappe.db.commit()
+        return
+
+    balance_transactions = get_balance_transactions(
+        {row.payment_intent_id for row in payments}, min(row.stripe_created or row.paid_at for row in payments)
+    )
+    grace_cutoff = add_days(now_datetime(), -FEE_GRACE_DAYS)
+    mark_uncapturable(
+        [
+            row
+            for row in payments
+            if row.payment_intent_id not in balance_transactions and (row.stripe_created or row.paid_at) < grace_cutoff
+        ],
+        "No balance transaction in Stripe",
+    )
+    frappe.db.commit()
+
+    by_company = defaultdict(list)
+    for row in payments:
+        if row.payment_intent_id in balance_transactions:
+            by_company[companies[row.name]].append(row)
+
+    for company, rows in by_company.items():
+        for start in range(0, len(rows), FEE_BATCH_SIZE):
+            try:
+                post_fees(company, rows[start : start + FEE_BATCH_SIZE], balance_transactions, fee_accounts[company])
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"Stripe Fee Capture Failed for {company}")
+
+
+def get_uncaptured_payments():
+    return frappe.get_all(
+        LEDGER,
+        filters={
+            "status": ["in", [PAID, REFUNDED]],
+            "payment_intent_id": ["is", "set"],
+            "balance_transaction_id": ["is", "not set"],
+            "fee_capture_error": ["is", "not set"],
+            "paid_at": [">=", add_days(nowdate(), -FEE_LOOKBACK_DAYS)],
+        },
+        fields=["name", "payment_intent_id", "reference_doctype", "reference_name", "stripe_created", "paid_at"],
+    )
+
+
+def mark_uncapturable(rows, error):
+    """Record why the fees of `rows` cannot be captured, so later runs stop listing charges back to them."""
+    if not rows:
+        return
+
+    ledger = frappe.qb.DocType(LEDGER)
+    frappe.qb.update(ledger).set(ledger.fee_capture_error, error).where(
+        ledger.name.isin([row.name for row in rows])
+    ).run()
+    frappe.log_error(
+        f"Stripe fees not captured ({error}): " + ", ".join(row.payment_intent_id for row in rows),
+        "Stripe Fee Capture",
+    )
+
+
+def get_balance_transactions(payment_intent_ids, since):
+    """{payment intent id: balance transaction} from a listing of the charges created since `since`.
+
+    Charges that have no balance transaction yet are left out.
+    """
+    balance_transactions = {}
+    starting_after = None
+    while True:
+        page = stripe_call(
+            stripe.Charge.list,
+            created={"gte": int(since.timestamp())},
+            expand=["data.balance_transaction"],
+            starting_after=starting_after,
+            limit=PAGE_SIZE,
+            priority=BACKGROUND,
+        )
+        for charge in page.data:
+            balance_transaction = charge.get("balance_transaction")
+            # unexpanded, i.e. a plain id, only if Stripe has not created it yet
+            if charge.get("payment_intent") in payment_intent_ids and balance_transaction and not isinstance(
+                balance_transaction, str
+            ):
+                balance_transactions[charge.payment_intent] = balance_transaction
+
+        if not page.has_more or not page.data or len(balance_transactions) == len(payment_intent_ids):
+            return balance_transactions
+        starting_after = page.data[-1].id
+
+
+def get_payment_companies(payments):
+    """{ledger row name: company}, from the invoice each payment is for."""
+    names_by_doctype = defaultdict(set)
+    for row in payments:
+        if row.reference_doctype and row.reference_name:
+            names_by_doctype[row.reference_doctype].add(row.reference_name)
+
+    invoice_companies = {}
+    if names_by_doctype.get("Sales Invoice"):
+        for name, company in frappe.get_all(
+            "Sales Invoice",
+            filters={"name": ["in", list(names_by_doctype["Sales Invoice"])]},
+            fields=["name", "company"],
+            as_list=True,
+        ):
+            invoice_companies["Sales Invoice", name] = company
+
+    for name, company in get_collective_invoice_companies(names_by_doctype.get("Collective Invoices")).items():
+        invoice_companies["Collective Invoices", name] = company
+
+    return {row.name: invoice_companies.get((row.reference_doctype, row.reference_name)) for row in payments}
+
+
+def post_fees(company, rows, balance_transactions, fee_account):
+    """Book the fees of one company's batch in one Journal Entry and record them on the ledger."""
+    company_currency = frappe.get_cached_value("Company", company, "default_currency")
+    captured, foreign = [], []
+    for row in rows:
+        balance_transaction = balance_transactions[row.payment_intent_id]
+        if balance_transaction.currency.upper() == company_currency.upper():
+            captured.append((row, balance_transaction))
+        else:
+            foreign.append((row, balance_transaction))
+
+    total_fee = sum(balance_transaction.fee for _row, balance_transaction in captured)
+    journal_entry = make_fee_journal_entry(company, fee_account, total_fee, captured) if total_fee else None
+    if foreign:
+        # recorded on the ledger below, but left to be booked by hand
+        frappe.log_error(
+            f"Stripe fees of {company} not in {company_currency}, not posted: "
+            + ", ".join(
+                f"{row.payment_intent_id} ({balance_transaction.fee} {balance_transaction.currency.upper()})"
+                for row, balance_transaction in foreign
+            ),
+            "Stripe Fee Capture",
+        )
+
+    ledger = frappe.qb.DocType(LEDGER)
+    for batch, batch_journal_entry in ((captured, journal_entry), (foreign, None)):
+        for row, balance_transaction in batch:
+            (
+                frappe.qb.update(ledger)
+                .set(ledger.fee, balance_transaction.fee)
+                .set(ledger.net, balance_transaction.net)
+                .set(ledger.balance_transaction_id, balance_transaction.id)
+                .set(ledger.fee_journal_entry, batch_journal_entry)
+                .where(ledger.name == row.name)
+                .run()
+            )
+
+
+def make_fee_journal_entry(company, fee_account, total_fee, captured):
+    stripe_account = get_payment_accounts(company).paid_to
+    if not stripe_account:
+        frappe.throw(f"No Stripe or Cash Mode of Payment account for company {company}")
+
+    amount = flt(total_fee / 100, 2)
+    journal_entry = frappe.get_doc(
+        {
+            "doctype": "Journal Entry",
+            "voucher_type": "Journal Entry",
+            "company": company,
+            "posting_date": nowdate(),
+            "user_remark": "Stripe fees for payments "
+            + ", ".join(row.payment_intent_id for row, balance_transaction in captured if balance_transaction.fee),
+            "accounts": [
+                {
+                    "account": fee_account.fee_account,
+                    "cost_center": fee_account.cost_center,
+                    "debit_in_account_currency": amount,
+                },
+                {
+                    "account": stripe_account,
+                    "credit_in_account_currency": amount,
+                },
+            ],
+        }
+    )
+    journal_entry.insert(ignore_permissions=True)
+    journal_entry.submit()
+    return journal_entry.name
@@ -0,0 +1,173 @@
+"""Background submission of Stripe Payment Entries.
+
+With `defer_payment_entry_submit` set, the checkout callbacks and direct payments
+insert their Payment Entries as drafts and queue them here, so the GL posting of
+`submit()` runs in a worker instead of the request the customer is waiting on.
+Each company's queue is drained by its own job; every submission is its own
+transaction, so a lock timeout or deadlock only reschedules that one entry.
+"""
+
+import frappe
+from frappe.query_builder.functions import Count, Min
+from frappe.utils import cint, now_datetime
+
+from stripe_pay.methods.retry import get_next_retry_at
+
+SUBMISSION = "Stripe Payment Entry Submission"
+QUEUED = "Queued"
+SUBMITTED = "Submitted"
+FAILED = "Failed"
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 30
+
+# lock contention on the ledger tables; anything else will fail the same way again
+LOCK_ERRORS = (frappe.QueryTimeoutError, frappe.QueryDeadlockError)
+
+
+def submit_payment_entry(payment_entry):
+    """Submit an inserted Payment Entry now, or queue the draft for the background submitter."""
+    if not frappe.get_cached_doc("Stripe Payment Settings").defer_payment_entry_submit:
+        payment_entry.submit()
+        return
+
+    frappe.get_doc(
+        {
+            "doctype": SUBMISSION,
+            "payment_entry": payment_entry.name,
+            "company": payment_entry.company,
+            "status": QUEUED,
+            "next_retry_at": now_datetime(),
+        }
+    ).insert(ignore_permissions=True)
+    enqueue_submitter(payment_entry.company)
+
+
+def enqueue_submitter(company):
+    frappe.enqueue(
+        "stripe_pay.methods.payment_entries.submit_company_payment_entries",
+        queue="long",
+        job_id=f"stripe_payment_entry_submitter::{company}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        company=company,
+    )
+
+
+def submit_queued_payment_entries():
+    """Scheduled: start a submitter for every company with due drafts.
+
+    Picks up retries that have come due and anything queued while a company's
+    submitter was already running.
+    """
+    for company in frappe.get_all(
+        SUBMISSION,
+        filters={"status": QUEUED, "next_retry_at": ["<=", now_datetime()]},
+        distinct=True,
+        pluck="company",
+    ):
+        enqueue_submitter(company)
+
+
+def submit_company_payment_entries(company):
+    """Submit a company's due drafts in batches until none are left."""
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    batch_size = cint(settings.payment_entry_submit_batch_size) or DEFAULT_BATCH_SIZE
+    max_attempts = cint(settings.payment_entry_submit_max_attempts) or DEFAULT_MAX_ATTEMPTS
+
+    submitted = 0
+    while True:
+        batch = frappe.get_all(
+            SUBMISSION,
+            filters={"status": QUEUED, "company": company, "next_retry_at": ["<=", now_datetime()]},
+            fields=["name", "payment_entry", "attempts"],
+            order_by="next_retry_at asc",
+            limit=batch_size,
+        )
+        # every submission leaves the due set, as submitted, failed or rescheduled
+        for submission in batch:
+            submitted += submit_queued(submission, max_attempts)
+            frappe.db.commit()
+
+        if len(batch) < batch_size:
+            return submitted
+
+
+def submit_queued(submission, max_attempts):
+    attempts = cint(submission.attempts) + 1
+    try:
+        payment_entry = frappe.get_doc("Payment Entry", submission.payment_entry)
+        if payment_entry.docstatus == 0:
+            # the job runs as whoever queued it, often Guest in the success callbacks;
+            # the entry was inserted with ignore_permissions and is submitted the same way
+            payment_entry.flags.ignore_permissions = True
+            payment_entry.submit()
+    except LOCK_ERRORS:
+        # a deadlock has already rolled back the whole transaction, a lock timeout only the statement
+        frappe.db.rollback()
+        retry = attempts < max_attempts
+        set_submission(
+            submission.name,
+            status=QUEUED if retry else FAILED,
+            attempts=attempts,
+            next_retry_at=get_next_retry_at(attempts, RETRY_BASE_DELAY) if retry else None,
+            error=frappe.get_traceback(),
+        )
+        return 0
+    except Exception:
+        frappe.db.rollback()
+        set_submission(submission.name, status=FAILED, attempts=attempts, next_retry_at=None, error=frappe.get_traceback())
+        return 0
+
+    set_submission(submission.name, status=SUBMITTED, attempts=attempts, submitted_at=now_datetime(), error=None)
+    return 1
+
+
+def set_submission(name, **values):
+    frappe.db.set_value(SUBMISSION, name, values, update_modified=False)
+
+
+@frappe.whitelist()
+def get_submission_status():
+    """Submission counts per company and status, with the oldest entry of each."""
+    frappe.only_for(["System Manager", "Accounts Manager"])
+    submission = frappe.qb.DocType(SUBMISSION)
+    return (
+        frappe.qb.from_(submission)
+        .select(
+            submission.company,
+            submission.status,
+            Count(submission.name).as_("count"),
+            Min(submission.creation).as_("oldest"),
+        )
+        .groupby(submission.company, submission.status)
+        .orderby(submission.company)
+        .run(as_dict=True)
+    )
+
+
+@frappe.whitelist()
+def requeue_failed_payment_entries(company=None):
+    """Put failed submissions back in the queue, e.g. after fixing the cause, and start the submitters."""
+    frappe.only_for(["System Manager", "Accounts Manager"])
+    filters = {"status": FAILED}
+    if company:
+        filters["company"] = company
+
+    failed = frappe.get_all(SUBMISSION, filters=filters, fields=["name", "company"])
+    if not failed:
+        return {"requeued": 0}
+
+    submission = frappe.qb.DocType(SUBMISSION)
+    (
+        frappe.qb.update(submission)
+        .set(submission.status, QUEUED)
+        .set(submission.attempts, 0)
+        .set(submission.next_retry_at, now_datetime())
+        .where(submission.name.isin([row.name for row in failed]))
+        .run()
+    )
+    for company in {row.company for row in failed}:
+        enqueue_submitter(company)
+    return {"requeued": len(failed)}
@@ -0,0 +1,205 @@
+import hashlib
+
+import frappe
+from frappe import _
+from frappe.query_builder.functions import Count, Sum
+from frappe.utils import add_to_date, flt, get_datetime, now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.retry import is_transient_stripe_error
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.tracing import traced
+from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+from stripe_pay.stripe_pay.doctype.stripe_connected_account.stripe_connected_account import (
+    get_connected_account,
+)
+from stripe_pay.stripe_pay.doctype.stripe_transfer_retry.stripe_transfer_retry import (
+    PAYOUT,
+    TRANSFER,
+    new_idempotency_key,
+    queue_transfer_retry,
+)
+
+PER_INVOICE = "Per Invoice"
+BATCHED = "Batched"
+
+SCHEDULE_INTERVALS = {"Hourly": {"hours": 1}, "Daily": {"days": 1}}
+
+
+@traced("transfer.payout")
+def transfer_and_payout(amount, reference_doc, reference_name, label, company=None, customer=None):
+    """Transfer an invoice's amount (in cents) to its connected account and pay it out.
+
+    The destination is resolved from the Stripe Connected Account registry by
+    customer, then company, falling back to the default account.
+
+    With payout batching enabled only the transfer is made here; it is logged with
+    payout status Pending and picked up by `create_batched_payouts`. Returns the
+    transfer id and the payout id (None when batched).
+
+    A transfer or payout that fails for a transient reason is queued as a Stripe
+    Transfer Retry under the idempotency key of the failed attempt instead of
+    failing the payment. For a queued transfer both ids are None: the caller posts
+    no Payment Entry, the retry posts it, and the payout, once the transfer goes
+    through; see `retry_failed_transfers`.
+    """
+    batched = frappe.get_cached_doc("Stripe Payment Settings").payout_mode == BATCHED
+    account = get_connected_account(company=company, customer=customer)
+    if not account:
+        frappe.throw(_("No Stripe Connected Account is configured for {0} {1}").format(_(label), reference_name))
+
+    transfer_request = {
+        "amount": amount,
+        "currency": "usd",
+        "destination": account,
+        "description": f"Transfer for {label} {reference_name}",
+    }
+    payout_request = {
+        "amount": amount,
+        "currency": "usd",
+        "description": f"Payout for {label} {reference_name}",
+        "stripe_account": account,
+    }
+
+    idempotency_key = new_idempotency_key(TRANSFER)
+    try:
+        transfer = stripe_call(stripe.Transfer.create, idempotency_key=idempotency_key, **transfer_request)
+    except Exception as e:
+        create_stripe_transfer_log(
+            "N/A", "failed", reference_doc, reference_name,
+            transfer_type="Transfer", account=account, company=company,
+        )
+        retry = queue_transfer_retry(
+            TRANSFER, transfer_request, reference_doc, reference_name, company=company,
+            idempotency_key=idempotency_key, exc=e, payout_request=None if batched else payout_request,
+            hold_payment_entry=True,
+        )
+        if not is_transient_stripe_error(e):
+            frappe.throw(f"Stripe Transfer failed: {e}")
+        frappe.msgprint(
+            f"Stripe Transfer failed ({e}); it will be retried in the background as {retry}, "
+            "and the Payment Entry posted once it goes through."
+        )
+        return None, None
+
+    transfer_id = transfer.id
+    frappe.msgprint(f"Transfer successful! Transfer ID: {transfer_id}")
+    create_stripe_transfer_log(
+        transfer_id, "paid", reference_doc, reference_name,
+        transfer_type="Transfer", amount=flt(amount) / 100,
+        payout_status="Pending" if batched else None, account=account, company=company,
+    )
+
+    if batched:
+        frappe.msgprint("Payout will be included in the next batched payout.")
+        return transfer_id, None
+
+    idempotency_key = new_idempotency_key(PAYOUT)
+    try:
+        payout = stripe_call(stripe.Payout.create, idempotency_key=idempotency_key, **payout_request)
+    except Exception as e:
+        create_stripe_transfer_log(
+            "N/A", "failed", reference_doc, reference_name,
+            transfer_type="Payout", account=account, company=company,
+        )
+        retry = queue_transfer_retry(
+            PAYOUT, payout_request, reference_doc, reference_name, company=company,
+            idempotency_key=idempotency_key, exc=e,
+        )
+        if not is_transient_stripe_error(e):
+            frappe.throw(f"Stripe Payout failed: {e}")
+        frappe.msgprint(f"Stripe Payout failed ({e}); it will be retried in the background as {retry}.")
+        return transfer_id, None
+
+    payout_id = payout.id
+    frappe.msgprint(f"Payout initiated! Payout ID: {payout_id}")
+    create_stripe_transfer_log(
+        payout_id, "paid", reference_doc, reference_name,
+        transfer_type="Payout", amount=flt(amount) / 100, account=account, company=company,
+    )
+    return transfer_id, payout_id
+
+
+def create_batched_payouts():
+    """Scheduled: aggregate pending transfers into one payout per connected account.
+
+    Runs when the configured window (hourly/daily) has elapsed since the last batch,
+    or earlier for accounts whose pending amount reached the threshold.
+    """
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    if settings.payout_mode != BATCHED:
+        return
+
+    interval = SCHEDULE_INTERVALS.get(settings.payout_schedule, SCHEDULE_INTERVALS["Daily"])
+    last_batch_at = frappe.db.get_single_value("Stripe Payment Settings", "last_payout_batch_at")
+    window_due = not last_batch_at or add_to_date(get_datetime(last_batch_at), **interval) <= now_datetime()
+    threshold = flt(settings.payout_threshold)
+
+    stripe.api_key = get_secret_key()
+
+    details = frappe.qb.DocType("Stripe Transfer Details")
+    pending = (
+        frappe.qb.from_(details)
+        .select(details.account, Sum(details.amount).as_("amount"), Count(details.name).as_("transfers"))
+        .where(details.transfer_type == "Transfer")
+        .where(details.status == "paid")
+        .where(details.payout_status == "Pending")
+        .groupby(details.account)
+        .run(as_dict=True)
+    )
+
+    for row in pending:
+        if not window_due and not (threshold and flt(row.amount) >= threshold):
+            continue
+
+        try:
+            create_account_payout(row.account)
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), f"Stripe Batched Payout Failed for {row.account}")
+
+    if window_due:
+        frappe.db.set_single_value("Stripe Payment Settings", "last_payout_batch_at", now_datetime())
+        frappe.db.commit()
+
+
+def create_account_payout(account):
+    """Pay out all pending transfers of one connected account and link them to the payout."""
+    transfers = frappe.get_all(
+        "Stripe Transfer Details",
+        filters={"account": account, "transfer_type": "Transfer", "status": "paid", "payout_status": "Pending"},
+        fields=["name", "amount"],
+        order_by="name asc",
+    )
+    names = [transfer.name for transfer in transfers]
+    amount = round(sum(flt(transfer.amount) for transfer in transfers) * 100)
+    if not amount:
+        return
+
+    # the same set of transfers always yields the same key, so a rerun after a
+    # failure between the payout and the update below cannot pay out twice
+    idempotency_key = "stripe-pay-payout-" + hashlib.sha256(",".join(names).encode()).hexdigest()[:32]
+    payout = stripe_call(
+        stripe.Payout.create,
+        amount=amount,
+        currency="usd",
+        description=f"Batched payout for {len(names)} transfers",
+        stripe_account=account,
+        idempotency_key=idempotency_key,
+        priority=BACKGROUND,
+    )
+
+    details = frappe.qb.DocType("Stripe Transfer Details")
+    (
+        frappe.qb.update(details)
+        .set(details.payout_id, payout.id)
+        .set(details.payout_status, "Paid Out")
+        .where(details.name.isin(names))
+        .run()
+    )
+    create_stripe_transfer_log(
+        payout.id, "paid", None, None,
+        transfer_type="Payout", amount=amount / 100, account=account,
+    )
+    return payout.id
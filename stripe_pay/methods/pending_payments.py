@@ -0,0 +1,181 @@
+"""Bank debits that are waiting to settle.
+
+A checkout paid by US bank account completes with `payment_status` "unpaid" and
+only settles days later with `checkout.session.async_payment_succeeded` or
+`_failed`. The Stripe Payments ledger holds such a payment as Processing from the
+completed checkout until one of those events moves it on, together with the date
+it should have settled by. Everything here reads the Processing rows through the
+(status, expected_settlement_date) index, so neither the float nor the stale check
+ever scans invoices or settled payments.
+"""
+
+import time
+
+import frappe
+from frappe.utils import add_to_date, date_diff, flt, getdate, now_datetime, nowdate
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.pool import run_parallel
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.replica import read_from_replica
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.webhook_queue import apply_events
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import PROCESSING
+
+LEDGER = "Stripe Payments"
+# Stripe Processed Event source of the events this check applies
+PENDING_CHECK = "Pending Check"
+CHECK_BATCH_SIZE = 100
+# an overdue payment is looked up in Stripe at most this often
+RECHECK_HOURS = 6
+# (label, upper bound in days pending, inclusive)
+AGING_BUCKETS = (("0-2 days", 2), ("3-5 days", 5), ("6-10 days", 10), ("Over 10 days", None))
+# payment intent statuses that end a bank debit without it settling
+FAILED_INTENT_STATUSES = ("requires_payment_method", "canceled")
+
+
+def check_pending_payments():
+    """Scheduled: look up overdue pending payments in Stripe and apply those that ended.
+
+    Only payments past their expected settlement date and not checked in the last
+    RECHECK_HOURS are fetched, a batch at a time. A payment that settled or failed
+    without its event reaching us goes through the same handlers as the webhook
+    would have, see `apply_session`; one still processing is left for the next check.
+    """
+    stripe.api_key = get_secret_key()
+    ledger = frappe.qb.DocType(LEDGER)
+    checked = []
+
+    while True:
+        recheck_before = add_to_date(now_datetime(), hours=-RECHECK_HOURS)
+        query = (
+            frappe.qb.from_(ledger)
+            .select(ledger.name)
+            .where(ledger.status == PROCESSING)
+            .where(ledger.expected_settlement_date < nowdate())
+            .where(ledger.last_checked_at.isnull() | (ledger.last_checked_at < recheck_before))
+            .orderby(ledger.expected_settlement_date)
+            .limit(CHECK_BATCH_SIZE)
+        )
+        if checked:
+            # rows whose lookup failed keep an old last_checked_at; don't pick them up again this run
+            query = query.where(ledger.name.notin(checked))
+        batch = query.run(pluck=True)
+        if not batch:
+            return
+
+        sessions = run_parallel(retrieve_session, batch)
+        for session_id in batch:
+            if sessions.get(session_id):
+                apply_session(sessions[session_id])
+            frappe.db.commit()
+        checked.extend(batch)
+
+        if len(batch) < CHECK_BATCH_SIZE:
+            return
+
+
+def retrieve_session(session_id):
+    return stripe_call(
+        stripe.checkout.Session.retrieve, session_id, expand=["payment_intent"], priority=BACKGROUND
+    )
+
+
+def apply_session(session):
+    payment_intent = session.get("payment_intent")
+    intent_status = payment_intent.get("status") if payment_intent else None
+    if session.get("payment_status") == "paid":
+        event_type = "checkout.session.async_payment_succeeded"
+    elif intent_status in FAILED_INTENT_STATUSES:
+        event_type = "checkout.session.async_payment_failed"
+    else:
+        frappe.db.set_value(LEDGER, session["id"], "last_checked_at", now_datetime(), update_modified=False)
+        return
+
+    # handlers expect the id, as sent in the event, not the expanded intent
+    session["payment_intent"] = payment_intent["id"] if payment_intent else None
+    # Applied and marked processed like the event it stands in for. Its target and
+    # creation time make the real event stale when it turns up later, so the
+    # handlers, and the additive payment summary, do not run twice.
+    apply_events(
+        [
+            {
+                "id": f"{event_type}:{session['id']}",
+                "object": "event",
+                "type": event_type,
+                "created": int(time.time()),
+                "data": {"object": session},
+            }
+        ],
+        PENDING_CHECK,
+    )
+    frappe.db.set_value(LEDGER, session["id"], "last_checked_at", now_datetime(), update_modified=False)
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_pending_float():
+    """Amount (in cents) of bank debits waiting to settle per currency, with their aging.
+
+    Each currency has its total, the overdue part, and count and amount per
+    AGING_BUCKETS bucket by days since the checkout completed.
+    """
+    frappe.has_permission(LEDGER, throw=True)
+
+    today = getdate()
+    float_by_currency = {}
+    for row in get_pending_payments():
+        currency = float_by_currency.setdefault(
+            row.currency,
+            {
+                "currency": row.currency,
+                "count": 0,
+                "amount": 0,
+                "overdue_count": 0,
+                "overdue_amount": 0,
+                "aging": {label: {"count": 0, "amount": 0} for label, _days in AGING_BUCKETS},
+            },
+        )
+        amount = flt(row.amount)
+        currency["count"] += 1
+        currency["amount"] += amount
+        if row.expected_settlement_date and getdate(row.expected_settlement_date) < today:
+            currency["overdue_count"] += 1
+            currency["overdue_amount"] += amount
+
+        bucket = currency["aging"][get_aging_bucket(date_diff(today, row.processing_since or row.stripe_created or today))]
+        bucket["count"] += 1
+        bucket["amount"] += amount
+
+    return list(float_by_currency.values())
+
+
+@frappe.whitelist()
+@read_from_replica
+def get_overdue_payments(limit=100):
+    """Pending payments past their expected settlement date, longest overdue first."""
+    frappe.has_permission(LEDGER, throw=True)
+    return frappe.get_all(
+        LEDGER,
+        filters={"status": PROCESSING, "expected_settlement_date": ["<", nowdate()]},
+        fields=[
+            "session_id", "payment_intent_id", "amount", "currency", "reference_doctype", "reference_name",
+            "processing_since", "expected_settlement_date", "last_checked_at",
+        ],
+        order_by="expected_settlement_date asc",
+        limit=limit,
+    )
+
+
+def get_pending_payments():
+    return frappe.get_all(
+        LEDGER,
+        filters={"status": PROCESSING},
+        fields=["amount", "currency", "processing_since", "stripe_created", "expected_settlement_date"],
+    )
+
+
+def get_aging_bucket(days):
+    for label, max_days in AGING_BUCKETS:
+        if max_days is None or days <= max_days:
+            return label
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import cint
+
+DEFAULT_WORKERS = 8
+
+
+def run_parallel(fn, items, max_workers=None):
+    """Run `fn(item)` for every item on a bounded thread pool and return {item: result}.
+
+    Meant for Stripe calls that span connected accounts, which spend their time
+    waiting on the network. Every task gets its own site context (frappe.local is
+    per thread), so `fn` can use the rate limiter and settings. Writes are best left
+    to the caller; a task that writes anyway must only touch rows of its own item.
+    A failing item is logged and maps to None.
+    """
+    items = list(dict.fromkeys(items))
+    if not items:
+        return {}
+
+    max_workers = min(len(items), max_workers or get_fan_out_workers())
+    site, user = frappe.local.site, frappe.session.user
+
+    if max_workers <= 1:
+        return {item: call_safely(fn, item) for item in items}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe-fan-out") as executor:
+        futures = {item: executor.submit(run_in_site, site, user, fn, item) for item in items}
+        return {item: future.result() for item, future in futures.items()}
+
+
+def get_fan_out_workers():
+    return cint(frappe.get_cached_doc("Stripe Payment Settings").fan_out_workers) or DEFAULT_WORKERS
+
+
+def run_in_site(site, user, fn, item):
+    frappe.init(site=site)
+    try:
+        frappe.connect()
+        frappe.set_user(user)
+        result = call_safely(fn, item)
+        frappe.db.commit()  # keep any error log written by the task
+        return result
+    finally:
+        frappe.destroy()
+
+
+def call_safely(fn, item):
+    try:
+        return fn(item)
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), f"Stripe Fan-out Failed for {item}")
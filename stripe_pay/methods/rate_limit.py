@@ -0,0 +1,98 @@
+import hashlib
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+from redis.exceptions import RedisError
+
+from stripe_pay.methods.sdk import stripe
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+DEFAULT_RATE = 25
+DEFAULT_INTERACTIVE_RESERVE = 20
+DEFAULT_MAX_WAIT = {INTERACTIVE: 10, BACKGROUND: 120}
+
+# Refill the bucket for the time elapsed since the last take, then take one token
+# only if that leaves at least `floor` tokens behind. Returns "0" when a token was
+# taken, otherwise the seconds to wait before one is available.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens - 1 >= floor then
+    tokens = tokens - 1
+else
+    wait = (floor + 1 - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+_token_bucket = None
+
+
+def acquire(stripe_account=None, priority=INTERACTIVE):
+    """Block until the shared token bucket of a Stripe account grants one request.
+
+    Buckets live in Redis so every web and background worker on the bench draws from
+    the same budget. Background callers may not dip into the share of the bucket
+    reserved for interactive requests, so checkout creation keeps flowing while
+    sweeps and backfills wait.
+    """
+    settings = frappe.get_cached_doc("Stripe Payment Settings")
+    rate = flt(settings.rate_limit_per_second) or DEFAULT_RATE
+    capacity = max(flt(settings.rate_limit_burst) or rate, 1)
+    floor = 0
+    if priority == BACKGROUND:
+        reserve = flt(settings.interactive_reserve_percent) or DEFAULT_INTERACTIVE_RESERVE
+        floor = capacity * reserve / 100
+
+    max_wait = DEFAULT_MAX_WAIT.get(priority, DEFAULT_MAX_WAIT[INTERACTIVE])
+    key = frappe.cache.make_key(f"stripe_pay:rate_limit:{get_bucket_name(stripe_account)}", shared=True)
+    started = time.monotonic()
+
+    while True:
+        try:
+            wait = flt(get_token_bucket()(keys=[key], args=[capacity, rate, time.time(), floor]))
+        except RedisError:
+            # never block payments because the limiter itself is unavailable
+            return
+
+        if wait <= 0:
+            return
+
+        if time.monotonic() - started + wait > max_wait:
+            frappe.throw(
+                _("Stripe request rate limit reached, please try again shortly."),
+                frappe.RateLimitExceededError,
+            )
+
+        time.sleep(wait)
+
+
+def get_bucket_name(stripe_account=None):
+    """Connected accounts get their own bucket; platform calls are keyed by the secret key."""
+    if stripe_account:
+        return stripe_account
+
+    return "platform:" + hashlib.sha256((stripe.api_key or "").encode()).hexdigest()[:16]
+
+
+def get_token_bucket():
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = frappe.cache.register_script(TOKEN_BUCKET_SCRIPT)
+    return _token_bucket
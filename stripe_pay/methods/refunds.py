@@ -0,0 +1,282 @@
+import frappe
+from frappe import _
+from frappe.utils import flt, nowdate
+
+from stripe_pay.methods.accounts import get_payment_accounts
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.pool import run_parallel
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import REFUNDED, set_payment_status
+
+# invoices refunded in parallel and then booked in one transaction
+REFUND_BATCH_SIZE = 50
+PROGRESS_EVENT = "stripe_bulk_refund_progress"
+
+# Stripe refund status -> Stripe Transfer Details status; bank account refunds
+# stay pending for days and can still fail
+REFUND_LOG_STATUS = {
+    "succeeded": "paid",
+    "pending": "pending",
+    "requires_action": "pending",
+    "failed": "failed",
+    "canceled": "cancel",
+}
+
+# where each refundable doctype stores its Stripe references
+INVOICE_FIELDS = {
+    "Sales Invoice": {"payment_intent": "stripe_payment_intent_id", "session": "stripe_session_id"},
+    "Collective Invoices": {"payment_intent": "custom_stripe_payment_intent_id", "session": "custom_stripe_session_id"},
+}
+
+
+@frappe.whitelist()
+def bulk_refund(invoices, reference_doctype="Sales Invoice", reason=None):
+    """Refund the Stripe payments of many invoices in the background.
+
+    Progress is published per invoice to the calling user as the realtime event
+    `stripe_bulk_refund_progress`. Returns the background job id.
+    """
+    frappe.only_for(("System Manager", "Accounts Manager"))
+
+    if reference_doctype not in INVOICE_FIELDS:
+        frappe.throw(_("Refunds are not supported for {0}").format(reference_doctype))
+
+    invoices = frappe.parse_json(invoices) if isinstance(invoices, str) else invoices
+    if not invoices:
+        frappe.throw(_("Select at least one invoice to refund"))
+
+    job = frappe.enqueue(
+        "stripe_pay.methods.refunds.run_bulk_refund",
+        queue="long",
+        timeout=60 * 60,
+        invoices=list(dict.fromkeys(invoices)),
+        reference_doctype=reference_doctype,
+        reason=reason,
+    )
+    return job.id if job else None
+
+
+def run_bulk_refund(invoices, reference_doctype, reason=None):
+    stripe.api_key = get_secret_key()
+    refundable = get_refundable_invoices(invoices, reference_doctype)
+
+    total = len(invoices)
+    done = 0
+    for name in invoices:
+        if name not in refundable:
+            done += 1
+            publish_progress(name, "skipped", done, total, error=_("No Stripe payment to refund"))
+
+    pending = list(refundable.values())
+    for start in range(0, len(pending), REFUND_BATCH_SIZE):
+        batch = pending[start : start + REFUND_BATCH_SIZE]
+        results = run_parallel(lambda name: create_refund(refundable[name], reason), [invoice.name for invoice in batch])
+
+        for invoice in batch:
+            done += 1
+            result = results.get(invoice.name) or {"error": _("Refund failed, see the Error Log")}
+            if result.get("error"):
+                create_stripe_transfer_log(
+                    invoice.payment_intent or "N/A", "failed", reference_doctype, invoice.name,
+                    transfer_type="Refund", company=invoice.company, commit=False,
+                )
+                publish_progress(invoice.name, "failed", done, total, error=result["error"])
+                continue
+
+            log_status = REFUND_LOG_STATUS.get(result["status"], "pending")
+            create_stripe_transfer_log(
+                result["refund_id"], log_status, reference_doctype, invoice.name,
+                transfer_type="Refund", amount=result["amount"], company=invoice.company, commit=False,
+            )
+            if log_status in ("failed", "cancel"):
+                publish_progress(
+                    invoice.name, "failed", done, total, refund_id=result["refund_id"],
+                    error=_("Stripe refund {0} is {1}").format(result["refund_id"], result["status"]),
+                )
+                continue
+
+            set_payment_status(REFUNDED, payment_intent_id=result["payment_intent"])
+
+            # the money has left Stripe at this point, so a booking failure must
+            # not take the refund log of this or any other invoice down with it
+            frappe.db.savepoint("stripe_refund_payment_entry")
+            try:
+                payment_entry = make_refund_payment_entry(invoice, reference_doctype, result)
+            except Exception:
+                frappe.db.rollback(save_point="stripe_refund_payment_entry")
+                frappe.log_error(frappe.get_traceback(), f"Stripe Refund Payment Entry Failed for {invoice.name}")
+                publish_progress(
+                    invoice.name, "refunded", done, total, refund_id=result["refund_id"],
+                    error=_("Refunded in Stripe, but the Payment Entry could not be created"),
+                )
+                continue
+
+            publish_progress(
+                invoice.name, "refunded", done, total,
+                refund_id=result["refund_id"], payment_entry=payment_entry,
+            )
+
+        frappe.db.commit()
+
+
+def get_refundable_invoices(invoices, reference_doctype):
+    """Invoices with a Stripe payment that has not been refunded yet, keyed by name."""
+    fields = INVOICE_FIELDS[reference_doctype]
+    meta = frappe.get_meta(reference_doctype)
+    query_fields = ["name", "customer"]
+    query_fields += [fields[key] for key in ("payment_intent", "session") if meta.has_field(fields[key])]
+    if meta.has_field("company"):
+        query_fields.append("company")
+
+    refunded = set(
+        frappe.get_all(
+            "Stripe Transfer Details",
+            filters={
+                "reference_doc": reference_doctype,
+                "refrence_name": ["in", invoices],
+                "transfer_type": "Refund",
+                "status": ["in", ["paid", "pending"]],
+            },
+            pluck="refrence_name",
+        )
+    )
+
+    refundable = {}
+    for row in frappe.get_all(reference_doctype, filters={"name": ["in", invoices]}, fields=query_fields):
+        payment_intent = row.get(fields["payment_intent"])
+        session = row.get(fields["session"])
+        if row.name in refunded or not (payment_intent or session):
+            continue
+
+        refundable[row.name] = frappe._dict(
+            name=row.name,
+            customer=row.customer,
+            company=row.get("company") or get_collective_invoice_company(row.name, reference_doctype),
+            payment_intent=payment_intent,
+            session=session,
+        )
+
+    return refundable
+
+
+def get_collective_invoice_company(name, reference_doctype):
+    if reference_doctype != "Collective Invoices":
+        return None
+
+    from stripe_pay.api.stripe_webhook import get_collective_invoice_company
+
+    return get_collective_invoice_company(frappe.get_doc(reference_doctype, name))
+
+
+def create_refund(invoice, reason=None):
+    """Refund one invoice's payment intent in full. Runs on the fan-out pool, so it
+    only talks to Stripe and returns what the caller needs to book the refund.
+    """
+    try:
+        payment_intent = invoice.payment_intent
+        if not payment_intent:
+            session = stripe_call(stripe.checkout.Session.retrieve, invoice.session, priority=BACKGROUND)
+            payment_intent = session.payment_intent
+        if not payment_intent:
+            return {"error": _("The checkout session was never paid")}
+
+        params = {"payment_intent": payment_intent, "metadata": {"invoice": invoice.name}}
+        if reason:
+            params["reason"] = reason
+        refund = stripe_call(
+            stripe.Refund.create,
+            # one refund per invoice and payment, however often the batch is retried
+            idempotency_key=f"stripe-pay-refund-{invoice.name}-{payment_intent}",
+            priority=BACKGROUND,
+            **params,
+        )
+    except Exception as e:
+        return {"error": str(e)}
+
+    return {
+        "refund_id": refund.id,
+        "amount": flt(refund.amount) / 100,
+        "status": refund.status,
+        "payment_intent": payment_intent,
+    }
+
+
+def make_refund_payment_entry(invoice, reference_doctype, result):
+    """Book a refund: a credit note for each refunded Sales Invoice and a Payment Entry
+    paying the refunded amount back to the customer against those credit notes.
+    """
+    accounts = get_payment_accounts(invoice.company)
+
+    payment_entry = frappe.new_doc("Payment Entry")
+    payment_entry.payment_type = "Pay"
+    payment_entry.company = invoice.company
+    payment_entry.posting_date = nowdate()
+    payment_entry.mode_of_payment = accounts.mode_of_payment
+    payment_entry.party_type = "Customer"
+    payment_entry.party = invoice.customer
+    payment_entry.paid_from = accounts.paid_to
+    payment_entry.paid_to = accounts.receivable_account
+    payment_entry.paid_amount = result["amount"]
+    payment_entry.received_amount = result["amount"]
+    payment_entry.source_exchange_rate = 1
+    payment_entry.reference_no = result["refund_id"]
+    payment_entry.reference_date = nowdate()
+    payment_entry.remarks = f"Stripe refund {result['refund_id']} for {reference_doctype} {invoice.name}"
+
+    # the refunded amount goes against the credit notes' (negative) outstanding in turn
+    unallocated = flt(result["amount"])
+    for sales_invoice in get_refunded_sales_invoices(invoice, reference_doctype):
+        if unallocated <= 0:
+            break
+        reference_name, outstanding = make_credit_note(sales_invoice)
+        allocated = min(unallocated, abs(outstanding))
+        if not allocated:
+            continue
+        payment_entry.append(
+            "references",
+            {"reference_doctype": "Sales Invoice", "reference_name": reference_name, "allocated_amount": allocated},
+        )
+        unallocated -= allocated
+
+    payment_entry.insert(ignore_permissions=True)
+    payment_entry.submit()
+    return payment_entry.name
+
+
+def get_refunded_sales_invoices(invoice, reference_doctype):
+    if reference_doctype == "Sales Invoice":
+        return [invoice.name]
+    return [
+        row.sales_invoice
+        for row in frappe.get_doc(reference_doctype, invoice.name).reference_invoices
+        if row.sales_invoice
+    ]
+
+
+def make_credit_note(sales_invoice):
+    """Submit a full return of a Sales Invoice; returns the invoice that carries the
+    return's outstanding and that outstanding.
+
+    Depending on `update_outstanding_for_self` the credit note's amount stays on the
+    credit note or goes against the original invoice.
+    """
+    from erpnext.accounts.doctype.sales_invoice.sales_invoice import make_sales_return
+
+    credit_note = make_sales_return(sales_invoice)
+    credit_note.remarks = f"Stripe refund of {sales_invoice}"
+    credit_note.insert(ignore_permissions=True)
+    credit_note.submit()
+
+    if flt(credit_note.outstanding_amount):
+        return credit_note.name, flt(credit_note.outstanding_amount)
+    return sales_invoice, flt(frappe.db.get_value("Sales Invoice", sales_invoice, "outstanding_amount"))
+
+
+def publish_progress(invoice, status, done, total, **details):
+    frappe.publish_realtime(
+        PROGRESS_EVENT,
+        {"invoice": invoice, "status": status, "done": done, "total": total, **details},
+        user=frappe.session.user,
+    )
@@ -0,0 +1,66 @@
+import functools
+from contextlib import contextmanager
+
+import frappe
+
+
+def read_from_replica(fn):
+    """Run a read-only function against the read replica when `read_from_replica` is set.
+
+    Falls back to the primary when no replica is configured or it cannot be reached,
+    and stays on the primary inside `use_primary()` blocks so read-after-write flows
+    never see replication lag.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if frappe.flags.stripe_pay_force_primary or not frappe.conf.read_from_replica:
+            return fn(*args, **kwargs)
+
+        # already running on the replica (nested call)
+        if getattr(frappe.local, "primary_db", None) and frappe.local.db is not frappe.local.primary_db:
+            return fn(*args, **kwargs)
+
+        try:
+            switched = frappe.connect_replica()
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "Stripe Read Replica Unavailable")
+            return fn(*args, **kwargs)
+
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not switched or not is_connection_error(e):
+                raise
+
+            frappe.log_error(frappe.get_traceback(), "Stripe Read Replica Unavailable")
+            restore_primary()
+            switched = False
+            return fn(*args, **kwargs)
+        finally:
+            if switched:
+                restore_primary()
+
+    return wrapper
+
+
+@contextmanager
+def use_primary():
+    """Force `read_from_replica` functions called inside the block onto the primary."""
+    previous = frappe.flags.stripe_pay_force_primary
+    frappe.flags.stripe_pay_force_primary = True
+    try:
+        yield
+    finally:
+        frappe.flags.stripe_pay_force_primary = previous
+
+
+def restore_primary():
+    if getattr(frappe.local, "primary_db", None) and frappe.local.db is not frappe.local.primary_db:
+        frappe.local.db.close()
+        frappe.local.db = frappe.local.primary_db
+
+
+def is_connection_error(e):
+    # pymysql and psycopg2 both report unreachable servers with these classes
+    return type(e).__name__ in ("OperationalError", "InterfaceError")
@@ -0,0 +1,47 @@
+import random
+
+from frappe.utils import add_to_date, now_datetime
+
+from stripe_pay.methods.sdk import stripe
+
+# Stripe error codes of requests that can succeed later unchanged
+TRANSIENT_STRIPE_ERROR_CODES = ("balance_insufficient", "lock_timeout", "rate_limit")
+
+
+def get_next_retry_at(attempts, base_delay=60, max_delay=6 * 60 * 60):
+    """Return when the next attempt is due, backing off exponentially with a little jitter."""
+    delay = min(max_delay, base_delay * (2 ** max(attempts - 1, 0)))
+    delay += random.uniform(0, delay * 0.1)
+    return add_to_date(now_datetime(), seconds=delay)
+
+
+def is_transient_stripe_error(exc):
+    """Whether the same request may succeed if sent again later.
+
+    Network failures, rate limiting, Stripe server errors and an empty balance are
+    transient; anything else Stripe rejected (bad parameters, permissions, a
+    reused idempotency key) fails the same way every time, as does any error that
+    is not Stripe's.
+    """
+    error = stripe.error
+    if isinstance(exc, (error.APIConnectionError, error.RateLimitError)):
+        return True
+    if isinstance(exc, (error.AuthenticationError, error.PermissionError, error.IdempotencyError)):
+        return False
+    if not isinstance(exc, error.StripeError):
+        return False
+
+    status = exc.http_status
+    return status is None or status >= 500 or status in (409, 429) or exc.code in TRANSIENT_STRIPE_ERROR_CODES
+
+
+def is_stripe_rejection(exc):
+    """Whether Stripe answered with a 4xx, i.e. definitely created nothing.
+
+    Stripe saves the response of a request that started executing under its
+    idempotency key and replays it for the same key, so a request to be sent again
+    after a rejection needs a new key. After a network error or a 5xx the outcome
+    is unknown and the key must be kept, so a request Stripe did complete is not
+    made twice.
+    """
+    return isinstance(exc, stripe.error.StripeError) and exc.http_status is not None and exc.http_status < 500
@@ -0,0 +1,47 @@
+import importlib
+import re
+import subprocess
+import sys
+
+
+class LazyStripe:
+    """Stand-in for the `stripe` module that imports the SDK on first use.
+
+    The SDK is large, so importing it at module top put its import cost on
+    whichever request first touched a Stripe module after every worker boot or
+    code reload. Attribute reads and writes (`stripe.api_key = ...`) are forwarded
+    to the real module once it is loaded.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_stripe_module(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_stripe_module(), name, value)
+
+
+stripe = LazyStripe()
+
+
+def get_stripe_module():
+    return sys.modules.get("stripe") or importlib.import_module("stripe")
+
+
+def measure_import_time(module="stripe"):
+    """Cold import time of a module in milliseconds, measured in a fresh interpreter.
+
+    bench --site <site> execute stripe_pay.methods.sdk.measure_import_time
+    bench --site <site> execute stripe_pay.methods.sdk.measure_import_time --kwargs "{'module': 'stripe_pay.methods.stripe'}"
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # each line is "import time: <self us> | <cumulative us> | <module>"
+    for line in reversed(result.stderr.splitlines()):
+        match = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)$", line)
+        if match and match.group(2) == module:
+            return int(match.group(1)) / 1000
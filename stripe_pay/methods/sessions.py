@@ -0,0 +1,123 @@
+from collections import defaultdict
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.pool import run_parallel
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.refunds import INVOICE_FIELDS
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.stripe_pay.doctype.stripe_checkout_session.stripe_checkout_session import (
+    COMPLETED,
+    EXPIRED,
+    OPEN,
+    SUPERSEDED,
+    set_session_status,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import (
+    EXPIRED as PAYMENT_EXPIRED,
+    PROCESSING as PAYMENT_PROCESSING,
+    get_session_ids_reached,
+    set_payment_status,
+)
+
+SWEEP_BATCH_SIZE = 500
+# time for a late completion webhook, or the event poller, to land before a
+# lapsed session is written off
+EXPIRY_GRACE_MINUTES = 60
+
+# Stripe checkout session status -> Stripe Checkout Session status
+STRIPE_SESSION_STATUS = {"complete": COMPLETED, "expired": EXPIRED, "open": None}
+
+
+def sweep_checkout_sessions():
+    """Scheduled: keep local checkout session state in line with what Stripe will accept.
+
+    Superseded sessions that could still be paid are expired in Stripe, and
+    sessions past their expiry are marked expired locally. Invoices stop pointing
+    at sessions that can no longer be paid.
+    """
+    expire_superseded_sessions()
+    expire_lapsed_sessions()
+    frappe.db.commit()
+
+
+def expire_superseded_sessions():
+    session_ids = frappe.get_all(
+        "Stripe Checkout Session",
+        filters={"status": SUPERSEDED, "expires_at": [">", now_datetime()]},
+        order_by="expires_at asc",
+        limit=SWEEP_BATCH_SIZE,
+        pluck="name",
+    )
+    if not session_ids:
+        return
+
+    stripe.api_key = get_secret_key()
+    session_ids_by_status = defaultdict(list)
+    for session_id, status in run_parallel(expire_session, session_ids).items():
+        if status:
+            session_ids_by_status[status].append(session_id)
+
+    for status, ids in session_ids_by_status.items():
+        set_session_status(ids, status)
+        if status == EXPIRED:
+            set_payment_status(PAYMENT_EXPIRED, session_ids=ids)
+
+
+def expire_session(session_id):
+    """Expire one checkout session in Stripe and return its final status."""
+    try:
+        stripe_call(stripe.checkout.Session.expire, session_id, priority=BACKGROUND)
+        return EXPIRED
+    except stripe.error.InvalidRequestError:
+        # only open sessions can be expired; find out what became of this one
+        session = stripe_call(stripe.checkout.Session.retrieve, session_id, priority=BACKGROUND)
+        return STRIPE_SESSION_STATUS.get(session.status)
+
+
+def expire_lapsed_sessions():
+    sessions = frappe.get_all(
+        "Stripe Checkout Session",
+        filters={
+            "status": ["in", [OPEN, SUPERSEDED]],
+            "expires_at": ["<", add_to_date(now_datetime(), minutes=-EXPIRY_GRACE_MINUTES)],
+        },
+        fields=["name", "reference_doctype"],
+        limit=SWEEP_BATCH_SIZE,
+    )
+    if not sessions:
+        return
+
+    # paid in time, only the completion webhook was missed
+    completed = get_session_ids_reached([session.name for session in sessions], PAYMENT_PROCESSING)
+    set_session_status(completed, COMPLETED)
+    sessions = [session for session in sessions if session.name not in completed]
+    if not sessions:
+        return
+
+    set_session_status([session.name for session in sessions], EXPIRED)
+    set_payment_status(PAYMENT_EXPIRED, session_ids=[session.name for session in sessions])
+
+    session_ids_by_doctype = defaultdict(list)
+    for session in sessions:
+        session_ids_by_doctype[session.reference_doctype].append(session.name)
+
+    for doctype, session_ids in session_ids_by_doctype.items():
+        clear_invoice_sessions(doctype, session_ids)
+
+
+def clear_invoice_sessions(doctype, session_ids):
+    """Unset the stored session id of invoices that still point at one of these sessions."""
+    fieldname = INVOICE_FIELDS.get(doctype, {}).get("session")
+    if not fieldname or not frappe.get_meta(doctype).has_field(fieldname):
+        return
+
+    table = frappe.qb.DocType(doctype)
+    (
+        frappe.qb.update(table)
+        .set(table.field(fieldname), None)
+        .where(table.field(fieldname).isin(session_ids))
+        .run()
+    )
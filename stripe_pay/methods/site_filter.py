@@ -0,0 +1,143 @@
+"""Drop webhook events that belong to another site on the same Stripe account.
+
+Several sites can share one Stripe platform account, and every one of them then
+receives every event. Checkout sessions and their payment intents carry the site
+that created them in `metadata.site`, so most foreign events are recognised from
+the event alone. Sessions created before the tag existed are matched against a
+Bloom filter of the session and payment intent ids this site may still get
+events for: those stored on its unpaid invoices, which is where sessions created
+before the session tracking and the payment ledger existed are recorded, plus the
+open sessions and unsettled payments of the two. The filter is built from the
+database by the scheduler, kept in Redis and copied into each web process, so
+rejecting an event never touches the database. Until the first rebuild there is
+no filter and untagged events are all kept.
+"""
+
+import hashlib
+import math
+import time
+
+import frappe
+from redis.exceptions import RedisError
+
+from stripe_pay.methods.refunds import INVOICE_FIELDS
+from stripe_pay.stripe_pay.doctype.stripe_checkout_session.stripe_checkout_session import OPEN
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import OPEN as PAYMENT_OPEN
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import PROCESSING
+
+SITE_METADATA_KEY = "site"
+FILTER_KEY = "stripe_pay:site_session_filter"
+# how long a web process keeps its copy before reading Redis again
+FILTER_TTL = 60
+FALSE_POSITIVE_RATE = 0.01
+# ids of the objects the filter holds
+SESSION_PREFIXES = ("cs_", "pi_")
+
+# site -> (loaded at, filter or None); per process, shared by its requests
+_filters = {}
+
+
+class BloomFilter:
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits or bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        size = max(int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        return cls(size, max(round(size / capacity * math.log(2)), 1))
+
+    def positions(self, value):
+        # double hashing over one digest: h1 + i * h2
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+def get_site_tag():
+    """This site's identifier in Stripe metadata; `stripe_site_tag` in site config overrides the site name."""
+    return frappe.conf.get("stripe_site_tag") or frappe.local.site
+
+
+def is_foreign_event(event):
+    """Whether an event is known to belong to another site; unknown events count as ours."""
+    obj = event["data"]["object"]
+    tag = (obj.get("metadata") or {}).get(SITE_METADATA_KEY)
+    if tag:
+        return tag != get_site_tag()
+
+    object_id = obj.get("id") or ""
+    if not object_id.startswith(SESSION_PREFIXES):
+        return False
+
+    session_filter = get_session_filter()
+    return session_filter is not None and object_id not in session_filter
+
+
+def get_session_filter():
+    site = frappe.local.site
+    loaded_at, session_filter = _filters.get(site, (0, None))
+    if time.monotonic() - loaded_at < FILTER_TTL:
+        return session_filter
+
+    try:
+        stored = frappe.cache.get_value(FILTER_KEY)
+    except RedisError:
+        stored = None
+    session_filter = BloomFilter(*stored) if stored else None
+    _filters[site] = (time.monotonic(), session_filter)
+    return session_filter
+
+
+def rebuild_session_filter():
+    """Scheduled: rebuild the filter of the sessions and payment intents this site may get events for."""
+    session = frappe.qb.DocType("Stripe Checkout Session")
+    ledger = frappe.qb.DocType("Stripe Payments")
+
+    ids = frappe.qb.from_(session).select(session.session_id).where(session.status == OPEN).run(pluck=True)
+    for session_id, payment_intent_id in (
+        frappe.qb.from_(ledger)
+        .select(ledger.session_id, ledger.payment_intent_id)
+        .where(ledger.status.isin([PAYMENT_OPEN, PROCESSING]))
+        .run()
+    ):
+        ids.append(session_id)
+        if payment_intent_id:
+            ids.append(payment_intent_id)
+
+    ids.extend(get_unpaid_invoice_ids())
+
+    session_filter = BloomFilter.for_capacity(len(ids))
+    for object_id in ids:
+        session_filter.add(object_id)
+    frappe.cache.set_value(FILTER_KEY, (session_filter.size, session_filter.hashes, bytes(session_filter.bits)))
+
+
+def get_unpaid_invoice_ids():
+    """Session and payment intent ids stored on invoices not paid yet."""
+    unpaid_filters = {
+        "Sales Invoice": {"docstatus": 1, "outstanding_amount": [">", 0]},
+        "Collective Invoices": {"status": ["!=", "Paid"]},
+    }
+    ids = []
+    for doctype, fields in INVOICE_FIELDS.items():
+        fieldnames = [field for field in fields.values() if frappe.get_meta(doctype).has_field(field)]
+        if fields["session"] not in fieldnames:
+            continue
+        for row in frappe.get_all(
+            doctype,
+            filters={**unpaid_filters[doctype], fields["session"]: ["is", "set"]},
+            fields=fieldnames,
+            as_list=True,
+        ):
+            ids.extend(object_id for object_id in row if object_id)
+    return ids
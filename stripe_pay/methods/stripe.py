@@ -1,12 +1,34 @@
-import stripe
 import frappe
 from frappe import _
 from frappe.utils import flt, now_datetime
 from frappe.utils import nowdate
 
-connected_account_id = "acct_1RdUXWQw0gf1zitu"
+from stripe_pay.api.stripe_webhook import stripe_payment_webhook
+from stripe_pay.methods.accounts import get_payment_accounts
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.payment_entries import submit_payment_entry
+from stripe_pay.methods.payouts import transfer_and_payout
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.site_filter import get_site_tag
+from stripe_pay.methods.tracing import get_trace_id, set_trace_id, span, traced
+from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+from stripe_pay.stripe_pay.doctype.stripe_checkout_session.stripe_checkout_session import (
+    COMPLETED as SESSION_COMPLETED,
+    get_session_trace_id,
+    record_checkout_session,
+    set_session_status,
+)
+from stripe_pay.stripe_pay.doctype.stripe_customer.stripe_customer import (
+    get_checkout_customer_params,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import (
+    PAID,
+    PROCESSING,
+    record_session_payment,
+)
 
 @frappe.whitelist()
+@traced("payment.create", new_trace=True)
 def create_stripe_payment(sales_invoice):
     si_doc = frappe.get_doc("Sales Invoice", sales_invoice)
 
@@ -15,39 +37,26 @@ def create_stripe_payment(sales_invoice):
 
     total = flt(si_doc.grand_total) * 100  
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
 
-    try:
-        transfer = stripe.Transfer.create(
-            amount=int(total),
-            currency="usd",
-            destination=connected_account_id,
-            description=f"Transfer for Sales Invoice {sales_invoice}"
-        )
-        transfer_id = transfer.id
-        frappe.msgprint(f"Transfer successful! Transfer ID: {transfer_id}")
-        create_stripe_transfer_log(transfer_id, "paid", "Sales Invoice", si_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Sales Invoice", si_doc.name)
-        frappe.throw(f"Stripe Transfer failed: {e}")
+    transfer_id, payout_id = transfer_and_payout(
+        int(total), "Sales Invoice", si_doc.name, "Sales Invoice",
+        company=si_doc.company, customer=si_doc.customer
+    )
+    # a queued transfer posts its Payment Entry once it goes through
+    payment_entry = create_transfer_payment_entry(si_doc, transfer_id) if transfer_id else None
 
-    try:
-        payout = stripe.Payout.create(
-            amount=int(total),  
-            currency="usd",
-            description=f"Payout for Sales Invoice {sales_invoice}",
-            stripe_account=connected_account_id
-        )
-        payout_id = payout.id
-        frappe.msgprint(f"Payout initiated! Payout ID: {payout_id}")
-        create_stripe_transfer_log(payout_id, "paid", "Sales Invoice", si_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Sales Invoice", si_doc.name)
-        frappe.throw(f"Stripe Payout failed: {e}")
+    return {
+        "transfer_id": transfer_id,
+        "payout_id": payout_id,
+        "payment_entry": payment_entry
+    }
 
+
+def create_transfer_payment_entry(si_doc, transfer_id):
+    """Post the Payment Entry of a Sales Invoice settled by a Stripe transfer and return its name."""
     payment_entry = frappe.new_doc("Payment Entry")
     payment_entry.payment_type = "Receive"
     payment_entry.company = si_doc.company
@@ -55,8 +64,9 @@ def create_stripe_payment(sales_invoice):
     payment_entry.mode_of_payment = "Cash"
     payment_entry.party_type = "Customer"
     payment_entry.party = si_doc.customer
-    payment_entry.paid_from = frappe.db.get_value("Company", si_doc.company, "default_receivable_account")
-    payment_entry.paid_to = frappe.db.get_value("Mode of Payment Account", {"parent": "Stripe"}, "default_account")
+    accounts = get_payment_accounts(si_doc.company)
+    payment_entry.paid_from = accounts.receivable_account
+    payment_entry.paid_to = accounts.stripe_account
     payment_entry.paid_amount = si_doc.grand_total
     payment_entry.received_amount = si_doc.grand_total
     payment_entry.target_exchange_rate = 1
@@ -69,44 +79,26 @@ def create_stripe_payment(sales_invoice):
         "allocated_amount": si_doc.grand_total
     })
 
-    payment_entry.insert(ignore_permissions=True)
-    payment_entry.submit()
+    with span("payment_entry.create"):
+        payment_entry.insert(ignore_permissions=True)
+        submit_payment_entry(payment_entry)
 
     frappe.msgprint(f"Payment Entry created: {payment_entry.name}")
-
-    return {
-        "transfer_id": transfer_id,
-        "payout_id": payout_id,
-        "payment_entry": payment_entry.name
-    }
-
-
-def create_stripe_transfer_log(reference_id, status, reference_doc, reference_name):
-    doc = frappe.new_doc("Stripe Transfer Details")
-    doc.reference_id = reference_id
-    doc.status = status
-    doc.datetime = now_datetime()
-    doc.reference_doc = reference_doc
-    doc.refrence_name = reference_name
-    doc.account = connected_account_id
-    doc.insert(ignore_permissions=True)
-    frappe.db.commit() 
-    frappe.msgprint(f"Stripe Transfer Log created: {doc.name}")
-    return doc.name
+    return payment_entry.name
 
 
 @frappe.whitelist()
 def check_transfer_status(account, reference_id):
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
     try:
-        transfer = stripe.Transfer.retrieve(reference_id)
+        transfer = stripe_call(stripe.Transfer.retrieve, reference_id)
         return {"status": transfer.status}
     except stripe.error.InvalidRequestError:
         try:
-            payout = stripe.Payout.retrieve(
+            payout = stripe_call(
+                stripe.Payout.retrieve,
                 reference_id,
                 stripe_account=account
             )
@@ -118,6 +110,7 @@ def check_transfer_status(account, reference_id):
 
 
 @frappe.whitelist()
+@traced("checkout.create", new_trace=True)
 def create_stripe_url(sales_invoice=None):
     if not sales_invoice:
         sales_invoice = frappe.local.request.args.get("sales_invoice")
@@ -130,14 +123,14 @@ def create_stripe_url(sales_invoice=None):
     if si_doc.docstatus != 1:
         frappe.throw(_("Sales Invoice must be submitted before creating a payment."))
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
     currency = "usd"  
 
     try:
-        session = stripe.checkout.Session.create(
+        session = stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=["us_bank_account"],
             
             line_items=[{
@@ -157,10 +150,13 @@ def create_stripe_url(sales_invoice=None):
             
             metadata={
                 "sales_invoice": si_doc.name,
-                "customer": si_doc.customer
+                "customer": si_doc.customer,
+                "trace_id": get_trace_id(),
+                "site": get_site_tag(),
             },
-            
-            customer_creation="if_required",
+            **get_checkout_customer_params(
+                si_doc.customer, {"sales_invoice": si_doc.name, "trace_id": get_trace_id(), "site": get_site_tag()}
+            ),
             
             billing_address_collection="auto",
             
@@ -190,6 +186,7 @@ def create_stripe_url(sales_invoice=None):
         si_doc.db_set("stripe_session_id", session.id)
         if session.get("payment_intent"):
             si_doc.db_set("stripe_payment_intent_id", session.payment_intent)
+        record_checkout_session("Sales Invoice", si_doc.name, session, si_doc.grand_total)
 
         frappe.db.commit()
 
@@ -205,6 +202,7 @@ def create_stripe_url(sales_invoice=None):
 
 
 @frappe.whitelist(allow_guest=True)
+@traced("callback.success")
 def handle_success_callback():
     try:
         invoice_id = frappe.local.request.args.get("invoice")
@@ -223,26 +221,28 @@ def handle_success_callback():
             frappe.local.response["location"] = f"/app/sales-invoice/{invoice_id}"
             return
 
-        stripe_settings = frappe.get_single("Stripe Payment Settings")
-        sk = stripe_settings.get_password("secret_key")
+        sk = get_secret_key()
         stripe.api_key = sk
         
         session_id = invoice.stripe_session_id
+        set_trace_id(get_session_trace_id(session_id))
         if session_id:
-            session = stripe.checkout.Session.retrieve(session_id)
-            payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
-            payment_method = stripe.PaymentMethod.retrieve(payment_intent.payment_method)
+            session = stripe_call(stripe.checkout.Session.retrieve, session_id)
+            payment_intent = stripe_call(stripe.PaymentIntent.retrieve, session.payment_intent)
+            payment_method = stripe_call(stripe.PaymentMethod.retrieve, payment_intent.payment_method)
             
             frappe.log_error(f"Payment method used: {payment_method.type}", "Payment Method Info")
+            record_session_payment(
+                session, PAID if session.payment_status == "paid" else PROCESSING,
+                "Sales Invoice", invoice.name, payment_method_type=payment_method.type,
+            )
+            if session.status == "complete":
+                set_session_status([session.id], SESSION_COMPLETED)
 
-        paid_from = frappe.get_cached_value("Company", invoice.company, "default_receivable_account")
-        
-        paid_to = frappe.get_cached_value("Mode of Payment Account", {"parent": "Stripe", "company": invoice.company}, "default_account")
-        mode_of_payment = "Stripe"
-        
-        if not paid_to:
-            paid_to = frappe.get_cached_value("Mode of Payment Account", {"parent": "Cash", "company": invoice.company}, "default_account")
-            mode_of_payment = "Stripe"
+        accounts = get_payment_accounts(invoice.company)
+        paid_from = accounts.receivable_account
+        paid_to = accounts.paid_to
+        mode_of_payment = accounts.mode_of_payment
 
         if not paid_from or not paid_to:
             frappe.log_error("Paid From or Paid To account missing", "Payment Account Error")
@@ -274,8 +274,9 @@ def handle_success_callback():
             "allocated_amount": invoice.outstanding_amount
         })
 
-        payment_entry.insert(ignore_permissions=True)
-        payment_entry.submit()
+        with span("payment_entry.create"):
+            payment_entry.insert(ignore_permissions=True)
+            submit_payment_entry(payment_entry)
         frappe.db.commit()
 
         frappe.log_error(payment_entry.name, "Payment Entry Created")
@@ -285,7 +286,10 @@ def handle_success_callback():
                 invoice.stripe_session_id, 
                 "paid", 
                 "Sales Invoice", 
-                invoice.name
+                invoice.name,
+                transfer_type="Checkout",
+                amount=payment_entry.paid_amount,
+                company=invoice.company
             )
 
         frappe.local.response["type"] = "redirect"
@@ -319,66 +323,10 @@ def handle_failure_callback():
 
 @frappe.whitelist(allow_guest=True)
 def stripe_webhook():
-    """Handle Stripe webhook events for payment status updates"""
-    try:
-        payload = frappe.request.get_data()
-        sig_header = frappe.request.headers.get('Stripe-Signature')
-        
-        stripe_settings = frappe.get_single("Stripe Payment Settings")
-        endpoint_secret = stripe_settings.get_password("webhook_secret")
-        
-        if not endpoint_secret:
-            frappe.log_error("Webhook secret not configured", "Stripe Webhook")
-            return {"status": "error", "message": "Webhook secret not configured"}
-        
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
+    """Webhook URL kept for endpoints registered with it; events are verified and
+    dispatched by `stripe_pay.api.stripe_webhook.stripe_payment_webhook`."""
+    return stripe_payment_webhook()
 
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            handle_checkout_session_completed(session)
-        elif event['type'] == 'payment_intent.succeeded':
-            payment_intent = event['data']['object']
-            handle_payment_intent_succeeded(payment_intent)
-        elif event['type'] == 'payment_intent.payment_failed':
-            payment_intent = event['data']['object']
-            handle_payment_intent_failed(payment_intent)
-
-        return {"status": "success"}
-
-    except ValueError as e:
-        frappe.log_error(f"Invalid payload: {str(e)}", "Stripe Webhook")
-        return {"status": "error", "message": "Invalid payload"}
-    except stripe.error.SignatureVerificationError as e:
-        frappe.log_error(f"Invalid signature: {str(e)}", "Stripe Webhook")
-        return {"status": "error", "message": "Invalid signature"}
-    except Exception as e:
-        frappe.log_error(frappe.get_traceback(), "Webhook Error")
-        return {"status": "error", "message": "Webhook processing failed"}
-
-def handle_checkout_session_completed(session):
-    """Handle completed checkout session"""
-    try:
-        sales_invoice = session.metadata.get('sales_invoice')
-        if sales_invoice:
-            frappe.log_error(f"Checkout session completed for invoice {sales_invoice}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing checkout session: {str(e)}", "Stripe Webhook")
-
-def handle_payment_intent_succeeded(payment_intent):
-    """Handle successful payment intent (useful for ACH payments)"""
-    try:
-        frappe.log_error(f"Payment intent succeeded: {payment_intent.id}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing payment success: {str(e)}", "Stripe Webhook")
-
-def handle_payment_intent_failed(payment_intent):
-    """Handle failed payment intent"""
-    try:
-        frappe.log_error(f"Payment intent failed: {payment_intent.id}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing payment failure: {str(e)}", "Stripe Webhook")
 
 @frappe.whitelist(allow_guest=True)
 def handle_failure_callback():
@@ -1,12 +1,41 @@
-import stripe
 import frappe
 from frappe import _
 from frappe.utils import flt, now_datetime, nowdate
 from frappe.utils import get_url
 
-connected_account_id = "acct_1RdUXWQw0gf1zitu"
+from stripe_pay.api.stripe_webhook import stripe_payment_webhook
+from stripe_pay.methods.accounts import get_payment_accounts
+from stripe_pay.methods.allocation import (
+    allocate,
+    build_payment_references,
+    get_allocation_strategy,
+    get_reference_invoices,
+)
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.payment_entries import submit_payment_entry
+from stripe_pay.methods.payouts import transfer_and_payout
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.site_filter import get_site_tag
+from stripe_pay.methods.stripe import create_transfer_payment_entry
+from stripe_pay.methods.tracing import get_trace_id, set_trace_id, span, traced
+from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+from stripe_pay.stripe_pay.doctype.stripe_checkout_session.stripe_checkout_session import (
+    COMPLETED as SESSION_COMPLETED,
+    get_session_trace_id,
+    record_checkout_session,
+    set_session_status,
+)
+from stripe_pay.stripe_pay.doctype.stripe_customer.stripe_customer import (
+    get_checkout_customer_params,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import (
+    PAID,
+    PROCESSING,
+    record_session_payment,
+)
 
 @frappe.whitelist()
+@traced("payment.create", new_trace=True)
 def create_stripe_payment_collective(collective_invoice):
     """Create Stripe payment for Collective Invoice"""
     ci_doc = frappe.get_doc("Collective Invoices", collective_invoice)
@@ -16,41 +45,17 @@ def create_stripe_payment_collective(collective_invoice):
 
     total = flt(ci_doc.total_amount) * 100  # Convert to cents
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
-    try:
-        # Create transfer
-        transfer = stripe.Transfer.create(
-            amount=int(total),
-            currency="usd",
-            destination=connected_account_id,
-            description=f"Transfer for Collective Invoice {collective_invoice}"
-        )
-        transfer_id = transfer.id
-        frappe.msgprint(f"Transfer successful! Transfer ID: {transfer_id}")
-        create_stripe_transfer_log(transfer_id, "paid", "Collective Invoices", ci_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Collective Invoices", ci_doc.name)
-        frappe.throw(f"Stripe Transfer failed: {e}")
-
-    try:
-        # Create payout
-        payout = stripe.Payout.create(
-            amount=int(total),  
-            currency="usd",
-            description=f"Payout for Collective Invoice {collective_invoice}",
-            stripe_account=connected_account_id
-        )
-        payout_id = payout.id
-        frappe.msgprint(f"Payout initiated! Payout ID: {payout_id}")
-        create_stripe_transfer_log(payout_id, "paid", "Collective Invoices", ci_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Collective Invoices", ci_doc.name)
-        frappe.throw(f"Stripe Payout failed: {e}")
+    invoices = get_reference_invoices(ci_doc)
+    transfer_id, payout_id = transfer_and_payout(
+        int(total), "Collective Invoices", ci_doc.name, "Collective Invoice",
+        company=invoices[0].company if invoices else None, customer=ci_doc.customer
+    )
 
-    payment_entry = create_collective_payment_entry(ci_doc, transfer_id)
+    # a queued transfer posts its Payment Entry once it goes through
+    payment_entry = create_collective_payment_entry(ci_doc, transfer_id, invoices=invoices) if transfer_id else None
 
     return {
         "transfer_id": transfer_id,
@@ -58,13 +63,18 @@ def create_stripe_payment_collective(collective_invoice):
         "payment_entry": payment_entry
     }
 
-def create_collective_payment_entry(ci_doc, reference_no):
-    """Create payment entry for collective invoice"""
+@traced("payment_entry.create")
+def create_collective_payment_entry(ci_doc, reference_no, settled_amount=None, strategy=None, invoices=None):
+    """Create payment entry for collective invoice
+
+    `settled_amount` defaults to the collective invoice total and is spread over the
+    reference invoices by the configured allocation strategy.
+    """
+    if invoices is None:
+        invoices = get_reference_invoices(ci_doc)
+
     # Get company from first reference invoice or use default
-    company = None
-    if ci_doc.reference_invoices:
-        first_invoice = frappe.get_doc("Sales Invoice", ci_doc.reference_invoices[0].sales_invoice)
-        company = first_invoice.company
+    company = invoices[0].company if invoices else None
     
     if not company:
         company = frappe.defaults.get_user_default("Company")
@@ -72,6 +82,9 @@ def create_collective_payment_entry(ci_doc, reference_no):
     if not company:
         frappe.throw("Cannot determine company for payment entry")
 
+    if settled_amount is None:
+        settled_amount = ci_doc.total_amount
+
     # Get customer from collective invoice
     customer = ci_doc.customer
 
@@ -84,48 +97,33 @@ def create_collective_payment_entry(ci_doc, reference_no):
     payment_entry.party = customer
     
     # Get accounts
-    paid_from = frappe.db.get_value("Company", company, "default_receivable_account")
-    paid_to = frappe.db.get_value("Mode of Payment Account", 
-                                  {"parent": "Stripe", "company": company}, 
-                                  "default_account")
-    
-    if not paid_to:
-        paid_to = frappe.db.get_value("Mode of Payment Account", 
-                                      {"parent": "Cash", "company": company}, 
-                                      "default_account")
+    accounts = get_payment_accounts(company)
+    paid_from = accounts.receivable_account
+    paid_to = accounts.paid_to
     
     if not paid_from or not paid_to:
         frappe.throw("Payment accounts not configured properly")
 
     payment_entry.paid_from = paid_from
     payment_entry.paid_to = paid_to
-    payment_entry.paid_amount = ci_doc.total_amount
-    payment_entry.received_amount = ci_doc.total_amount
+    payment_entry.paid_amount = settled_amount
+    payment_entry.received_amount = settled_amount
     payment_entry.target_exchange_rate = 1
     payment_entry.reference_no = reference_no
     payment_entry.reference_date = now_datetime().date()
 
-    # Add all reference invoices to payment entry
-    for ref_invoice in ci_doc.reference_invoices:
-        si_doc = frappe.get_doc("Sales Invoice", ref_invoice.sales_invoice)
-        outstanding_amount = min(si_doc.outstanding_amount, ref_invoice.outstanding)
-        
-        if outstanding_amount > 0:
-            payment_entry.append("references", {
-                "reference_doctype": "Sales Invoice",
-                "reference_name": si_doc.name,
-                "total_amount": si_doc.grand_total,
-                "outstanding_amount": si_doc.outstanding_amount,
-                "allocated_amount": outstanding_amount
-            })
+    # Spread the settled amount over all reference invoices
+    allocations = allocate(settled_amount, invoices, strategy or get_allocation_strategy())
+    payment_entry.extend("references", build_payment_references(invoices, allocations))
 
     payment_entry.insert(ignore_permissions=True)
-    payment_entry.submit()
+    submit_payment_entry(payment_entry)
 
     frappe.msgprint(f"Payment Entry created: {payment_entry.name}")
     return payment_entry.name
 
 @frappe.whitelist()
+@traced("checkout.create", new_trace=True)
 def create_stripe_url_collective(collective_invoice=None):
     """Create Stripe checkout URL for Collective Invoice"""
     if not collective_invoice:
@@ -136,13 +134,11 @@ def create_stripe_url_collective(collective_invoice=None):
     
     ci_doc = frappe.get_doc("Collective Invoices", collective_invoice)
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     
     if not sk:
         frappe.throw(_("Stripe secret key not configured"))
     
-    import stripe
     stripe.api_key = sk
 
     currency = "usd"
@@ -162,7 +158,8 @@ def create_stripe_url_collective(collective_invoice=None):
         # Get the site URL properly
         site_url = frappe.utils.get_url()
         
-        session = stripe.checkout.Session.create(
+        session = stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=["us_bank_account"],
             
             line_items=[{
@@ -186,10 +183,13 @@ def create_stripe_url_collective(collective_invoice=None):
                 "collective_invoice": ci_doc.name,
                 "customer": ci_doc.customer,
                 "total_amount": str(ci_doc.total_amount),
-                "invoice_count": str(len(ci_doc.reference_invoices))
+                "invoice_count": str(len(ci_doc.reference_invoices)),
+                "trace_id": get_trace_id(),
+                "site": get_site_tag(),
             },
-            
-            customer_creation="if_required",
+            **get_checkout_customer_params(
+                ci_doc.customer, {"collective_invoice": ci_doc.name, "trace_id": get_trace_id(), "site": get_site_tag()}
+            ),
             billing_address_collection="auto",
             
             custom_fields=[
@@ -218,6 +218,7 @@ def create_stripe_url_collective(collective_invoice=None):
         ci_doc.db_set("custom_stripe_session_id", session.id)
         if session.get("payment_intent"):
             ci_doc.db_set("custom_stripe_payment_intent_id", session.payment_intent)
+        record_checkout_session("Collective Invoices", ci_doc.name, session, ci_doc.total_amount)
 
         frappe.db.commit()
 
@@ -232,6 +233,7 @@ def create_stripe_url_collective(collective_invoice=None):
         frappe.throw(_("Stripe Checkout Session creation failed: ") + str(e))
 
 @frappe.whitelist(allow_guest=True)
+@traced("callback.success")
 def handle_collective_success_callback():
     """Handle successful payment for collective invoice"""
     try:
@@ -259,10 +261,8 @@ def handle_collective_success_callback():
             return
 
         # Get company from first reference invoice
-        company = None
-        if ci_doc.reference_invoices:
-            first_invoice = frappe.get_doc("Sales Invoice", ci_doc.reference_invoices[0].sales_invoice)
-            company = first_invoice.company
+        invoices = get_reference_invoices(ci_doc)
+        company = invoices[0].company if invoices else None
 
         if not company:
             company = frappe.defaults.get_user_default("Company")
@@ -274,8 +274,7 @@ def handle_collective_success_callback():
             return
 
         # Initialize Stripe
-        stripe_settings = frappe.get_single("Stripe Payment Settings")
-        sk = stripe_settings.get_password("secret_key")
+        sk = get_secret_key()
         
         if not sk:
             frappe.log_error("Stripe secret key not found", "Stripe Config Error")
@@ -287,26 +286,32 @@ def handle_collective_success_callback():
         
         # Get payment method info if session exists
         session_id = getattr(ci_doc, 'custom_stripe_session_id', None)
+        set_trace_id(get_session_trace_id(session_id))
+        settled_amount = ci_doc.total_amount
         if session_id:
             try:
-                session = stripe.checkout.Session.retrieve(session_id)
+                session = stripe_call(stripe.checkout.Session.retrieve, session_id)
+                if session.amount_total is not None:
+                    settled_amount = flt(session.amount_total) / 100
+                payment_method_type = None
                 if session.payment_intent:
-                    payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
-                    payment_method = stripe.PaymentMethod.retrieve(payment_intent.payment_method)
+                    payment_intent = stripe_call(stripe.PaymentIntent.retrieve, session.payment_intent)
+                    payment_method = stripe_call(stripe.PaymentMethod.retrieve, payment_intent.payment_method)
+                    payment_method_type = payment_method.type
                     frappe.log_error(f"Payment method used: {payment_method.type}", "Collective Payment Method Info")
+                record_session_payment(
+                    session, PAID if session.payment_status == "paid" else PROCESSING,
+                    "Collective Invoices", ci_doc.name, payment_method_type=payment_method_type,
+                )
+                if session.status == "complete":
+                    set_session_status([session.id], SESSION_COMPLETED)
             except Exception as e:
                 frappe.log_error(f"Error retrieving payment info: {str(e)}", "Payment Info Error")
 
         # Get accounts
-        paid_from = frappe.get_cached_value("Company", company, "default_receivable_account")
-        paid_to = frappe.get_cached_value("Mode of Payment Account", 
-                                          {"parent": "Stripe", "company": company}, 
-                                          "default_account")
-        
-        if not paid_to:
-            paid_to = frappe.get_cached_value("Mode of Payment Account", 
-                                              {"parent": "Cash", "company": company}, 
-                                              "default_account")
+        accounts = get_payment_accounts(company)
+        paid_from = accounts.receivable_account
+        paid_to = accounts.paid_to
 
         if not paid_from or not paid_to:
             frappe.log_error("Paid From or Paid To account missing", "Collective Payment Account Error")
@@ -324,8 +329,8 @@ def handle_collective_success_callback():
         payment_entry.party = ci_doc.customer
         payment_entry.paid_from = paid_from
         payment_entry.paid_to = paid_to
-        payment_entry.paid_amount = ci_doc.total_amount
-        payment_entry.received_amount = ci_doc.total_amount
+        payment_entry.paid_amount = settled_amount
+        payment_entry.received_amount = settled_amount
         payment_entry.target_exchange_rate = 1
         
         # Set reference details
@@ -336,24 +341,12 @@ def handle_collective_success_callback():
             payment_entry.reference_no = f"Collective-{ci_doc.name}"
             payment_entry.reference_date = nowdate()
 
-        # Add all reference invoices to payment entry
-        total_allocated = 0
-        for ref_invoice in ci_doc.reference_invoices:
-            try:
-                si_doc = frappe.get_doc("Sales Invoice", ref_invoice.sales_invoice)
-                outstanding_amount = min(si_doc.outstanding_amount, ref_invoice.outstanding)
-                
-                if outstanding_amount > 0:
-                    payment_entry.append("references", {
-                        "reference_doctype": "Sales Invoice",
-                        "reference_name": si_doc.name,
-                        "total_amount": si_doc.grand_total,
-                        "outstanding_amount": si_doc.outstanding_amount,
-                        "allocated_amount": outstanding_amount
-                    })
-                    total_allocated += outstanding_amount
-            except Exception as e:
-                frappe.log_error(f"Error processing reference invoice {ref_invoice.sales_invoice}: {str(e)}", "Reference Invoice Error")
+        # Spread the settled amount over all reference invoices
+        references = build_payment_references(
+            invoices, allocate(settled_amount, invoices, get_allocation_strategy())
+        )
+        payment_entry.extend("references", references)
+        total_allocated = sum(ref["allocated_amount"] for ref in references)
 
         if total_allocated == 0:
             frappe.log_error("No amount allocated to references", "Allocation Error")
@@ -362,8 +355,9 @@ def handle_collective_success_callback():
             return
 
         # Save and submit payment entry
-        payment_entry.insert(ignore_permissions=True)
-        payment_entry.submit()
+        with span("payment_entry.create"):
+            payment_entry.insert(ignore_permissions=True)
+            submit_payment_entry(payment_entry)
         frappe.db.commit()
 
         frappe.log_error(f"Collective Payment Entry Created: {payment_entry.name}", "Payment Entry Success")
@@ -374,7 +368,10 @@ def handle_collective_success_callback():
                 session_id, 
                 "paid", 
                 "Collective Invoices", 
-                ci_doc.name
+                ci_doc.name,
+                transfer_type="Checkout",
+                amount=settled_amount,
+                company=company
             )
 
         # Redirect back to collective invoice with success message
@@ -407,34 +404,20 @@ def handle_collective_failure_callback():
         frappe.local.response["location"] = "/app/collective-invoices"
     return
 
-# Keep the existing utility functions
-def create_stripe_transfer_log(reference_id, status, reference_doc, reference_name):
-    """Create transfer log entry"""
-    doc = frappe.new_doc("Stripe Transfer Details")
-    doc.reference_id = reference_id
-    doc.status = status
-    doc.datetime = now_datetime()
-    doc.reference_doc = reference_doc
-    doc.refrence_name = reference_name  # Note: keeping the typo from original
-    doc.account = connected_account_id
-    doc.insert(ignore_permissions=True)
-    frappe.db.commit() 
-    frappe.msgprint(f"Stripe Transfer Log created: {doc.name}")
-    return doc.name
 
 @frappe.whitelist()
 def check_collective_transfer_status(account, reference_id):
     """Check status of collective invoice transfer"""
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
     try:
-        transfer = stripe.Transfer.retrieve(reference_id)
+        transfer = stripe_call(stripe.Transfer.retrieve, reference_id)
         return {"status": transfer.status}
     except stripe.error.InvalidRequestError:
         try:
-            payout = stripe.Payout.retrieve(
+            payout = stripe_call(
+                stripe.Payout.retrieve,
                 reference_id,
                 stripe_account=account
             )
@@ -444,77 +427,15 @@ def check_collective_transfer_status(account, reference_id):
     except Exception as e:
         frappe.throw(f"Could not retrieve status: {str(e)}")
 
-# Keep existing webhook and other functions unchanged
 @frappe.whitelist(allow_guest=True)
 def stripe_webhook():
-    """Handle Stripe webhook events for payment status updates"""
-    try:
-        payload = frappe.request.get_data()
-        sig_header = frappe.request.headers.get('Stripe-Signature')
-        
-        stripe_settings = frappe.get_single("Stripe Payment Settings")
-        endpoint_secret = stripe_settings.get_password("webhook_secret")
-        
-        if not endpoint_secret:
-            frappe.log_error("Webhook secret not configured", "Stripe Webhook")
-            return {"status": "error", "message": "Webhook secret not configured"}
-        
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
-
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            handle_checkout_session_completed(session)
-        elif event['type'] == 'payment_intent.succeeded':
-            payment_intent = event['data']['object']
-            handle_payment_intent_succeeded(payment_intent)
-        elif event['type'] == 'payment_intent.payment_failed':
-            payment_intent = event['data']['object']
-            handle_payment_intent_failed(payment_intent)
-
-        return {"status": "success"}
-
-    except ValueError as e:
-        frappe.log_error(f"Invalid payload: {str(e)}", "Stripe Webhook")
-        return {"status": "error", "message": "Invalid payload"}
-    except stripe.error.SignatureVerificationError as e:
-        frappe.log_error(f"Invalid signature: {str(e)}", "Stripe Webhook")
-        return {"status": "error", "message": "Invalid signature"}
-    except Exception as e:
-        frappe.log_error(frappe.get_traceback(), "Webhook Error")
-        return {"status": "error", "message": "Webhook processing failed"}
-
-def handle_checkout_session_completed(session):
-    """Handle completed checkout session"""
-    try:
-        # Check if it's a collective invoice or sales invoice
-        collective_invoice = session.metadata.get('collective_invoice')
-        sales_invoice = session.metadata.get('sales_invoice')
-        
-        if collective_invoice:
-            frappe.log_error(f"Checkout session completed for collective invoice {collective_invoice}", "Stripe Webhook")
-        elif sales_invoice:
-            frappe.log_error(f"Checkout session completed for sales invoice {sales_invoice}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing checkout session: {str(e)}", "Stripe Webhook")
-
-def handle_payment_intent_succeeded(payment_intent):
-    """Handle successful payment intent"""
-    try:
-        frappe.log_error(f"Payment intent succeeded: {payment_intent.id}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing payment success: {str(e)}", "Stripe Webhook")
-
-def handle_payment_intent_failed(payment_intent):
-    """Handle failed payment intent"""
-    try:
-        frappe.log_error(f"Payment intent failed: {payment_intent.id}", "Stripe Webhook")
-    except Exception as e:
-        frappe.log_error(f"Error processing payment failure: {str(e)}", "Stripe Webhook")
+    """Webhook URL kept for endpoints registered with it; events are verified and
+    dispatched by `stripe_pay.api.stripe_webhook.stripe_payment_webhook`."""
+    return stripe_payment_webhook()
 
 # Keep existing Sales Invoice functions for backward compatibility
 @frappe.whitelist()
+@traced("payment.create", new_trace=True)
 def create_stripe_payment(sales_invoice):
     """Original function for Sales Invoice payments"""
     si_doc = frappe.get_doc("Sales Invoice", sales_invoice)
@@ -524,71 +445,24 @@ def create_stripe_payment(sales_invoice):
 
     total = flt(si_doc.grand_total) * 100  
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
-    try:
-        transfer = stripe.Transfer.create(
-            amount=int(total),
-            currency="usd",
-            destination=connected_account_id,
-            description=f"Transfer for Sales Invoice {sales_invoice}"
-        )
-        transfer_id = transfer.id
-        frappe.msgprint(f"Transfer successful! Transfer ID: {transfer_id}")
-        create_stripe_transfer_log(transfer_id, "paid", "Sales Invoice", si_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Sales Invoice", si_doc.name)
-        frappe.throw(f"Stripe Transfer failed: {e}")
-
-    try:
-        payout = stripe.Payout.create(
-            amount=int(total),  
-            currency="usd",
-            description=f"Payout for Sales Invoice {sales_invoice}",
-            stripe_account=connected_account_id
-        )
-        payout_id = payout.id
-        frappe.msgprint(f"Payout initiated! Payout ID: {payout_id}")
-        create_stripe_transfer_log(payout_id, "paid", "Sales Invoice", si_doc.name)
-    except Exception as e:
-        create_stripe_transfer_log("N/A", "failed", "Sales Invoice", si_doc.name)
-        frappe.throw(f"Stripe Payout failed: {e}")
-
-    payment_entry = frappe.new_doc("Payment Entry")
-    payment_entry.payment_type = "Receive"
-    payment_entry.company = si_doc.company
-    payment_entry.posting_date = now_datetime().date()
-    payment_entry.mode_of_payment = "Cash"
-    payment_entry.party_type = "Customer"
-    payment_entry.party = si_doc.customer
-    payment_entry.paid_from = frappe.db.get_value("Company", si_doc.company, "default_receivable_account")
-    payment_entry.paid_to = frappe.db.get_value("Mode of Payment Account", {"parent": "Stripe"}, "default_account")
-    payment_entry.paid_amount = si_doc.grand_total
-    payment_entry.received_amount = si_doc.grand_total
-    payment_entry.target_exchange_rate = 1
-    payment_entry.reference_no = transfer_id
-    payment_entry.reference_date = now_datetime().date()
-
-    payment_entry.append("references", {
-        "reference_doctype": "Sales Invoice",
-        "reference_name": si_doc.name,
-        "allocated_amount": si_doc.grand_total
-    })
-
-    payment_entry.insert(ignore_permissions=True)
-    payment_entry.submit()
-
-    frappe.msgprint(f"Payment Entry created: {payment_entry.name}")
+    transfer_id, payout_id = transfer_and_payout(
+        int(total), "Sales Invoice", si_doc.name, "Sales Invoice",
+        company=si_doc.company, customer=si_doc.customer
+    )
+    # a queued transfer posts its Payment Entry once it goes through
+    payment_entry = create_transfer_payment_entry(si_doc, transfer_id) if transfer_id else None
 
     return {
         "transfer_id": transfer_id,
         "payout_id": payout_id,
-        "payment_entry": payment_entry.name
+        "payment_entry": payment_entry
     }
 
 @frappe.whitelist()
+@traced("checkout.create", new_trace=True)
 def create_stripe_url(sales_invoice=None):
     """Original function for Sales Invoice Stripe URL"""
     if not sales_invoice:
@@ -602,14 +476,14 @@ def create_stripe_url(sales_invoice=None):
     if si_doc.docstatus != 1:
         frappe.throw(_("Sales Invoice must be submitted before creating a payment."))
 
-    stripe_settings = frappe.get_single("Stripe Payment Settings")
-    sk = stripe_settings.get_password("secret_key")
+    sk = get_secret_key()
     stripe.api_key = sk
 
     currency = "usd"  
 
     try:
-        session = stripe.checkout.Session.create(
+        session = stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=["us_bank_account"],
             
             line_items=[{
@@ -629,10 +503,13 @@ def create_stripe_url(sales_invoice=None):
             
             metadata={
                 "sales_invoice": si_doc.name,
-                "customer": si_doc.customer
+                "customer": si_doc.customer,
+                "trace_id": get_trace_id(),
+                "site": get_site_tag(),
             },
-            
-            customer_creation="if_required",
+            **get_checkout_customer_params(
+                si_doc.customer, {"sales_invoice": si_doc.name, "trace_id": get_trace_id(), "site": get_site_tag()}
+            ),
             billing_address_collection="auto",
             
             custom_fields=[
@@ -660,6 +537,7 @@ def create_stripe_url(sales_invoice=None):
         si_doc.db_set("stripe_session_id", session.id)
         if session.get("payment_intent"):
             si_doc.db_set("stripe_payment_intent_id", session.payment_intent)
+        record_checkout_session("Sales Invoice", si_doc.name, session, si_doc.grand_total)
 
         frappe.db.commit()
 
@@ -674,6 +552,7 @@ def create_stripe_url(sales_invoice=None):
         frappe.throw(_("Stripe Checkout Session creation failed: ") + str(e))
 
 @frappe.whitelist(allow_guest=True)
+@traced("callback.success")
 def handle_success_callback():
     """Original success callback for Sales Invoice"""
     try:
@@ -694,26 +573,28 @@ def handle_success_callback():
             frappe.local.response["location"] = f"/app/sales-invoice/{invoice_id}"
             return
 
-        stripe_settings = frappe.get_single("Stripe Payment Settings")
-        sk = stripe_settings.get_password("secret_key")
+        sk = get_secret_key()
         stripe.api_key = sk
         
         session_id = invoice.stripe_session_id
+        set_trace_id(get_session_trace_id(session_id))
         if session_id:
-            session = stripe.checkout.Session.retrieve(session_id)
-            payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
-            payment_method = stripe.PaymentMethod.retrieve(payment_intent.payment_method)
+            session = stripe_call(stripe.checkout.Session.retrieve, session_id)
+            payment_intent = stripe_call(stripe.PaymentIntent.retrieve, session.payment_intent)
+            payment_method = stripe_call(stripe.PaymentMethod.retrieve, payment_intent.payment_method)
             
             frappe.log_error(f"Payment method used: {payment_method.type}", "Payment Method Info")
+            record_session_payment(
+                session, PAID if session.payment_status == "paid" else PROCESSING,
+                "Sales Invoice", invoice.name, payment_method_type=payment_method.type,
+            )
+            if session.status == "complete":
+                set_session_status([session.id], SESSION_COMPLETED)
 
-        paid_from = frappe.get_cached_value("Company", invoice.company, "default_receivable_account")
-        
-        paid_to = frappe.get_cached_value("Mode of Payment Account", {"parent": "Stripe", "company": invoice.company}, "default_account")
-        mode_of_payment = "Stripe"
-        
-        if not paid_to:
-            paid_to = frappe.get_cached_value("Mode of Payment Account", {"parent": "Cash", "company": invoice.company}, "default_account")
-            mode_of_payment = "Stripe"
+        accounts = get_payment_accounts(invoice.company)
+        paid_from = accounts.receivable_account
+        paid_to = accounts.paid_to
+        mode_of_payment = accounts.mode_of_payment
 
         if not paid_from or not paid_to:
             frappe.log_error("Paid From or Paid To account missing", "Payment Account Error")
@@ -745,8 +626,9 @@ def handle_success_callback():
             "allocated_amount": invoice.outstanding_amount
         })
 
-        payment_entry.insert(ignore_permissions=True)
-        payment_entry.submit()
+        with span("payment_entry.create"):
+            payment_entry.insert(ignore_permissions=True)
+            submit_payment_entry(payment_entry)
         frappe.db.commit()
 
         frappe.log_error(payment_entry.name, "Payment Entry Created")
@@ -756,7 +638,10 @@ def handle_success_callback():
                 invoice.stripe_session_id, 
                 "paid", 
                 "Sales Invoice", 
-                invoice.name
+                invoice.name,
+                transfer_type="Checkout",
+                amount=payment_entry.paid_amount,
+                company=invoice.company
             )
 
         frappe.local.response["type"] = "redirect"
@@ -0,0 +1,164 @@
+"""Per-payment trace ids and timed spans.
+
+A trace id is minted when a checkout session (or direct payment) is created,
+stored in the Stripe metadata of the session and its payment intent, and picked
+up again by the callbacks and webhook handlers. Every span recorded while a
+trace is active is pushed to a Redis list, which `flush_spans` moves into
+Stripe Payment Span in bulk, so tracing never adds a query to the payment path.
+"""
+
+import functools
+import json
+from contextlib import contextmanager
+from time import perf_counter
+
+import frappe
+from frappe.query_builder.functions import Avg, Count, Max
+from frappe.utils import get_datetime, now_datetime
+from redis.exceptions import RedisError
+
+from stripe_pay.methods.replica import read_from_replica
+
+SPANS_KEY = "stripe_pay:spans"
+FLUSH_BATCH_SIZE = 1000
+OK = "OK"
+ERROR = "Error"
+
+
+def new_trace_id():
+    return frappe.generate_hash(length=16)
+
+
+def get_trace_id():
+    return getattr(frappe.local, "stripe_pay_trace_id", None)
+
+
+def set_trace_id(trace_id):
+    frappe.local.stripe_pay_trace_id = trace_id
+
+
+def get_stripe_trace_id(obj):
+    """Trace id stored in the metadata of a Stripe object, or of an event's object."""
+    if obj and obj.get("object") == "event":
+        obj = obj["data"]["object"]
+    return ((obj or {}).get("metadata") or {}).get("trace_id")
+
+
+@contextmanager
+def span(stage, trace_id=None, reference=None):
+    """Time the block as one stage of the current payment trace.
+
+    `trace_id` starts or joins a trace for the block. A trace picked up inside the
+    block, e.g. from a session loaded half way through a callback, still counts
+    for the span.
+    """
+    previous = get_trace_id()
+    if trace_id:
+        set_trace_id(trace_id)
+
+    started_at = now_datetime()
+    started = perf_counter()
+    status = OK
+    try:
+        yield
+    except Exception:
+        status = ERROR
+        raise
+    finally:
+        current = get_trace_id()
+        if current:
+            record_span(current, stage, started_at, (perf_counter() - started) * 1000, status, reference)
+        if trace_id:
+            set_trace_id(previous)
+
+
+def traced(stage, new_trace=False):
+    """Decorator form of `span`; `new_trace` starts a fresh trace for every call."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, trace_id=new_trace_id() if new_trace else None):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_span(trace_id, stage, started_at, duration_ms, status=OK, reference=None):
+    try:
+        frappe.cache.rpush(
+            SPANS_KEY,
+            json.dumps(
+                [trace_id, stage, str(started_at), round(duration_ms, 3), status, reference],
+                separators=(",", ":"),
+            ),
+        )
+    except RedisError:
+        # tracing must never fail a payment
+        pass
+
+
+def flush_spans():
+    """Scheduled: move buffered spans from Redis into Stripe Payment Span."""
+    while True:
+        spans = frappe.cache.lrange(SPANS_KEY, 0, FLUSH_BATCH_SIZE - 1)
+        if not spans:
+            return
+
+        now = now_datetime()
+        frappe.db.bulk_insert(
+            "Stripe Payment Span",
+            [
+                "name", "creation", "modified", "owner", "modified_by",
+                "trace_id", "stage", "started_at", "duration_ms", "status", "reference",
+            ],
+            [
+                (frappe.generate_hash(length=10), now, now, "Administrator", "Administrator", *json.loads(item))
+                for item in spans
+            ],
+        )
+        frappe.db.commit()
+
+        # spans pushed meanwhile are appended after the flushed ones and survive the trim
+        frappe.cache.ltrim(SPANS_KEY, len(spans), -1)
+        if len(spans) < FLUSH_BATCH_SIZE:
+            return
+
+
+@frappe.whitelist()
+def get_trace(trace_id):
+    """All spans of one payment in the order they started."""
+    frappe.only_for("System Manager")
+    return frappe.get_all(
+        "Stripe Payment Span",
+        filters={"trace_id": trace_id},
+        fields=["stage", "status", "started_at", "duration_ms", "reference"],
+        order_by="started_at asc",
+    )
+
+
+@frappe.whitelist()
+def get_stage_latency(from_datetime, to_datetime):
+    """Count, average and worst duration per stage over a period."""
+    frappe.only_for("System Manager")
+    return _get_stage_latency(from_datetime, to_datetime)
+
+
+@read_from_replica
+def _get_stage_latency(from_datetime, to_datetime):
+    spans = frappe.qb.DocType("Stripe Payment Span")
+    return (
+        frappe.qb.from_(spans)
+        .select(
+            spans.stage,
+            Count(spans.name).as_("count"),
+            Avg(spans.duration_ms).as_("avg_ms"),
+            Max(spans.duration_ms).as_("max_ms"),
+        )
+        .where(spans.started_at[get_datetime(from_datetime) : get_datetime(to_datetime)])
+        .groupby(spans.stage)
+        .orderby(spans.stage)
+        .run(as_dict=True)
+    )
@@ -0,0 +1,45 @@
+import frappe
+from frappe.utils import now_datetime
+
+from stripe_pay.methods.tracing import get_trace_id
+from stripe_pay.stripe_pay.doctype.stripe_connected_account.stripe_connected_account import (
+    get_connected_account,
+)
+from stripe_pay.stripe_pay.doctype.stripe_payment_summary.stripe_payment_summary import (
+    record_payment_summary,
+)
+
+
+def create_stripe_transfer_log(
+    reference_id,
+    status,
+    reference_doc,
+    reference_name,
+    transfer_type=None,
+    amount=None,
+    payout_status=None,
+    account=None,
+    company=None,
+    commit=True,
+):
+    doc = frappe.new_doc("Stripe Transfer Details")
+    doc.reference_id = reference_id
+    doc.status = status
+    doc.datetime = now_datetime()
+    doc.reference_doc = reference_doc
+    doc.refrence_name = reference_name  # Note: keeping the typo from original
+    doc.account = account or get_connected_account(company=company)
+    doc.transfer_type = transfer_type
+    doc.amount = amount
+    doc.currency = "usd"
+    doc.payout_status = payout_status
+    doc.trace_id = get_trace_id()
+    doc.insert(ignore_permissions=True)
+    record_payment_summary(
+        amount, status, reference_doc=reference_doc, transfer_type=transfer_type,
+        company=company, currency=doc.currency, posting_date=doc.datetime,
+    )
+    if commit:
+        frappe.db.commit()
+    frappe.msgprint(f"Stripe Transfer Log created: {doc.name}")
+    return doc.name
@@ -0,0 +1,143 @@
+"""Route Stripe events to the handlers registered in the `stripe_webhook_handlers` hook.
+
+Handlers are registered per event type and per invoice doctype, like doc_events:
+
+    stripe_webhook_handlers = {
+        "checkout.session.completed": {
+            "*": "my_app.stripe.on_any_checkout",
+            "Sales Invoice": "my_app.stripe.on_sales_invoice_checkout",
+        },
+    }
+
+An event is routed by the invoice named in its object's metadata. "*" handlers run
+for every event of the type; events without an invoice in their metadata, such as
+those of sessions created before it was stored there, go to the handlers of every
+doctype, which find their invoice by session or payment intent id. Every handler
+call is counted and timed in Redis, read back by `get_handler_stats`.
+"""
+
+from time import perf_counter
+
+import frappe
+from frappe.utils import cint, flt
+from redis.exceptions import RedisError
+
+from stripe_pay.methods.tracing import span
+
+ANY_DOCTYPE = "*"
+# metadata key -> doctype, checked in order
+METADATA_DOCTYPES = {"collective_invoice": "Collective Invoices", "sales_invoice": "Sales Invoice"}
+STATS_KEY = "stripe_pay:webhook_handler_stats"
+COUNTERS = ("calls", "errors", "ms")
+
+
+def get_webhook_handlers():
+    return frappe.get_hooks("stripe_webhook_handlers")
+
+
+def get_handled_event_types():
+    return list(get_webhook_handlers())
+
+
+def get_event_doctype(event):
+    return get_object_reference(event["data"]["object"])[0]
+
+
+def get_object_reference(obj):
+    """(doctype, name) of the invoice named in a Stripe object's metadata."""
+    metadata = obj.get("metadata") or {}
+    for key, doctype in METADATA_DOCTYPES.items():
+        if metadata.get(key):
+            return doctype, metadata[key]
+    return None, None
+
+
+def get_event_handlers(event):
+    handlers_by_doctype = get_webhook_handlers().get(event["type"]) or {}
+    handlers = list(handlers_by_doctype.get(ANY_DOCTYPE, []))
+
+    doctype = get_event_doctype(event)
+    for handler_doctype, paths in handlers_by_doctype.items():
+        if handler_doctype != ANY_DOCTYPE and doctype in (None, handler_doctype):
+            handlers.extend(paths)
+    return handlers
+
+
+def dispatch_event(event):
+    """Run the event's handlers in order; a handler error propagates to the caller."""
+    handlers = get_event_handlers(event)
+    if not handlers:
+        frappe.log_error(f"Unhandled event type: {event['type']}", "Stripe Webhook Info")
+        return
+
+    for path in handlers:
+        run_handler(path, event["data"]["object"])
+
+
+def run_handler(path, obj):
+    started = perf_counter()
+    failed = True
+    try:
+        with span(f"handler.{path.rsplit('.', 1)[-1]}"):
+            frappe.get_attr(path)(obj)
+        failed = False
+    finally:
+        record_handler_call(path, (perf_counter() - started) * 1000, failed)
+
+
+def record_handler_call(path, duration_ms, failed):
+    try:
+        pipeline = frappe.cache.pipeline()
+        pipeline.incr(get_stats_key(path, "calls"))
+        pipeline.incrbyfloat(get_stats_key(path, "ms"), duration_ms)
+        if failed:
+            pipeline.incr(get_stats_key(path, "errors"))
+        pipeline.execute()
+    except RedisError:
+        pass
+
+
+def get_stats_key(path, counter):
+    return frappe.cache.make_key(f"{STATS_KEY}:{path}:{counter}")
+
+
+def get_registered_handlers():
+    return list(
+        dict.fromkeys(
+            path
+            for handlers_by_doctype in get_webhook_handlers().values()
+            for paths in handlers_by_doctype.values()
+            for path in paths
+        )
+    )
+
+
+@frappe.whitelist()
+def get_handler_stats():
+    """Calls, errors and time spent per registered handler since the last reset, slowest first."""
+    frappe.only_for("System Manager")
+
+    handlers = get_registered_handlers()
+    values = iter(frappe.cache.mget([get_stats_key(path, counter) for path in handlers for counter in COUNTERS]))
+
+    stats = []
+    for path in handlers:
+        calls, errors, total_ms = cint(next(values)), cint(next(values)), flt(next(values))
+        stats.append(
+            {
+                "handler": path,
+                "calls": calls,
+                "errors": errors,
+                "avg_ms": flt(total_ms / calls, 3) if calls else 0,
+                "total_ms": flt(total_ms, 3),
+            }
+        )
+    return sorted(stats, key=lambda row: row["total_ms"], reverse=True)
+
+
+@frappe.whitelist()
+def reset_handler_stats():
+    frappe.only_for("System Manager")
+    frappe.cache.delete(
+        *[get_stats_key(path, counter) for path in get_registered_handlers() for counter in COUNTERS]
+    )
@@ -0,0 +1,128 @@
+"""Sharded background processing of Stripe events.
+
+With `webhook_queue_shards` set to N, events are hashed by their target document
+onto the RQ queues stripe_webhooks_0 .. stripe_webhooks_{N-1}. Each queue must be
+declared in common_site_config.json and drained by exactly one worker, which keeps
+the events of one invoice in order while unrelated invoices run in parallel:
+
+    "workers": {"stripe_webhooks_0": {"timeout": 300}, "stripe_webhooks_1": {"timeout": 300}}
+
+    bench worker --queue stripe_webhooks_0
+"""
+
+import json
+import time
+import zlib
+from datetime import datetime
+
+import frappe
+from frappe.query_builder.functions import Max
+from frappe.utils import cint
+
+from stripe_pay.methods.client import get_secret_key
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.tracing import get_stripe_trace_id, record_span, span
+from stripe_pay.stripe_pay.doctype.stripe_processed_event.stripe_processed_event import (
+    get_event_target,
+    get_processed_event_ids,
+    mark_events_processed,
+)
+
+QUEUE_PREFIX = "stripe_webhooks_"
+
+# events that move an invoice's status; an older one must not overwrite a newer one
+ORDERED_EVENT_TYPES = [
+    "checkout.session.completed",
+    "checkout.session.async_payment_succeeded",
+    "checkout.session.async_payment_failed",
+    "payment_intent.payment_failed",
+]
+
+
+def get_queue_shards():
+    return cint(frappe.get_cached_doc("Stripe Payment Settings").webhook_queue_shards)
+
+
+def get_shard_queues(shards):
+    return [f"{QUEUE_PREFIX}{shard}" for shard in range(shards)]
+
+
+def get_shard_queue(event, shards):
+    # crc32 rather than hash(), which differs between worker processes
+    return f"{QUEUE_PREFIX}{zlib.crc32(get_event_target(event).encode()) % shards}"
+
+
+def submit_events(events, source):
+    """Apply events oldest first, either right away or on their target's queue shard."""
+    shards = get_queue_shards()
+    if not shards:
+        return apply_events(events, source)
+
+    for event in events:
+        frappe.enqueue(
+            "stripe_pay.methods.webhook_queue.process_queued_event",
+            queue=get_shard_queue(event, shards),
+            job_id=f"stripe_event::{event['id']}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+            payload=json.dumps(event),
+            source=source,
+            enqueued_at=time.time(),
+        )
+
+
+def process_queued_event(payload, source, enqueued_at=None):
+    """Shard worker job: apply one event unless the webhook or poller already did."""
+    stripe.api_key = get_secret_key()
+    event = stripe.Event.construct_from(json.loads(payload), stripe.api_key)
+    trace_id = get_stripe_trace_id(event)
+    if trace_id and enqueued_at:
+        record_span(
+            trace_id,
+            "webhook.queue_wait",
+            datetime.fromtimestamp(enqueued_at),
+            (time.time() - enqueued_at) * 1000,
+            reference=event["id"],
+        )
+    if get_processed_event_ids([event["id"]]):
+        return
+
+    apply_events([event], source)
+    frappe.db.commit()
+
+
+def apply_events(events, source):
+    from stripe_pay.api.stripe_webhook import process_event
+
+    for event in events:
+        if is_stale(event):
+            frappe.log_error(
+                f"Skipped {event['type']} {event['id']}: a newer event of {get_event_target(event)} was already applied",
+                "Stripe Stale Event",
+            )
+        else:
+            with span(f"event.{event['type']}", trace_id=get_stripe_trace_id(event), reference=event["id"]):
+                process_event(event)
+
+        # each event is committed with its processed mark, so a later event of the
+        # batch failing cannot undo it, and one that was neither applied nor parked
+        # in the dead-letter queue is never marked
+        mark_events_processed([event], source)
+        frappe.db.commit()
+
+
+def is_stale(event):
+    """Whether a newer status-changing event of the same target has already been applied."""
+    if event["type"] not in ORDERED_EVENT_TYPES or not event.get("created"):
+        return False
+
+    processed = frappe.qb.DocType("Stripe Processed Event")
+    last_applied = (
+        frappe.qb.from_(processed)
+        .select(Max(processed.event_created))
+        .where(processed.target == get_event_target(event))
+        .where(processed.event_type.isin(ORDERED_EVENT_TYPES))
+        .where(processed.name != event["id"])
+        .run()
+    )[0][0]
+    return bool(last_applied and datetime.fromtimestamp(event["created"]) < last_applied)
@@ -0,0 +1,9 @@
+import frappe
+
+
+def execute():
+	"""Check defaults only apply to new Singles; turn prewarming on where it was never set."""
+	if frappe.db.get_value(
+		"Singles", {"doctype": "Stripe Payment Settings", "field": "prewarm_client"}, "value"
+	) is None:
+		frappe.db.set_single_value("Stripe Payment Settings", "prewarm_client", 1)
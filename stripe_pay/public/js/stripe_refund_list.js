@@ -0,0 +1,72 @@
+// Bulk "Refund via Stripe" action for the Sales Invoice and Collective Invoices lists.
+// Extends the list settings other apps may already have defined for these doctypes.
+(function () {
+    ["Sales Invoice", "Collective Invoices"].forEach((doctype) => {
+        const settings = (frappe.listview_settings[doctype] = frappe.listview_settings[doctype] || {});
+        if (settings.stripe_refund_action) {
+            // this file is loaded for each list, add the action only once
+            return;
+        }
+        settings.stripe_refund_action = true;
+        const onload = settings.onload;
+
+        settings.onload = function (listview) {
+            if (onload) {
+                onload(listview);
+            }
+            listview.page.add_action_item(__("Refund via Stripe"), () => refund_with_stripe(listview));
+        };
+    });
+
+    function refund_with_stripe(listview) {
+        const invoices = listview.get_checked_items(true);
+        if (!invoices.length) {
+            return;
+        }
+
+        frappe.confirm(
+            __("Refund the Stripe payments of {0} invoice(s)? This cannot be undone.", [invoices.length]),
+            () => {
+                frappe.call({
+                    method: "stripe_pay.methods.refunds.bulk_refund",
+                    args: {
+                        invoices: invoices,
+                        reference_doctype: listview.doctype,
+                    },
+                    callback: () => track_progress(listview),
+                });
+            }
+        );
+    }
+
+    function track_progress(listview) {
+        const failed = [];
+        const handler = (data) => {
+            if (data.error) {
+                failed.push(`${data.invoice}: ${data.error}`);
+            }
+            frappe.show_progress(
+                __("Refunding via Stripe"),
+                data.done,
+                data.total,
+                __("{0}: {1}", [data.invoice, data.status])
+            );
+
+            if (data.done >= data.total) {
+                frappe.realtime.off("stripe_bulk_refund_progress", handler);
+                frappe.hide_progress();
+                listview.refresh();
+                if (failed.length) {
+                    frappe.msgprint({
+                        title: __("Some refunds need attention"),
+                        message: failed.join("<br>"),
+                        indicator: "orange",
+                    });
+                } else {
+                    frappe.show_alert({ message: __("Refunds completed"), indicator: "green" });
+                }
+            }
+        };
+        frappe.realtime.on("stripe_bulk_refund_progress", handler);
+    }
+})();
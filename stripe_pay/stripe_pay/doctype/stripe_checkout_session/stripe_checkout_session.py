@@ -0,0 +1,88 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime
+
+from stripe_pay.methods.tracing import get_trace_id
+from stripe_pay.stripe_pay.doctype.stripe_payments.stripe_payments import (
+	OPEN as PAYMENT_OPEN,
+	record_session_payment,
+)
+
+OPEN = "Open"
+SUPERSEDED = "Superseded"
+COMPLETED = "Completed"
+EXPIRED = "Expired"
+
+
+class StripeCheckoutSession(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Checkout Session", ["status", "expires_at"])
+	frappe.db.add_index("Stripe Checkout Session", ["reference_doctype", "reference_name", "status"])
+
+
+def record_checkout_session(reference_doctype, reference_name, session, amount=None):
+	"""Track a new checkout session of an invoice; its earlier open sessions become superseded."""
+	checkout_session = frappe.qb.DocType("Stripe Checkout Session")
+	(
+		frappe.qb.update(checkout_session)
+		.set(checkout_session.status, SUPERSEDED)
+		.where(checkout_session.reference_doctype == reference_doctype)
+		.where(checkout_session.reference_name == reference_name)
+		.where(checkout_session.status == OPEN)
+		.run()
+	)
+
+	frappe.get_doc(
+		{
+			"doctype": "Stripe Checkout Session",
+			"session_id": session.id,
+			"status": OPEN,
+			"reference_doctype": reference_doctype,
+			"reference_name": reference_name,
+			"amount": amount,
+			"trace_id": get_trace_id(),
+			"url": session.url,
+			"expires_at": datetime.fromtimestamp(session.expires_at) if session.get("expires_at") else None,
+		}
+	).insert(ignore_permissions=True)
+	record_session_payment(session, PAYMENT_OPEN, reference_doctype, reference_name)
+
+
+def get_live_session(reference_doctype, reference_name):
+	"""The invoice's open checkout session that can still be paid, from local state only."""
+	return frappe.db.get_value(
+		"Stripe Checkout Session",
+		{
+			"reference_doctype": reference_doctype,
+			"reference_name": reference_name,
+			"status": OPEN,
+			"expires_at": [">", now_datetime()],
+		},
+		["session_id", "url", "expires_at"],
+		as_dict=True,
+	)
+
+
+def get_session_trace_id(session_id):
+	return frappe.db.get_value("Stripe Checkout Session", session_id, "trace_id") if session_id else None
+
+
+def set_session_status(session_ids, status):
+	if not session_ids:
+		return
+
+	checkout_session = frappe.qb.DocType("Stripe Checkout Session")
+	(
+		frappe.qb.update(checkout_session)
+		.set(checkout_session.status, status)
+		.where(checkout_session.name.isin(list(session_ids)))
+		.run()
+	)
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, S and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Stripe Connected Account", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,85 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+CONNECTED_ACCOUNTS_CACHE_KEY = "stripe_pay:connected_accounts"
+
+
+class StripeConnectedAccount(Document):
+	def validate(self):
+		if not self.enabled:
+			return
+		if self.customer:
+			self.validate_unique_assignment("customer", {"customer": self.customer})
+		elif self.company:
+			self.validate_unique_assignment("company", {"company": self.company, "customer": ["is", "not set"]})
+
+	def validate_unique_assignment(self, fieldname, filters):
+		filters.update({"enabled": 1, "name": ["!=", self.name]})
+		existing = frappe.db.get_value("Stripe Connected Account", filters)
+		if existing:
+			frappe.throw(
+				_("{0} {1} is already assigned to Stripe Connected Account {2}").format(
+					_(self.meta.get_label(fieldname)), frappe.bold(self.get(fieldname)), frappe.bold(existing)
+				)
+			)
+
+	def on_update(self):
+		clear_connected_account_cache()
+
+	def on_trash(self):
+		clear_connected_account_cache()
+
+
+def get_connected_account(company=None, customer=None):
+	"""Connected account for a customer or company: customer, then company, then the default account."""
+	registry = get_connected_account_registry()
+	return (
+		registry["customer"].get(customer)
+		or registry["company"].get(company)
+		or registry["default"]
+	)
+
+
+def get_all_connected_accounts():
+	return get_connected_account_registry()["all"]
+
+
+def get_connected_account_registry():
+	return frappe.cache.get_value(CONNECTED_ACCOUNTS_CACHE_KEY, build_connected_account_registry)
+
+
+def build_connected_account_registry():
+	rows = frappe.get_all(
+		"Stripe Connected Account",
+		filters={"enabled": 1},
+		fields=["account_id", "company", "customer", "is_default"],
+		order_by="creation asc",
+	)
+
+	registry = {"customer": {}, "company": {}, "default": None, "all": []}
+	for row in rows:
+		if row.customer:
+			registry["customer"][row.customer] = row.account_id
+		elif row.company:
+			registry["company"][row.company] = row.account_id
+		if row.is_default and not registry["default"]:
+			registry["default"] = row.account_id
+		if row.account_id not in registry["all"]:
+			registry["all"].append(row.account_id)
+
+	if not registry["default"]:
+		# the single account configured before the registry existed
+		settings = frappe.get_cached_doc("Stripe Payment Settings")
+		registry["default"] = settings.get_password("connected_account_id", raise_exception=False)
+		if registry["default"] and registry["default"] not in registry["all"]:
+			registry["all"].append(registry["default"])
+
+	return registry
+
+
+def clear_connected_account_cache(doc=None, method=None):
+	frappe.cache.delete_value(CONNECTED_ACCOUNTS_CACHE_KEY)
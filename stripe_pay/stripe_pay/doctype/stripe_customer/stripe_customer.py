@@ -0,0 +1,77 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+from stripe_pay.methods.client import stripe_call
+from stripe_pay.methods.sdk import stripe
+
+STRIPE_CUSTOMERS_CACHE_KEY = "stripe_pay:stripe_customers"
+
+
+class StripeCustomer(Document):
+	def on_update(self):
+		frappe.cache.hdel(STRIPE_CUSTOMERS_CACHE_KEY, self.customer)
+
+	def on_trash(self):
+		frappe.cache.hdel(STRIPE_CUSTOMERS_CACHE_KEY, self.customer)
+
+
+def get_stripe_customer(customer):
+	"""Stripe customer id of an ERPNext Customer, creating the Stripe customer on first use."""
+	if not customer:
+		return None
+
+	stripe_customer_id = frappe.cache.hget(
+		STRIPE_CUSTOMERS_CACHE_KEY,
+		customer,
+		lambda: frappe.db.get_value("Stripe Customer", {"customer": customer}, "stripe_customer_id"),
+	)
+	return stripe_customer_id or create_stripe_customer(customer)
+
+
+def get_checkout_customer_params(customer, metadata):
+	"""`checkout.Session.create` arguments attaching the buyer's Stripe customer.
+
+	The payment method is saved to that customer so repeat payments can reuse the
+	verified bank account. `metadata` goes on the payment intent, which lets
+	payment_intent.* webhooks find their invoice. If Stripe cannot be reached,
+	Checkout creates the customer as before.
+	"""
+	try:
+		stripe_customer_id = get_stripe_customer(customer)
+	except Exception:
+		frappe.log_error(frappe.get_traceback(), "Stripe Customer Lookup Failed")
+		stripe_customer_id = None
+
+	if not stripe_customer_id:
+		return {"customer_creation": "if_required", "payment_intent_data": {"metadata": metadata}}
+
+	return {
+		"customer": stripe_customer_id,
+		"payment_intent_data": {"metadata": metadata, "setup_future_usage": "off_session"},
+	}
+
+
+def create_stripe_customer(customer):
+	customer_name, email_id = frappe.db.get_value("Customer", customer, ["customer_name", "email_id"])
+	stripe_customer = stripe_call(
+		stripe.Customer.create,
+		name=customer_name,
+		email=email_id or None,
+		metadata={"erpnext_customer": customer},
+		# concurrent checkouts of a new customer end up with the same Stripe customer
+		idempotency_key=f"stripe-pay-customer-{frappe.local.site}-{customer}",
+	)
+
+	try:
+		frappe.get_doc(
+			{"doctype": "Stripe Customer", "customer": customer, "stripe_customer_id": stripe_customer.id}
+		).insert(ignore_permissions=True)
+	except frappe.DuplicateEntryError:
+		# the concurrent checkout stored the mapping first
+		pass
+
+	frappe.cache.hset(STRIPE_CUSTOMERS_CACHE_KEY, customer, stripe_customer.id)
+	return stripe_customer.id
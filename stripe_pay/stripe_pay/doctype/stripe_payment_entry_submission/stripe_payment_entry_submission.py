@@ -0,0 +1,13 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class StripePaymentEntrySubmission(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Payment Entry Submission", ["status", "company", "next_retry_at"])
@@ -1,9 +1,25 @@
 # Copyright (c) 2025, S and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
+from frappe import _
 from frappe.model.document import Document
+from frappe.utils import cint
 
 
 class StripePaymentSettings(Document):
-	pass
+	def validate(self):
+		self.validate_webhook_queues()
+
+	def validate_webhook_queues(self):
+		from frappe.utils.background_jobs import get_queue_list
+
+		from stripe_pay.methods.webhook_queue import get_shard_queues
+
+		missing = set(get_shard_queues(cint(self.webhook_queue_shards))) - set(get_queue_list())
+		if missing:
+			frappe.throw(
+				_("Add workers for these queues to common_site_config.json before enabling webhook shards: {0}").format(
+					", ".join(sorted(missing))
+				)
+			)
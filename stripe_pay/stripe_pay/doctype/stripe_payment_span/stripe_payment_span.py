@@ -0,0 +1,19 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Interval
+from frappe.query_builder.functions import Now
+
+
+class StripePaymentSpan(Document):
+	@staticmethod
+	def clear_old_logs(days=30):
+		"""Called by Log Settings with the retention set in hooks.default_log_clearing_doctypes."""
+		table = frappe.qb.DocType("Stripe Payment Span")
+		frappe.db.delete(table, filters=(table.creation < (Now() - Interval(days=days))))
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Payment Span", ["stage", "started_at"])
@@ -0,0 +1,123 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import hashlib
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder.functions import Function
+from frappe.utils import flt, getdate, now_datetime
+
+# transfer type of the rows the webhook handlers write
+WEBHOOK = "Webhook"
+SUMMARY_KEY = ["posting_date", "company", "reference_doc", "transfer_type", "status", "currency"]
+
+
+class StripePaymentSummary(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique(
+		"Stripe Payment Summary",
+		SUMMARY_KEY,
+		constraint_name="unique_summary_key",
+	)
+	frappe.db.add_index("Stripe Payment Summary", ["company", "posting_date"])
+
+
+def record_payment_summary(amount, status, reference_doc=None, transfer_type=None, company=None, currency="usd", posting_date=None):
+	"""Add one payment to its day/company/reference doc/type/status bucket with a single upsert."""
+	key = {
+		"posting_date": getdate(posting_date),
+		"company": company or "",
+		"reference_doc": reference_doc or "",
+		"transfer_type": transfer_type or "",
+		"status": (status or "").lower(),
+		"currency": (currency or "").lower(),
+	}
+	name = hashlib.sha1("|".join(str(key[field]) for field in SUMMARY_KEY).encode()).hexdigest()[:20]
+	now = now_datetime()
+	values = {
+		"name": name,
+		"creation": now,
+		"modified": now,
+		"owner": "Administrator",
+		"modified_by": "Administrator",
+		"amount": flt(amount),
+		**key,
+	}
+
+	if frappe.db.db_type == "postgres":
+		upsert = """on conflict (name) do update set
+			amount = "tabStripe Payment Summary".amount + excluded.amount,
+			payment_count = "tabStripe Payment Summary".payment_count + 1,
+			modified = excluded.modified"""
+	else:
+		upsert = """on duplicate key update
+			amount = amount + values(amount),
+			payment_count = payment_count + 1,
+			modified = values(modified)"""
+
+	frappe.db.sql(
+		f"""insert into `tabStripe Payment Summary`
+			(name, creation, modified, owner, modified_by, posting_date, company, reference_doc,
+			transfer_type, status, currency, amount, payment_count)
+		values
+			(%(name)s, %(creation)s, %(modified)s, %(owner)s, %(modified_by)s, %(posting_date)s, %(company)s,
+			%(reference_doc)s, %(transfer_type)s, %(status)s, %(currency)s, %(amount)s, 1)
+		{upsert}""",
+		values,
+	)
+
+
+@frappe.whitelist()
+def rebuild_payment_summary():
+	"""Recompute the summary of Stripe Transfer Details, e.g. after a manual data fix.
+
+	Rows of transfer type Webhook are kept: they are written by the webhook handlers
+	from the events themselves, which are not stored anywhere to rebuild them from.
+	"""
+	from stripe_pay.methods.allocation import get_collective_invoice_companies
+
+	frappe.only_for("System Manager")
+
+	details = frappe.qb.DocType("Stripe Transfer Details")
+	sales_invoice = frappe.qb.DocType("Sales Invoice")
+	rows = (
+		frappe.qb.from_(details)
+		.left_join(sales_invoice)
+		.on((details.reference_doc == "Sales Invoice") & (details.refrence_name == sales_invoice.name))
+		.select(
+			Function("DATE", details.datetime).as_("posting_date"),
+			sales_invoice.company,
+			details.reference_doc,
+			details.refrence_name,
+			details.transfer_type,
+			details.status,
+			details.currency,
+			details.amount,
+		)
+		.run(as_dict=True)
+	)
+	collective_invoice_companies = get_collective_invoice_companies(
+		{row.refrence_name for row in rows if row.reference_doc == "Collective Invoices" and row.refrence_name}
+	)
+
+	summary = frappe.qb.DocType("Stripe Payment Summary")
+	frappe.qb.from_(summary).delete().where(summary.transfer_type != WEBHOOK).run()
+	for row in rows:
+		if row.reference_doc == "Collective Invoices":
+			row.company = collective_invoice_companies.get(row.refrence_name)
+		record_payment_summary(
+			row.amount,
+			row.status,
+			reference_doc=row.reference_doc,
+			transfer_type=row.transfer_type,
+			company=row.company,
+			currency=row.currency,
+			posting_date=row.posting_date,
+		)
+
+	frappe.db.commit()
+	return len(rows)
@@ -1,9 +1,156 @@
 # Copyright (c) 2025, S and contributors
 # For license information, please see license.txt
 
-# import frappe
+from datetime import datetime
+
+import frappe
 from frappe.model.document import Document
+from frappe.query_builder.functions import Coalesce
+from frappe.utils import add_days, cint, getdate, now_datetime
+
+OPEN = "Open"
+PROCESSING = "Processing"
+EXPIRED = "Expired"
+PAID = "Paid"
+FAILED = "Failed"
+REFUNDED = "Refunded"
+
+# a payment only moves forward in this order, so a late callback or a replayed
+# event cannot undo a state that was reached after it; Paid and Refunded are
+# final, a failure handled after the success of the same payment is ignored, and
+# a session swept as expired cannot undo a payment that is settling or paid
+STATUS_ORDER = [OPEN, EXPIRED, PROCESSING, FAILED, PAID, REFUNDED]
+# set once and kept by later upserts
+FIRST_VALUE_FIELDS = ("stripe_created", "paid_at", "processing_since", "expected_settlement_date")
+DEFAULT_SETTLEMENT_DAYS = 4
 
 
 class StripePayments(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Payments", ["reference_doctype", "reference_name"])
+	frappe.db.add_index("Stripe Payments", ["status", "stripe_created"])
+	frappe.db.add_index("Stripe Payments", ["status", "expected_settlement_date"])
+
+
+def record_payment(session_id, **values):
+	"""Insert or update the ledger row of a checkout session with a single upsert.
+
+	Fields passed as None keep their stored value, and the status only moves
+	forward in STATUS_ORDER.
+	"""
+	values = {field: value for field, value in values.items() if value is not None}
+	now = now_datetime()
+	row = {
+		"name": session_id,
+		"creation": now,
+		"modified": now,
+		"owner": "Administrator",
+		"modified_by": "Administrator",
+		"session_id": session_id,
+		**values,
+	}
+
+	postgres = frappe.db.db_type == "postgres"
+	assignments = ["modified = excluded.modified" if postgres else "modified = values(modified)"]
+	for field in values:
+		assignments.append(get_upsert_assignment(field, postgres))
+
+	upsert = "on conflict (name) do update set" if postgres else "on duplicate key update"
+	frappe.db.sql(
+		f"""insert into `tabStripe Payments` ({", ".join(row)})
+		values ({", ".join(f"%({field})s" for field in row)})
+		{upsert} {", ".join(assignments)}""",
+		row,
+	)
+
+
+def get_upsert_assignment(field, postgres):
+	current = f'"tabStripe Payments".{field}' if postgres else field
+	new = f"excluded.{field}" if postgres else f"values({field})"
+
+	if field == "status":
+		order = ", ".join(frappe.db.escape(status) for status in STATUS_ORDER)
+		if postgres:
+			rank = f"array_position(array[{order}]::varchar[], {{}})"
+		else:
+			rank = f"field({{}}, {order})"
+		return f"status = case when {rank.format(new)} > {rank.format(current)} then {new} else {current} end"
+
+	if field in FIRST_VALUE_FIELDS:
+		return f"{field} = coalesce({current}, {new})"
+
+	return f"{field} = {new}"
+
+
+def record_session_payment(session, status, reference_doctype=None, reference_name=None, payment_method_type=None):
+	"""Ledger upsert from a Stripe checkout session object."""
+	now = now_datetime()
+	record_payment(
+		session["id"],
+		status=status,
+		payment_intent_id=session.get("payment_intent") or None,
+		amount=session.get("amount_total"),
+		currency=session.get("currency"),
+		reference_doctype=reference_doctype,
+		reference_name=reference_name,
+		payment_method_type=payment_method_type,
+		stripe_created=datetime.fromtimestamp(session["created"]) if session.get("created") else None,
+		paid_at=now if status == PAID else None,
+		processing_since=now if status == PROCESSING else None,
+		expected_settlement_date=get_expected_settlement_date(now) if status == PROCESSING else None,
+	)
+
+
+def get_expected_settlement_date(start):
+	"""Date a bank debit started at `start` should settle, counting business days only."""
+	days = cint(frappe.db.get_single_value("Stripe Payment Settings", "ach_settlement_days")) or DEFAULT_SETTLEMENT_DAYS
+	date = getdate(start)
+	while days:
+		date = add_days(date, 1)
+		if date.weekday() < 5:
+			days -= 1
+	return date
+
+
+def set_payment_status(status, session_ids=None, payment_intent_id=None):
+	"""Move existing ledger rows, by session or payment intent, forward to `status`."""
+	if not session_ids and not payment_intent_id:
+		return
+
+	ledger = frappe.qb.DocType("Stripe Payments")
+	query = (
+		frappe.qb.update(ledger)
+		.set(ledger.status, status)
+		.set(ledger.modified, now_datetime())
+		.where(ledger.status.isin(STATUS_ORDER[: STATUS_ORDER.index(status)]))
+	)
+	if status == PAID:
+		query = query.set(ledger.paid_at, Coalesce(ledger.paid_at, now_datetime()))
+	if session_ids:
+		query = query.where(ledger.name.isin(list(session_ids)))
+	else:
+		query = query.where(ledger.payment_intent_id == payment_intent_id)
+	query.run()
+
+
+def get_session_ids_reached(session_ids, status):
+	"""The subset of `session_ids` whose ledger row is at `status` or later in STATUS_ORDER."""
+	if not session_ids:
+		return set()
+
+	return set(
+		frappe.get_all(
+			"Stripe Payments",
+			filters={"name": ["in", list(session_ids)], "status": ["in", STATUS_ORDER[STATUS_ORDER.index(status) :]]},
+			pluck="name",
+		)
+	)
+
+
+def get_payment_reference(session_id=None, payment_intent_id=None):
+	"""(reference doctype, reference name) of a session or payment intent, from the ledger."""
+	filters = {"name": session_id} if session_id else {"payment_intent_id": payment_intent_id}
+	return frappe.db.get_value("Stripe Payments", filters, ["reference_doctype", "reference_name"]) or (None, None)
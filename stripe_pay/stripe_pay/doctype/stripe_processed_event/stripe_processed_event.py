@@ -0,0 +1,74 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Interval
+from frappe.query_builder.functions import Now
+from frappe.utils import now_datetime
+
+
+class StripeProcessedEvent(Document):
+	@staticmethod
+	def clear_old_logs(days=30):
+		"""Called by Log Settings with the retention set in hooks.default_log_clearing_doctypes."""
+		table = frappe.qb.DocType("Stripe Processed Event")
+		frappe.db.delete(table, filters=(table.creation < (Now() - Interval(days=days))))
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Processed Event", ["target", "event_created"])
+
+
+def get_event_target(event):
+	"""The document an event acts on, used to keep that document's events in order.
+
+	Checkout sessions and their payment intents carry the invoice in their metadata;
+	objects without it fall back to the payment intent, then to the object itself.
+	"""
+	obj = event["data"]["object"]
+	metadata = obj.get("metadata") or {}
+	if metadata.get("collective_invoice"):
+		return f"Collective Invoices:{metadata['collective_invoice']}"
+	if metadata.get("sales_invoice"):
+		return f"Sales Invoice:{metadata['sales_invoice']}"
+
+	payment_intent = obj.get("id") if obj.get("object") == "payment_intent" else obj.get("payment_intent")
+	if payment_intent:
+		return f"PaymentIntent:{payment_intent}"
+	return obj.get("id") or event["id"]
+
+
+def get_processed_event_ids(event_ids):
+	"""The subset of `event_ids` that has already been handled, in one query."""
+	if not event_ids:
+		return set()
+
+	return set(frappe.get_all("Stripe Processed Event", filters={"name": ["in", list(event_ids)]}, pluck="name"))
+
+
+def mark_events_processed(events, source):
+	"""Record handled events in bulk; ids seen before are skipped."""
+	now = now_datetime()
+	frappe.db.bulk_insert(
+		"Stripe Processed Event",
+		["name", "creation", "modified", "owner", "modified_by", "event_id", "event_type", "source", "event_created", "target"],
+		[
+			(
+				event["id"],
+				now,
+				now,
+				"Administrator",
+				"Administrator",
+				event["id"],
+				event["type"],
+				source,
+				datetime.fromtimestamp(event["created"]) if event.get("created") else None,
+				get_event_target(event),
+			)
+			for event in events
+		],
+		ignore_duplicates=True,
+	)
@@ -1,9 +1,14 @@
 # Copyright (c) 2025, S and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class StripeTransferDetails(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Transfer Details", ["reference_doc", "refrence_name"])
+	frappe.db.add_index("Stripe Transfer Details", ["account", "payout_status"])
@@ -0,0 +1,218 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, flt, now_datetime
+
+from stripe_pay.methods.client import get_secret_key, stripe_call
+from stripe_pay.methods.rate_limit import BACKGROUND
+from stripe_pay.methods.retry import get_next_retry_at, is_stripe_rejection, is_transient_stripe_error
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.tracing import get_trace_id, span
+from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+
+TRANSFER = "Transfer"
+PAYOUT = "Payout"
+QUEUED = "Queued"
+SUCCEEDED = "Succeeded"
+FAILED = "Failed"
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BATCH_SIZE = 20
+RETRY_BASE_DELAY = 120
+
+
+class StripeTransferRetry(Document):
+	def retry(self):
+		"""Send the stored request again under its idempotency key, rescheduling or failing it on error."""
+		settings = frappe.get_cached_doc("Stripe Payment Settings")
+		max_attempts = cint(settings.transfer_retry_max_attempts) or DEFAULT_MAX_ATTEMPTS
+		attempts = cint(self.attempts) + 1
+		create = stripe.Transfer.create if self.operation == TRANSFER else stripe.Payout.create
+
+		try:
+			with span(f"transfer_retry.{self.operation.lower()}", trace_id=self.trace_id, reference=self.name):
+				result = stripe_call(
+					create, idempotency_key=self.idempotency_key, priority=BACKGROUND, **json.loads(self.request)
+				)
+		except Exception as e:
+			frappe.db.rollback()
+			retry = is_transient_stripe_error(e) and attempts < max_attempts
+			self.db_set(
+				{
+					"attempts": attempts,
+					"last_attempt_at": now_datetime(),
+					"error_class": type(e).__name__,
+					"error": frappe.get_traceback(),
+					"status": QUEUED if retry else FAILED,
+					"next_retry_at": get_next_retry_at(attempts, RETRY_BASE_DELAY) if retry else None,
+					"idempotency_key": get_next_idempotency_key(self.operation, self.idempotency_key, e),
+				}
+			)
+			return False
+
+		# in the same transaction as the log and the follow-up payout, so neither can be written twice
+		self.db_set(
+			{
+				"attempts": attempts,
+				"last_attempt_at": now_datetime(),
+				"status": SUCCEEDED,
+				"next_retry_at": None,
+				"result_id": result.id,
+			}
+		)
+		self.on_success(result.id, settings)
+		return True
+
+	def on_success(self, result_id, settings):
+		from stripe_pay.methods.payouts import BATCHED
+
+		batched = settings.payout_mode == BATCHED
+		create_stripe_transfer_log(
+			result_id, "paid", self.reference_doc, self.reference_name,
+			transfer_type=self.operation, amount=flt(self.amount) / 100,
+			payout_status="Pending" if self.operation == TRANSFER and batched else None,
+			account=self.account, company=self.company, commit=False,
+		)
+		if self.operation != TRANSFER:
+			return
+
+		if self.hold_payment_entry:
+			self.post_payment_entry(result_id)
+		if self.payout_request and not batched:
+			queue_transfer_retry(
+				PAYOUT, json.loads(self.payout_request), self.reference_doc, self.reference_name,
+				company=self.company, trace_id=self.trace_id,
+			)
+
+	def post_payment_entry(self, transfer_id):
+		"""Post the Payment Entry held back while the transfer was queued.
+
+		A failure is logged for the entry to be made by hand; it must not undo the
+		transfer that has gone through.
+		"""
+		from stripe_pay.methods.stripe import create_transfer_payment_entry
+		from stripe_pay.methods.stripe_collective import create_collective_payment_entry
+
+		frappe.db.savepoint("post_payment_entry")
+		try:
+			doc = frappe.get_doc(self.reference_doc, self.reference_name)
+			if self.reference_doc == "Collective Invoices":
+				payment_entry = create_collective_payment_entry(doc, transfer_id)
+			else:
+				payment_entry = create_transfer_payment_entry(doc, transfer_id)
+		except Exception:
+			frappe.db.rollback(save_point="post_payment_entry")
+			frappe.log_error(frappe.get_traceback(), f"Stripe Payment Entry Failed for {self.name}")
+			return
+
+		self.db_set("payment_entry", payment_entry)
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Transfer Retry", ["status", "next_retry_at"])
+
+
+def new_idempotency_key(operation):
+	return f"stripe-pay-{operation.lower()}-{frappe.generate_hash(length=32)}"
+
+
+def get_next_idempotency_key(operation, idempotency_key, exc):
+	if not idempotency_key or is_stripe_rejection(exc):
+		return new_idempotency_key(operation)
+	return idempotency_key
+
+
+def queue_transfer_retry(
+	operation, request, reference_doc, reference_name, company=None, idempotency_key=None,
+	exc=None, payout_request=None, trace_id=None, hold_payment_entry=False,
+):
+	"""Record a transfer or payout to be made by the retry worker.
+
+	`exc` is the error of the failed attempt: a permanent one records the request as
+	Failed, for an operator to requeue once its cause is fixed. With
+	`hold_payment_entry` the reference's Payment Entry is posted when the transfer
+	succeeds. Commits, so the item survives the rollback of a request that goes on
+	to throw.
+	"""
+	queued = exc is None or is_transient_stripe_error(exc)
+	doc = frappe.get_doc(
+		{
+			"doctype": "Stripe Transfer Retry",
+			"operation": operation,
+			"status": QUEUED if queued else FAILED,
+			"amount": request.get("amount"),
+			"currency": request.get("currency"),
+			"account": request.get("destination") or request.get("stripe_account"),
+			"company": company,
+			"reference_doc": reference_doc,
+			"reference_name": reference_name,
+			"idempotency_key": get_next_idempotency_key(operation, idempotency_key, exc),
+			"trace_id": trace_id or get_trace_id(),
+			"request": json.dumps(request),
+			"payout_request": json.dumps(payout_request) if payout_request else None,
+			"hold_payment_entry": 1 if hold_payment_entry else 0,
+			"attempts": 1 if exc else 0,
+			"last_attempt_at": now_datetime() if exc else None,
+			"next_retry_at": (get_next_retry_at(1, RETRY_BASE_DELAY) if exc else now_datetime()) if queued else None,
+			"error_class": type(exc).__name__ if exc else None,
+			"error": frappe.get_traceback() if exc else None,
+		}
+	)
+	doc.insert(ignore_permissions=True)
+	frappe.db.commit()
+	return doc.name
+
+
+def retry_failed_transfers():
+	"""Scheduled: retry due transfers and payouts in one batch, oldest due first."""
+	settings = frappe.get_cached_doc("Stripe Payment Settings")
+	batch_size = cint(settings.transfer_retry_batch_size) or DEFAULT_BATCH_SIZE
+	sk = get_secret_key()
+	if not sk:
+		return
+
+	stripe.api_key = sk
+
+	due = frappe.get_all(
+		"Stripe Transfer Retry",
+		filters={"status": QUEUED, "next_retry_at": ["<=", now_datetime()]},
+		order_by="next_retry_at asc",
+		limit=batch_size,
+		pluck="name",
+	)
+
+	for name in due:
+		frappe.get_doc("Stripe Transfer Retry", name).retry()
+		frappe.db.commit()
+
+	return len(due)
+
+
+@frappe.whitelist()
+def requeue_transfer_retries(names=None):
+	"""Queue failed transfers and payouts again, e.g. after fixing the account or balance.
+
+	The key of a request whose outcome was unknown is kept, so one Stripe did
+	complete is not made twice.
+	"""
+	frappe.only_for(["System Manager", "Accounts Manager"])
+	filters = {"status": FAILED}
+	if names:
+		filters["name"] = ["in", frappe.parse_json(names) if isinstance(names, str) else names]
+
+	failed = frappe.get_all("Stripe Transfer Retry", filters=filters, pluck="name")
+	if failed:
+		retry = frappe.qb.DocType("Stripe Transfer Retry")
+		(
+			frappe.qb.update(retry)
+			.set(retry.status, QUEUED)
+			.set(retry.attempts, 0)
+			.set(retry.next_retry_at, now_datetime())
+			.where(retry.name.isin(failed))
+			.run()
+		)
+	return {"requeued": len(failed)}
@@ -0,0 +1,156 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import json
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, get_datetime, now_datetime
+
+from stripe_pay.methods.client import get_secret_key
+from stripe_pay.methods.retry import get_next_retry_at
+from stripe_pay.methods.sdk import stripe
+from stripe_pay.methods.webhook_dispatch import dispatch_event
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 60
+DEFAULT_BATCH_SIZE = 50
+
+
+class StripeWebhookDeadLetter(Document):
+	def retry(self):
+		"""Re-dispatch the stored event, rescheduling or burying it if the handler fails again."""
+		from stripe_pay.methods.webhook_queue import is_stale
+
+		settings = frappe.get_cached_doc("Stripe Payment Settings")
+		max_attempts = cint(settings.webhook_max_attempts) or DEFAULT_MAX_ATTEMPTS
+		base_delay = cint(settings.webhook_retry_base_delay) or DEFAULT_BASE_DELAY
+
+		attempts = cint(self.attempts) + 1
+		event = stripe.Event.construct_from(json.loads(self.payload), stripe.api_key)
+		if is_stale(event):
+			# a newer event of the same invoice has been applied since, replaying this one would undo it
+			self.db_set({"attempts": attempts, "last_attempt_at": now_datetime(), "status": "Resolved", "next_retry_at": None})
+			return True
+
+		try:
+			dispatch_event(event)
+		except Exception as e:
+			frappe.db.rollback()
+			self.db_set(
+				{
+					"attempts": attempts,
+					"last_attempt_at": now_datetime(),
+					"error_class": type(e).__name__,
+					"error": frappe.get_traceback(),
+					"status": "Dead" if attempts >= max_attempts else "Pending",
+					"next_retry_at": None if attempts >= max_attempts else get_next_retry_at(attempts, base_delay),
+				}
+			)
+			return False
+
+		self.db_set({"attempts": attempts, "last_attempt_at": now_datetime(), "status": "Resolved", "next_retry_at": None})
+		return True
+
+
+def on_doctype_update():
+	frappe.db.add_index("Stripe Webhook Dead Letter", ["status", "next_retry_at"])
+
+
+def record_dead_letter(event, exc):
+	"""Park a webhook event whose handler raised, so it can be replayed later.
+
+	An event that is parked again counts as another attempt, and stays Dead once
+	it has used up `webhook_max_attempts`.
+	"""
+	settings = frappe.get_cached_doc("Stripe Payment Settings")
+	base_delay = cint(settings.webhook_retry_base_delay) or DEFAULT_BASE_DELAY
+	max_attempts = cint(settings.webhook_max_attempts) or DEFAULT_MAX_ATTEMPTS
+	values = {
+		"status": "Pending",
+		"error_class": type(exc).__name__,
+		"error": frappe.get_traceback(),
+		"last_attempt_at": now_datetime(),
+		"next_retry_at": get_next_retry_at(1, base_delay),
+	}
+
+	name = frappe.db.get_value("Stripe Webhook Dead Letter", {"event_id": event["id"]})
+	if name:
+		doc = frappe.get_doc("Stripe Webhook Dead Letter", name)
+		attempts = cint(doc.attempts) + 1
+		values["attempts"] = attempts
+		if attempts >= max_attempts:
+			values.update({"status": "Dead", "next_retry_at": None})
+		else:
+			values["next_retry_at"] = get_next_retry_at(attempts, base_delay)
+		doc.db_set(values)
+	else:
+		doc = frappe.get_doc(
+			{
+				"doctype": "Stripe Webhook Dead Letter",
+				"event_id": event["id"],
+				"event_type": event["type"],
+				"event_created": datetime.fromtimestamp(event["created"]) if event.get("created") else None,
+				"payload": json.dumps(event, indent=1),
+				"attempts": 1,
+				**values,
+			}
+		)
+		doc.insert(ignore_permissions=True)
+
+	frappe.db.commit()
+	return doc.name
+
+
+def retry_dead_letters():
+	"""Scheduled: replay due dead letters in one batch, oldest due first."""
+	settings = frappe.get_cached_doc("Stripe Payment Settings")
+	batch_size = cint(settings.webhook_retry_batch_size) or DEFAULT_BATCH_SIZE
+	sk = get_secret_key()
+	if not sk:
+		return
+
+	stripe.api_key = sk
+
+	due = frappe.get_all(
+		"Stripe Webhook Dead Letter",
+		filters={"status": "Pending", "next_retry_at": ["<=", now_datetime()]},
+		order_by="next_retry_at asc",
+		limit=batch_size,
+		pluck="name",
+	)
+
+	for name in due:
+		frappe.get_doc("Stripe Webhook Dead Letter", name).retry()
+		frappe.db.commit()
+
+	return len(due)
+
+
+@frappe.whitelist()
+def requeue_dead_letters(event_type=None, from_datetime=None, to_datetime=None, include_dead=1):
+	"""Bulk-requeue dead letters by event type and/or event time range and kick off a replay."""
+	frappe.only_for("System Manager")
+
+	statuses = ["Pending", "Dead"] if cint(include_dead) else ["Pending"]
+	dead_letter = frappe.qb.DocType("Stripe Webhook Dead Letter")
+	condition = dead_letter.status.isin(statuses)
+	if event_type:
+		condition &= dead_letter.event_type == event_type
+	if from_datetime:
+		condition &= dead_letter.event_created >= get_datetime(from_datetime)
+	if to_datetime:
+		condition &= dead_letter.event_created <= get_datetime(to_datetime)
+
+	names = frappe.qb.from_(dead_letter).select(dead_letter.name).where(condition).run(pluck=True)
+	if not names:
+		return {"requeued": 0}
+
+	frappe.qb.update(dead_letter).set(dead_letter.status, "Pending").set(dead_letter.attempts, 0).set(
+		dead_letter.next_retry_at, now_datetime()
+	).where(dead_letter.name.isin(names)).run()
+	frappe.db.commit()
+
+	frappe.enqueue("stripe_pay.stripe_pay.doctype.stripe_webhook_dead_letter.stripe_webhook_dead_letter.retry_dead_letters", queue="long")
+	return {"requeued": len(names)}
@@ -0,0 +1,55 @@
+// Copyright (c) 2026, S and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Stripe Payments Summary"] = {
+	filters: [
+		{
+			fieldname: "from_date",
+			label: __("From Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.get_today(),
+			reqd: 1,
+		},
+		{
+			fieldname: "to_date",
+			label: __("To Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.get_today(),
+			reqd: 1,
+		},
+		{
+			fieldname: "company",
+			label: __("Company"),
+			fieldtype: "Link",
+			options: "Company",
+		},
+		{
+			fieldname: "reference_doc",
+			label: __("Reference Doc"),
+			fieldtype: "Select",
+			options: ["", "Sales Invoice", "Collective Invoices"],
+		},
+		{
+			fieldname: "transfer_type",
+			label: __("Type"),
+			fieldtype: "Select",
+			options: ["", "Checkout", "Webhook", "Transfer", "Payout"],
+		},
+		{
+			fieldname: "status",
+			label: __("Status"),
+			fieldtype: "Data",
+		},
+		{
+			fieldname: "group_by",
+			label: __("Group By"),
+			fieldtype: "MultiSelectList",
+			get_data: function () {
+				return ["Date", "Company", "Reference Doc", "Type", "Status"].map((value) => ({
+					value: value,
+					description: "",
+				}));
+			},
+		},
+	],
+};
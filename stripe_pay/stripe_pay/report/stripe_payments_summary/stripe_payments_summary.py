@@ -0,0 +1,60 @@
+# Copyright (c) 2026, S and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.query_builder.functions import Sum
+
+from stripe_pay.methods.replica import read_from_replica
+
+GROUP_BY_FIELDS = {
+	"Date": "posting_date",
+	"Company": "company",
+	"Reference Doc": "reference_doc",
+	"Type": "transfer_type",
+	"Status": "status",
+}
+
+
+def execute(filters=None):
+	filters = frappe._dict(filters or {})
+	group_by = [GROUP_BY_FIELDS[label] for label in GROUP_BY_FIELDS if label in (filters.group_by or GROUP_BY_FIELDS)]
+	return get_columns(group_by), get_data(filters, group_by)
+
+
+def get_columns(group_by):
+	columns = {
+		"posting_date": {"label": _("Date"), "fieldname": "posting_date", "fieldtype": "Date", "width": 110},
+		"company": {"label": _("Company"), "fieldname": "company", "fieldtype": "Link", "options": "Company", "width": 180},
+		"reference_doc": {"label": _("Reference Doc"), "fieldname": "reference_doc", "fieldtype": "Link", "options": "DocType", "width": 160},
+		"transfer_type": {"label": _("Type"), "fieldname": "transfer_type", "fieldtype": "Data", "width": 100},
+		"status": {"label": _("Status"), "fieldname": "status", "fieldtype": "Data", "width": 100},
+	}
+	return [columns[field] for field in group_by] + [
+		{"label": _("Currency"), "fieldname": "currency", "fieldtype": "Data", "width": 80},
+		{"label": _("Amount"), "fieldname": "amount", "fieldtype": "Float", "precision": 2, "width": 140},
+		{"label": _("Count"), "fieldname": "payment_count", "fieldtype": "Int", "width": 90},
+	]
+
+
+@read_from_replica
+def get_data(filters, group_by):
+	summary = frappe.qb.DocType("Stripe Payment Summary")
+	fields = [summary.field(field) for field in group_by] + [summary.currency]
+
+	query = (
+		frappe.qb.from_(summary)
+		.select(*fields, Sum(summary.amount).as_("amount"), Sum(summary.payment_count).as_("payment_count"))
+		.groupby(*fields)
+		.orderby(*fields)
+	)
+
+	if filters.from_date:
+		query = query.where(summary.posting_date >= filters.from_date)
+	if filters.to_date:
+		query = query.where(summary.posting_date <= filters.to_date)
+	for field in ("company", "reference_doc", "transfer_type", "status"):
+		if filters.get(field):
+			query = query.where(summary.field(field) == filters.get(field))
+
+	return query.run(as_dict=True)
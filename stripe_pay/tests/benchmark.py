@@ -0,0 +1,65 @@
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+from unittest.mock import patch
+
+import frappe
+
+TRANSACTION_CONTROL = re.compile(r"^\s*(start transaction|begin|commit|rollback|savepoint|release savepoint)", re.I)
+
+
+@dataclass
+class Budget:
+	"""Upper bounds on the queries, commits, Stripe calls and time of one call of a hot function."""
+
+	queries: int
+	commits: int
+	stripe_calls: int
+	seconds: float
+
+
+@dataclass
+class Measurement:
+	queries: int = 0
+	commits: int = 0
+	stripe_calls: int = 0
+	seconds: float = 0.0
+	statements: list = field(default_factory=list)
+
+	def over_budget(self, budget):
+		"""Human readable list of the metrics that exceed the budget."""
+		return [
+			f"{metric}: {getattr(self, metric)} > {getattr(budget, metric)}"
+			for metric in ("queries", "commits", "stripe_calls", "seconds")
+			if getattr(self, metric) > getattr(budget, metric)
+		]
+
+
+@contextmanager
+def measure(sdk):
+	"""Count DB queries, commits and Stripe calls made inside the block and time it.
+
+	Commits are counted but not executed, so fixtures stay inside the test
+	transaction that FrappeTestCase rolls back.
+	"""
+	measurement = Measurement()
+	sql = frappe.db.sql
+	stripe_calls = len(sdk.calls)
+
+	def counting_sql(query, *args, **kwargs):
+		if not TRANSACTION_CONTROL.match(str(query)):
+			measurement.queries += 1
+			measurement.statements.append(str(query))
+		return sql(query, *args, **kwargs)
+
+	def counting_commit(*args, **kwargs):
+		measurement.commits += 1
+
+	started = perf_counter()
+	try:
+		with patch.object(frappe.db, "sql", counting_sql), patch.object(frappe.db, "commit", counting_commit):
+			yield measurement
+	finally:
+		measurement.seconds = perf_counter() - started
+		measurement.stripe_calls = len(sdk.calls) - stripe_calls
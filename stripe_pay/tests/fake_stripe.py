@@ -0,0 +1,178 @@
+import itertools
+import json
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import frappe
+
+
+class FakeStripeError(Exception):
+	pass
+
+
+class FakeInvalidRequestError(FakeStripeError):
+	pass
+
+
+class FakeSignatureVerificationError(FakeStripeError):
+	pass
+
+
+class FakeResource:
+	"""One Stripe API resource (Transfer, Payout, ...) backed by a dict of objects."""
+
+	def __init__(self, sdk, object_type, prefix, defaults=None):
+		self.sdk = sdk
+		self.object_type = object_type
+		self.prefix = prefix
+		self.defaults = defaults or {}
+
+	def create(self, **params):
+		self.sdk.record(self.object_type, "create", params)
+		return self.sdk.add(self.object_type, self.prefix, **self.defaults, **strip_options(params))
+
+	def retrieve(self, id, **params):
+		self.sdk.record(self.object_type, "retrieve", params)
+		obj = self.sdk.objects.get(id)
+		if not obj:
+			raise FakeInvalidRequestError(f"No such {self.object_type}: '{id}'")
+		return obj
+
+	def list(self, limit=10, **params):
+		self.sdk.record(self.object_type, "list", params)
+		filters = strip_options(params)
+		data = [
+			obj
+			for obj in reversed(self.sdk.objects.values())
+			if obj.object == self.object_type and matches(obj, filters)
+		]
+		return frappe._dict(object="list", data=data[:limit], has_more=len(data) > limit)
+
+	def expire(self, id, **params):
+		self.sdk.record(self.object_type, "expire", params)
+		obj = self.retrieve(id)
+		if obj.status != "open":
+			raise FakeInvalidRequestError(f"Only open sessions can be expired, this one is {obj.status}")
+		obj.status = "expired"
+		return obj
+
+	def construct_from(self, values, key):
+		return frappe._dict(values)
+
+	def modify(self, id, **params):
+		self.sdk.record(self.object_type, "modify", params)
+		obj = self.retrieve(id)
+		obj.update(strip_options(params))
+		return obj
+
+
+class FakeBalance:
+	def __init__(self, sdk):
+		self.sdk = sdk
+
+	def retrieve(self, **params):
+		self.sdk.record("balance", "retrieve", params)
+		return frappe._dict(
+			object="balance",
+			available=[frappe._dict(amount=0, currency="usd")],
+			pending=[frappe._dict(amount=0, currency="usd")],
+		)
+
+
+class FakeWebhook:
+	def __init__(self, sdk):
+		self.sdk = sdk
+
+	def construct_event(self, payload, sig_header, secret):
+		# signatures are not checked; an empty header stands for a forged request
+		if not sig_header:
+			raise FakeSignatureVerificationError("No signatures found matching the expected signature")
+		return frappe._dict(json.loads(payload))
+
+
+class FakeStripe:
+	"""In-memory stand-in for the `stripe` module.
+
+	Objects live in a dict for the lifetime of the fake and every API call is
+	recorded in `calls`, so tests can assert how many requests a function makes.
+	"""
+
+	def __init__(self):
+		self.api_key = None
+		self.objects = {}
+		self.calls = []
+		self._ids = itertools.count(1)
+
+		self.error = SimpleNamespace(
+			StripeError=FakeStripeError,
+			InvalidRequestError=FakeInvalidRequestError,
+			SignatureVerificationError=FakeSignatureVerificationError,
+		)
+		self.checkout = SimpleNamespace(
+			Session=FakeResource(
+				self,
+				"checkout.session",
+				"cs_test",
+				{"status": "open", "payment_status": "unpaid", "payment_intent": None, "currency": "usd"},
+			)
+		)
+		self.Customer = FakeResource(self, "customer", "cus_test")
+		self.PaymentIntent = FakeResource(self, "payment_intent", "pi_test", {"status": "processing"})
+		self.PaymentMethod = FakeResource(self, "payment_method", "pm_test", {"type": "us_bank_account"})
+		self.Refund = FakeResource(self, "refund", "re_test", {"status": "succeeded"})
+		self.Transfer = FakeResource(self, "transfer", "tr_test")
+		self.Payout = FakeResource(self, "payout", "po_test", {"status": "pending"})
+		self.Event = FakeResource(self, "event", "evt_test")
+		self.BalanceTransaction = FakeResource(self, "balance_transaction", "txn_test", {"fee": 0})
+		self.Balance = FakeBalance(self)
+		self.Webhook = FakeWebhook(self)
+
+	def record(self, object_type, method, params):
+		self.calls.append((object_type, method, params))
+
+	def add(self, object_type, prefix, **fields):
+		"""Store an object without recording an API call, for fixtures."""
+		obj = frappe._dict(id=f"{prefix}_{next(self._ids)}", object=object_type, created=int(time.time()))
+		obj.update(fields)
+		if object_type == "checkout.session":
+			obj.setdefault("url", f"https://checkout.stripe.test/{obj.id}")
+		self.objects[obj.id] = obj
+		return obj
+
+	def count(self, object_type=None, method=None):
+		return sum(
+			1
+			for call_type, call_method, _ in self.calls
+			if object_type in (None, call_type) and method in (None, call_method)
+		)
+
+
+# request options the SDK accepts on every call; they are not object fields
+REQUEST_OPTIONS = ("stripe_account", "idempotency_key", "api_key", "stripe_version", "expand")
+
+
+def strip_options(params):
+	return {key: value for key, value in params.items() if key not in REQUEST_OPTIONS}
+
+
+def matches(obj, filters):
+	for key, value in filters.items():
+		if isinstance(value, dict):
+			# range filters such as created={"gte": ...}
+			if "gte" in value and not obj.get(key, 0) >= value["gte"]:
+				return False
+			if "lte" in value and not obj.get(key, 0) <= value["lte"]:
+				return False
+		elif key not in ("starting_after", "ending_before") and obj.get(key) != value:
+			return False
+	return True
+
+
+@contextmanager
+def fake_stripe():
+	"""Serve `stripe_pay.methods.sdk.stripe` from a fresh FakeStripe for the duration of the block."""
+	sdk = FakeStripe()
+	with patch("stripe_pay.methods.sdk.get_stripe_module", return_value=sdk):
+		yield sdk
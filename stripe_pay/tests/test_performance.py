@@ -0,0 +1,296 @@
+# Copyright (c) 2026, S and Contributors
+# See license.txt
+
+"""Query, commit, Stripe call and wall time budgets for the app's hot functions.
+
+Stripe is replaced by an in-memory fake and ERPNext's own Payment Entry posting
+is stubbed out, so the numbers only cover code in this app. Each function is
+run once to warm caches and then measured against its entry in BUDGETS.
+
+bench --site <site> run-tests --module stripe_pay.tests.test_performance
+"""
+
+import json
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import frappe
+from frappe.test_runner import make_test_records
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+from stripe_pay.tests.benchmark import Budget, measure
+from stripe_pay.tests.fake_stripe import fake_stripe
+
+# Upper bounds. Commits and Stripe calls are the counts each path makes; queries
+# allow about 25% over the count, so cache and framework changes do not fail the
+# suite while a new query per row or per invoice still does. A change that moves
+# a path past its budget raises it in the same diff, so the cost shows in review.
+BUDGETS = {
+	"create_stripe_transfer_log": Budget(queries=8, commits=1, stripe_calls=0, seconds=0.5),
+	"create_stripe_url": Budget(queries=45, commits=1, stripe_calls=1, seconds=1.0),
+	"handle_success_callback": Budget(queries=59, commits=2, stripe_calls=3, seconds=2.0),
+	"create_stripe_payment": Budget(queries=50, commits=2, stripe_calls=2, seconds=2.0),
+	"create_collective_payment_entry": Budget(queries=7, commits=0, stripe_calls=0, seconds=0.5),
+	"create_stripe_url_collective": Budget(queries=27, commits=1, stripe_calls=1, seconds=1.0),
+	"handle_collective_success_callback": Budget(queries=47, commits=2, stripe_calls=3, seconds=2.0),
+	"webhook_checkout_completed": Budget(queries=65, commits=1, stripe_calls=0, seconds=2.0),
+	"webhook_payment_failed": Budget(queries=53, commits=1, stripe_calls=0, seconds=2.0),
+}
+
+TEST_ACCOUNT = "acct_test_default"
+
+
+class TestPerformance(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		make_test_records("Sales Invoice")
+
+		settings = frappe.get_single("Stripe Payment Settings")
+		settings.secret_key = "sk_test_fake"
+		settings.payout_mode = "Per Invoice"
+		settings.save()
+
+		if not frappe.db.exists("Stripe Connected Account", TEST_ACCOUNT):
+			frappe.get_doc(
+				{
+					"doctype": "Stripe Connected Account",
+					"account_id": TEST_ACCOUNT,
+					"account_name": "Test Account",
+					"is_default": 1,
+				}
+			).insert()
+
+		make_stripe_mode_of_payment("_Test Company", "Cash - _TC")
+
+	def setUp(self):
+		stripe_patcher = fake_stripe()
+		self.stripe = stripe_patcher.__enter__()
+		self.addCleanup(stripe_patcher.__exit__, None, None, None)
+
+		# ERPNext's posting cost is not ours to budget
+		from erpnext.accounts.doctype.payment_entry.payment_entry import PaymentEntry
+
+		for method in ("insert", "submit"):
+			patcher = patch.object(PaymentEntry, method, autospec=True, side_effect=fake_save)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def run_benchmark(self, name, fn, *args, **kwargs):
+		"""Call fn once to warm caches, then again measured against BUDGETS[name]."""
+		with measure(self.stripe):
+			fn(*args, **kwargs)
+
+		with measure(self.stripe) as measurement:
+			result = fn(*args, **kwargs)
+
+		over_budget = measurement.over_budget(BUDGETS[name])
+		self.assertFalse(
+			over_budget,
+			f"{name} is over its budget ({', '.join(over_budget)}). Queries:\n"
+			+ "\n".join(measurement.statements),
+		)
+		return result, measurement
+
+	def test_create_stripe_transfer_log(self):
+		from stripe_pay.methods.transfer_log import create_stripe_transfer_log
+
+		si = make_sales_invoice()
+		self.run_benchmark(
+			"create_stripe_transfer_log",
+			create_stripe_transfer_log,
+			"tr_test_log",
+			"paid",
+			"Sales Invoice",
+			si.name,
+			transfer_type="Transfer",
+			amount=si.grand_total,
+			company=si.company,
+		)
+
+	def test_create_stripe_url(self):
+		from stripe_pay.methods.stripe import create_stripe_url
+
+		si = make_sales_invoice()
+		self.require_field("Sales Invoice", "stripe_session_id")
+		result, _ = self.run_benchmark("create_stripe_url", create_stripe_url, si.name)
+		self.assertTrue(result["url"])
+
+	def test_handle_success_callback(self):
+		from stripe_pay.methods.stripe import handle_success_callback
+
+		si = make_sales_invoice()
+		self.require_field("Sales Invoice", "stripe_session_id")
+		si.db_set("stripe_session_id", self.make_checkout_session(si.grand_total).id)
+
+		with request_args(invoice=si.name):
+			self.run_benchmark("handle_success_callback", handle_success_callback)
+		self.assertIn("payment_status=success", frappe.local.response["location"])
+
+	def test_create_stripe_payment(self):
+		from stripe_pay.methods.stripe import create_stripe_payment
+
+		si = make_sales_invoice()
+		result, _ = self.run_benchmark("create_stripe_payment", create_stripe_payment, si.name)
+		self.assertTrue(result["transfer_id"])
+		self.assertEqual(self.stripe.objects[result["transfer_id"]].destination, TEST_ACCOUNT)
+
+	def test_create_collective_payment_entry(self):
+		from stripe_pay.methods.stripe_collective import create_collective_payment_entry
+
+		ci = make_collective_invoice_stub([make_sales_invoice() for _ in range(5)])
+		self.run_benchmark("create_collective_payment_entry", create_collective_payment_entry, ci, "tr_test")
+
+	def test_collective_payment_entry_queries_do_not_grow_with_invoices(self):
+		from stripe_pay.methods.stripe_collective import create_collective_payment_entry
+
+		invoices = [make_sales_invoice() for _ in range(10)]
+		_, few = self.run_benchmark(
+			"create_collective_payment_entry",
+			create_collective_payment_entry,
+			make_collective_invoice_stub(invoices[:2]),
+			"tr_test",
+		)
+		_, many = self.run_benchmark(
+			"create_collective_payment_entry",
+			create_collective_payment_entry,
+			make_collective_invoice_stub(invoices),
+			"tr_test",
+		)
+		self.assertEqual(few.queries, many.queries, "\n".join(many.statements))
+
+	def test_create_stripe_url_collective(self):
+		from stripe_pay.methods.stripe_collective import create_stripe_url_collective
+
+		ci = self.make_collective_invoice([make_sales_invoice(), make_sales_invoice()])
+		result, _ = self.run_benchmark("create_stripe_url_collective", create_stripe_url_collective, ci.name)
+		self.assertTrue(result["url"])
+
+	def test_handle_collective_success_callback(self):
+		from stripe_pay.methods.stripe_collective import handle_collective_success_callback
+
+		ci = self.make_collective_invoice([make_sales_invoice(), make_sales_invoice()])
+		ci.db_set("custom_stripe_session_id", self.make_checkout_session(ci.total_amount).id)
+
+		with request_args(collective_invoice=ci.name):
+			self.run_benchmark("handle_collective_success_callback", handle_collective_success_callback)
+		self.assertIn("payment_status=success", frappe.local.response["location"])
+
+	def test_webhook_checkout_completed(self):
+		from stripe_pay.api.stripe_webhook import process_event
+
+		ci = self.make_collective_invoice([make_sales_invoice()])
+		session = self.make_checkout_session(ci.total_amount, payment_status="paid")
+		ci.db_set("custom_stripe_session_id", session.id)
+
+		self.run_benchmark("webhook_checkout_completed", process_event, make_event("checkout.session.completed", session))
+		self.assertEqual(frappe.db.get_value("Collective Invoices", ci.name, "status"), "Paid")
+		self.assertFalse(frappe.db.exists("Stripe Webhook Dead Letter", {"status": "Pending"}))
+
+	def test_webhook_payment_failed(self):
+		from stripe_pay.api.stripe_webhook import process_event
+
+		ci = self.make_collective_invoice([make_sales_invoice()])
+		payment_intent = self.stripe.add(
+			"payment_intent", "pi_test", amount=int(flt(ci.total_amount) * 100), currency="usd",
+			last_payment_error={"message": "Insufficient funds"},
+		)
+		ci.db_set("custom_stripe_payment_intent_id", payment_intent.id)
+
+		self.run_benchmark("webhook_payment_failed", process_event, make_event("payment_intent.payment_failed", payment_intent))
+		self.assertEqual(frappe.db.get_value("Collective Invoices", ci.name, "status"), "Failed")
+
+	def make_checkout_session(self, amount, payment_status="unpaid"):
+		payment_method = self.stripe.add("payment_method", "pm_test", type="us_bank_account")
+		payment_intent = self.stripe.add("payment_intent", "pi_test", payment_method=payment_method.id)
+		return self.stripe.add(
+			"checkout.session",
+			"cs_test",
+			amount_total=int(flt(amount) * 100),
+			currency="usd",
+			payment_status=payment_status,
+			payment_intent=payment_intent.id,
+		)
+
+	def make_collective_invoice(self, invoices):
+		if not frappe.db.exists("DocType", "Collective Invoices"):
+			self.skipTest("Collective Invoices is not installed on this site")
+
+		ci = frappe.get_doc(
+			{
+				"doctype": "Collective Invoices",
+				"customer": invoices[0].customer,
+				"total_amount": sum(flt(si.grand_total) for si in invoices),
+				"reference_invoices": [
+					{"sales_invoice": si.name, "outstanding": si.outstanding_amount} for si in invoices
+				],
+			}
+		)
+		ci.flags.ignore_mandatory = True
+		ci.insert(ignore_permissions=True)
+		if ci.meta.is_submittable:
+			ci.submit()
+		return ci
+
+	def require_field(self, doctype, fieldname):
+		if not frappe.get_meta(doctype).has_field(fieldname):
+			self.skipTest(f"{doctype} has no {fieldname} field on this site")
+
+
+def make_sales_invoice():
+	from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+
+	return create_sales_invoice(rate=100, qty=1)
+
+
+def make_collective_invoice_stub(invoices):
+	"""In-memory Collective Invoice, for functions that only read it."""
+	return frappe._dict(
+		name="_Test Collective Invoice",
+		docstatus=1,
+		customer=invoices[0].customer,
+		total_amount=sum(flt(si.grand_total) for si in invoices),
+		reference_invoices=[
+			frappe._dict(sales_invoice=si.name, outstanding=si.outstanding_amount) for si in invoices
+		],
+	)
+
+
+def make_stripe_mode_of_payment(company, account):
+	if frappe.db.exists("Mode of Payment", "Stripe"):
+		return
+
+	frappe.get_doc(
+		{
+			"doctype": "Mode of Payment",
+			"mode_of_payment": "Stripe",
+			"type": "Bank",
+			"accounts": [{"company": company, "default_account": account}],
+		}
+	).insert()
+
+
+def make_event(event_type, obj):
+	return frappe._dict(
+		id=f"evt_test_{frappe.generate_hash(length=10)}",
+		type=event_type,
+		created=obj.created,
+		data={"object": json.loads(json.dumps(obj))},
+	)
+
+
+def fake_save(doc, *args, **kwargs):
+	doc.name = doc.name or frappe.generate_hash(length=10)
+	return doc
+
+
+@contextmanager
+def request_args(**args):
+	"""Serve `frappe.local.request.args` to whitelisted callbacks that read query parameters."""
+	previous = getattr(frappe.local, "request", None)
+	frappe.local.request = frappe._dict(args=args)
+	try:
+		yield
+	finally:
+		frappe.local.request = previous